@@ -0,0 +1,129 @@
+"""
+#########################   Adjust   #########################
+Split/dividend adjusted prices from the raw prices and the corporate actions
+
+The actions (ex-date, dividend amount, split coefficient) are taken from the
+daily-adjusted series and stored once per symbol. Every action scales the
+bars before its ex-date: splits divide the prices by the coefficient (and
+multiply the volumes) and dividends multiply the prices by
+(1 - dividend / previous close), as the adjusted close of Alpha Vantage.
+
+The cumulative factor of every bar is the product of the actions after it:
+a reversed cumulative product computed in one pass. New bars get a factor
+of 1 and a new action only multiplies the bars before it (the prefix).
+##############################################################
+"""
+import numpy as np
+import pandas as pd
+from src.resample import resample_bars
+
+
+ACTION_COLUMNS = ["dividend amount", "split coefficient", "factor"]
+PRICE_COLUMNS = ("open", "high", "low", "close")
+
+
+def extract_actions(data):
+    """
+    Corporate actions of a daily series with close, dividend amount and split coefficient columns.
+    factor: price factor of the bars before the ex-date
+    """
+    close = data["close"].to_numpy(dtype="<f8")
+    dividend = data["dividend amount"].to_numpy(dtype="<f8")
+    split = data["split coefficient"].to_numpy(dtype="<f8")
+    rows = np.flatnonzero((dividend != 0) | (split != 1))
+    previous = np.where(rows > 0, close[np.maximum(rows - 1, 0)], np.nan)
+    ratio = np.where(np.isfinite(previous) & (previous > 0), 1 - dividend[rows] / previous, 1.0)
+    return pd.DataFrame({"dividend amount": dividend[rows], "split coefficient": split[rows],
+                         "factor": ratio / split[rows]}, index=data.index[rows], columns=ACTION_COLUMNS)
+
+
+def merge_actions(stored, actions):
+    """Stored actions updated with the new ones (same ex-date: the new one wins)"""
+    if stored is None or stored.empty:
+        return actions
+    merged = pd.concat((stored[~stored.index.isin(actions.index)], actions[stored.columns]), axis=0)
+    return merged.sort_index()
+
+
+def cumulative_factors(dates, actions):
+    """Price and volume factors of every date: products of the actions after it (one vectorized pass)"""
+    # Factor of every action at the row of its ex-date (one extra row for the actions after the last date)
+    price, volume = np.ones(len(dates) + 1), np.ones(len(dates) + 1)
+    positions = dates.searchsorted(actions.index)
+    np.multiply.at(price, positions, actions["factor"].to_numpy())
+    np.multiply.at(volume, positions, actions["split coefficient"].to_numpy())
+    # Product of the rows after every row: reversed cumulative product, shifted one row
+    return np.cumprod(price[::-1])[::-1][1:], np.cumprod(volume[::-1])[::-1][1:]
+
+
+class AdjustmentFactors:
+    """Cumulative factors of a daily series, updated in place when it grows or new actions arrive"""
+
+    def __init__(self, dates, actions):
+        self.dates = pd.DatetimeIndex(dates)
+        self.actions = actions
+        self.price, self.volume = cumulative_factors(self.dates, actions)
+
+    def update(self, dates, actions):
+        """
+        Follow a series: appended dates get a factor of 1 and new (or revised) actions multiply the prefix before
+        their ex-date. Anything else (rewritten history, removed actions) is computed again.
+        :return: True if the factors were updated incrementally
+        """
+        dates = pd.DatetimeIndex(dates)
+        n = len(self.dates)
+        if len(dates) < n or not dates[:n].equals(self.dates) or not self.actions.index.isin(actions.index).all():
+            self.__init__(dates, actions)
+            return False
+        if len(dates) > n:
+            self.price = np.r_[self.price, np.ones(len(dates) - n)]
+            self.volume = np.r_[self.volume, np.ones(len(dates) - n)]
+            self.dates = dates
+        old = self.actions.reindex(actions.index).fillna(1.0)
+        changed = (old["factor"].to_numpy() != actions["factor"].to_numpy()) | \
+                  (old["split coefficient"].to_numpy() != actions["split coefficient"].to_numpy())
+        for date, factor, split, old_factor, old_split in zip(
+                actions.index[changed], actions["factor"].to_numpy()[changed],
+                actions["split coefficient"].to_numpy()[changed], old["factor"].to_numpy()[changed],
+                old["split coefficient"].to_numpy()[changed]):
+            prefix = dates.searchsorted(date)
+            self.price[:prefix] *= factor / old_factor
+            self.volume[:prefix] *= split / old_split
+        self.actions = actions
+        return True
+
+
+def adjust(data, factors, period=None):
+    """Adjusted OHLC and volume of a daily series (aggregated into weekly/monthly bars if period is given)"""
+    if len(data) != len(factors.dates):
+        raise ValueError(f"The factors ({len(factors.dates)} dates) do not match the data ({len(data)} rows)")
+    columns = {}
+    for column in data.columns:
+        if column in PRICE_COLUMNS:
+            columns[column] = data[column].to_numpy(dtype="<f8") * factors.price
+        elif column == "volume":
+            columns[column] = data[column].to_numpy(dtype="<f8") * factors.volume
+    adjusted = pd.DataFrame(columns, index=data.index, columns=list(columns))
+    return adjusted if period is None else resample_bars(adjusted, period)
+
+
+class FactorCache:
+    """AdjustmentFactors of every symbol, kept between calls so updates only touch what changed"""
+
+    def __init__(self):
+        self._factors = {}
+        self.incremental = 0
+        self.computed = 0
+
+    def factors(self, symbol, dates, actions):
+        cached = self._factors.get(symbol)
+        if cached is not None and cached.update(dates, actions):
+            self.incremental += 1
+            return cached
+        self.computed += 1
+        if cached is None:
+            cached = self._factors[symbol] = AdjustmentFactors(dates, actions)
+        return cached
+
+    def clear(self):
+        self._factors.clear()
@@ -5,15 +5,24 @@ Documentation:   https://www.alphavantage.co/documentation/
 """
 
 import re
+from os import getenv
 from src.config import crypto_currencies
 from src.utils import LOG, get_tabs
 
 
-ALPHA_VANTAGE_URI = "https://www.alphavantage.co/query"
+ALPHA_VANTAGE_URI = getenv("ALPHA_VANTAGE_URI", "https://www.alphavantage.co/query")
+COMPACT_SIZE = 100          # Rows of outputsize=compact (weekly and monthly series are always full)
 fx_regex = re.compile("^fx_")
 digital_regex = re.compile("^digital_")
 fx_data_regex = re.compile(r"\A[A-Z]{3,4}_[A-Z]{3,4}")
 fx_crypto_regex = re.compile(r"\ACRYPTO_[A-Z]{3,4}_[A-Z]{3,4}")
+intraday_regex = re.compile(r"\A(fx_)?intraday_(\d+min)\Z")
+INTRADAY_INTERVALS = ("1min", "5min", "15min", "30min", "60min")
+INTRADAY_CATEGORIES = tuple(f"{prefix}intraday_{interval}" for prefix in ("", "fx_") for interval in INTRADAY_INTERVALS)
+VANTAGE_CATEGORIES = INTRADAY_CATEGORIES + ("daily", "daily-adjusted", "weekly", "weekly-adjusted", "monthly", "monthly-adjusted", "search",
+                      "sector", "fx", "fx_exchange", "fx_rate", "fx_daily", "fx_weekly", "fx_monthly", "digital",
+                      "digital_fx", "digital_exchange", "digital_daily", "digital_weekly", "digital_keekly",
+                      "digital_monthly")
 
 
 def validate_stock_symbol(symbol):
@@ -28,9 +37,21 @@ def validate_currency_pair(symbol):
         raise TypeError("Currency symbol must be a list of two elements")
 
 
+def intraday_interval(category):
+    """'intraday_5min' or 'fx_intraday_5min' -> '5min' (None for other categories)"""
+    match = intraday_regex.match(category.lower())
+    if match is None:
+        return None
+    if match.group(2) not in INTRADAY_INTERVALS:
+        raise ValueError(f"Interval {match.group(2)} not supported. Please select one among {INTRADAY_INTERVALS}")
+    return match.group(2)
+
+
 def get_api_function(category):
     category = category.lower()
-    if category == "daily":
+    if intraday_regex.match(category):
+        function = "FX_INTRADAY" if category.startswith("fx_") else "TIME_SERIES_INTRADAY"
+    elif category == "daily":
         function = "TIME_SERIES_DAILY"
     elif category == "daily-adjusted":
         function = "TIME_SERIES_DAILY_ADJUSTED"
@@ -73,6 +94,13 @@ def alpha_vantage_query(symbol, category, output_size=None, datatype=None, key=N
         params = {"function": function, "symbol": symbol, "outputsize": output_size,
                   "datatype": datatype, "apikey": key}
 
+    elif category.startswith("intraday_"):
+        validate_stock_symbol(symbol)
+        # Retrieval of intraday bars (1min, 5min, 15min, 30min or 60min)
+        function = get_api_function(category)
+        params = {"function": function, "symbol": symbol, "interval": intraday_interval(category),
+                  "outputsize": output_size, "datatype": datatype, "apikey": key}
+
     elif category == "search":
         # Retrieval of best-matching symbols (with scores) and market info
         function = "SYMBOL_SEARCH"
@@ -108,6 +136,8 @@ def alpha_vantage_query(symbol, category, output_size=None, datatype=None, key=N
             function = get_api_function(category)
             params = {"function": function, "from_symbol": from_crrn, "to_symbol": to_crrn,
                       "outputsize": output_size, "datatype": datatype, "apikey": key}
+            if function == "FX_INTRADAY":
+                params["interval"] = intraday_interval(category)
 
     elif category in ["digital", "digital_fx"] or bool(digital_regex.match(category)):
         # Digital requires two values, the symbol and the market
@@ -161,3 +191,8 @@ def manage_vantage_errors(response, symbol):
             LOG.info(f"Retrieving {symbol}:{get_tabs(symbol, prev=12)}Max frequency reached! Waiting...")
             return "longWait"
     return None
+
+
+def is_vantage_data(response):
+    """False for error, throttling or informative messages (responses that must not be cached)"""
+    return isinstance(response, dict) and not any(k in response for k in ("Error Message", "Note", "Information"))
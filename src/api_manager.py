@@ -5,6 +5,8 @@ Retrieves information of stocks and currency using multiple API's
 """
 import re
 import json
+import time
+import pathlib
 import aiohttp
 import asyncio
 import aiofiles
@@ -14,8 +16,20 @@ import traceback
 from datetime import datetime
 from src.config import *
 from src.crawler_semaphore import SemaphoreController
-from src.alpha_vantage_api import alpha_vantage_query, manage_vantage_errors
-from src.utils import LOG, get_tabs, get_index, add_first_ts
+from src.alpha_vantage_api import is_vantage_data
+from src.providers import providers_for, pick_provider
+from src.storage import BACKENDS, get_backend, backend_for
+from src.catalog import Catalog, data_summary
+from src.resample import derived_from, resample_tail, select_columns, period_start
+from src.response_cache import ResponseCache, cache_key, ttl_for, conditional_headers
+from src.ingest import VantageResponse, load_body
+from src.offload import run_off_loop, metrics as offload_metrics
+from src.frame_cache import FrameCache
+from src.backfill import Gap, plan_fetch, find_gaps, series_period
+from src.adjust import extract_actions, merge_actions, adjust, FactorCache
+from src.telemetry import REGISTRY, trace, span
+from src.symbol_index import SymbolIndex, clean_keys
+from src.utils import LOG, get_tabs, get_index, add_first_ts, ts2datetime
 
 
 nest_asyncio.apply()
@@ -23,11 +37,45 @@ nest_asyncio.apply()
 clean_names_regex = re.compile("[\w]*$")
 capture_enum_regex = re.compile("^[\w]*\.\s*")
 # Functions & Filtering
-dateparse = lambda dates: pd.datetime.strptime(dates, '%Y-%m-%d')
 semaphore_controller = SemaphoreController()
-
-
-def build_path_and_file(symbol, category):
+response_cache = ResponseCache()
+frame_cache = FrameCache()
+factor_cache = FactorCache()
+catalog = Catalog()
+symbol_index = SymbolIndex()
+
+request_seconds = REGISTRY.histogram("pythia_request_seconds", "Latency of the api requests", ("api",))
+requests_total = REGISTRY.counter("pythia_requests_total", "Api requests by answer status", ("api", "status"))
+downloaded_bytes = REGISTRY.counter("pythia_downloaded_bytes_total", "Bytes received from the apis", ("api",))
+throttled_total = REGISTRY.counter("pythia_throttled_total", "Answers out of the api quota", ("api",))
+rate_wait_seconds = REGISTRY.histogram("pythia_rate_wait_seconds", "Seconds waiting for the api quota", ("api",))
+cached_total = REGISTRY.counter("pythia_cached_answers_total", "Queries answered by the response cache",
+                                ("category",))
+
+
+def cache_metrics(registry):
+    """Collector of the hit rates of the response, frame, adjustment factor caches and of the symbol index"""
+    hits = registry.gauge("pythia_cache_hits", "Hits of the in process caches", ("cache",))
+    misses = registry.gauge("pythia_cache_misses", "Misses of the in process caches", ("cache",))
+    ratio = registry.gauge("pythia_cache_hit_ratio", "Hit rate of the in process caches", ("cache",))
+    caches = {"response": response_cache.stats(), "frame": frame_cache.stats(),
+              "factors": {"hits": factor_cache.incremental, "misses": factor_cache.computed},
+              "symbols": {"hits": symbol_index.hits, "misses": symbol_index.misses}}
+    for name, stats in caches.items():
+        requests = stats["hits"] + stats["misses"]
+        hits.set(stats["hits"], cache=name)
+        misses.set(stats["misses"], cache=name)
+        ratio.set(stats["hits"] / requests if requests else 0.0, cache=name)
+
+
+REGISTRY.add_collector(cache_metrics)
+
+
+def build_path_and_file(symbol, category, backend=None):
+    """
+    Folder and data file of a symbol. The file extension depends on the storage backend;
+    if the file does not exist yet but another backend has it (e.g. not migrated), that one is used.
+    """
     if isinstance(symbol, (list, tuple)):
         # FX currencies (from, to) and digital currencies:
         if "digital_" in category:
@@ -35,68 +83,115 @@ def build_path_and_file(symbol, category):
         else:
             subfolder = symbol[0] + "_" + symbol[1]
         folder_name = DATA_FOLDER.joinpath(subfolder)
-        file_name = folder_name.joinpath(DFT_FX_FILE + "_" + category + DFT_FX_EXT)
+        file_name = folder_name.joinpath(DFT_FX_FILE + "_" + category)
     else:
         # Shares & stocks
         folder_name = DATA_FOLDER.joinpath(symbol)
-        file_name = folder_name.joinpath(DFT_STOCK_FILE + "_" + category + DFT_STOCK_EXT)
+        file_name = folder_name.joinpath(DFT_STOCK_FILE + "_" + category)
 
     folder_name.mkdir(parents=True, exist_ok=True)      # Create if doesn't exist
-    return folder_name, file_name
-
-
-def delta_surpassed(last_date, max_gap, category):
-    now = datetime.now()
-    delta = (now - last_date).days
-
-    if delta > max_gap:
-        if "monthly" in category and ((now.month - last_date.month > 0) or (now.year - last_date.year > 0)):
-            return True
-        elif "weekly" in category and delta > 7:
-            return True
-        else:
-            return True
-    return False
+    storage = get_backend(backend)
+    data_file = file_name.with_name(file_name.name + storage.extension)
+    if not data_file.exists():
+        for other in BACKENDS.values():
+            other_file = file_name.with_name(file_name.name + other.extension)
+            if other_file.exists():
+                return folder_name, other_file
+    return folder_name, data_file
 
 
 def build_info_file(folder_name, category):
     return folder_name.joinpath(DFT_INFO_FILE + "_" + category + DFT_INFO_EXT)
 
 
-async def query_data(symbol, category=None, api="vantage", verbose=VERBOSE, **kwargs):
-    if category is None:
-        raise ValueError("Please provide a valid category in the parameters")
-    # Get semaphore
-    semaphore_controller.get_semaphore(api)
-
-    if verbose > 2:
-        LOG.info("Successfully acquired the semaphore")
+def store_response(key, data, params, validators, valid=None, body_file=None):
+    """Cache the valid answers (the raw body of the streamed ones). The body of any other answer is dropped"""
+    valid = valid or (lambda answer: isinstance(answer, VantageResponse) or is_vantage_data(answer))
+    if valid(data):
+        if body_file is not None:
+            response_cache.put_body(key, body_file, params=params, etag=validators[0], last_modified=validators[1])
+        else:
+            response_cache.put(key, data, params=params, etag=validators[0], last_modified=validators[1])
+    elif body_file is not None and body_file.exists():
+        body_file.unlink()
 
-    if api == "vantage":
-        url, params = alpha_vantage_query(symbol, category, key=KEYS_SET["alpha_vantage"], **kwargs)
-        LOG.info(f"Retrieving {symbol}:{get_tabs(symbol, prev=12)}From '{api}' API")
-    else:
-        LOG.error(f"Not supported api {api}")
 
-    counter = 0
+async def query_data(symbol, category=None, api=None, stream=False, verbose=VERBOSE, **kwargs):
+    """
+    Query the providers through the response cache, the semaphores and the rate limiters.
+    api: provider name, list of candidate providers or None (every provider serving the category). Each attempt
+         goes to the candidate with spare quota, so a throttled provider fails over to the others
+    stream: parse time series answers while they are received; they are returned as VantageResponse(info, data)
+    """
+    if category is None:
+        raise ValueError("Please provide a valid category in the parameters")
+    candidates = providers_for(category, api=api)
+    queries = {provider.name: provider.build(symbol, category, **kwargs) for provider in candidates}
+
+    # Cached responses (of any candidate) do not consume the api quota
+    entries = {}
+    if RESPONSE_CACHE:
+        for provider in candidates:
+            url, params, _ = queries[provider.name]
+            key = cache_key(params, url=url)
+            data = response_cache.get(key, ttl_for(category))
+            if data is not None:
+                if verbose > 1:
+                    LOG.info(f"Retrieving {symbol}:{get_tabs(symbol, prev=12)}From cache")
+                cached_total.inc(category=category)
+                datatype = params.get("datatype", "json")
+                return provider.normalize(load_body(data, datatype, stream=stream)
+                                          if isinstance(data, pathlib.Path) else data)
+            entries[provider.name] = key, response_cache.lookup(key)        # Stale entry to revalidate
+
+    counter, data = 0, None
     while counter <= QUERY_RETRY_LIMIT:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, headers=HEADERS) as resp:
-                data = await resp.json()
-
-        if api == "vantage":
-            if manage_vantage_errors(data, symbol) == "longWait":
-                counter += 1
-                await asyncio.sleep(VANTAGE_WAIT)
-            else:
-                break
-
-    await asyncio.sleep(MIN_SEM_WAIT)
-    if verbose > 2:
-        LOG.info("Releasing Semaphore")
-    # Release semaphore
-    semaphore_controller.release_semaphore(api)
-    return data
+        provider = pick_provider(candidates)
+        url, params, headers = queries[provider.name]
+        key, entry = entries.get(provider.name, (None, None))
+        datatype = params.get("datatype", "json")
+
+        # Get semaphore
+        await semaphore_controller.get_semaphore(provider.name)
+        if verbose > 2:
+            LOG.info("Successfully acquired the semaphore")
+        try:
+            # Wait for the api quota (calls per minute / per day)
+            with rate_wait_seconds.time(api=provider.name):
+                await semaphore_controller.wait_for_rate(provider.name)
+            LOG.info(f"Retrieving {symbol}:{get_tabs(symbol, prev=12)}From '{provider.name}' API")
+            session = semaphore_controller.get_session(provider.name)
+            start = time.perf_counter()
+            async with session.get(url, params=params, headers={**headers, **conditional_headers(entry)}) as resp:
+                status = resp.status
+                requests_total.inc(api=provider.name, status=status)
+                if status == 304 and entry is not None:
+                    response_cache.refresh(key, entry)
+                    data = response_cache.payload(key, entry)
+                    data = load_body(data, datatype, stream=stream) if isinstance(data, pathlib.Path) else data
+                    break
+                validators = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+                body_file = response_cache.body_tmp_file(key) if stream and provider.stream and RESPONSE_CACHE else None
+                data = await provider.read(resp, params, stream=stream, body_file=body_file)
+                downloaded_bytes.inc(resp.content.total_bytes, api=provider.name)
+            request_seconds.observe(time.perf_counter() - start, api=provider.name)
+        finally:
+            if verbose > 2:
+                LOG.info("Releasing Semaphore")
+            # Release semaphore
+            semaphore_controller.release_semaphore(provider.name)
+
+        throttled = provider.check(data, status, symbol) == "longWait"
+        if RESPONSE_CACHE:
+            store_response(key, data, params, validators, valid=provider.valid, body_file=body_file)
+        if throttled:
+            # Out of quota: the next attempt goes to the candidate with spare quota (or waits for this one)
+            counter += 1
+            throttled_total.inc(api=provider.name)
+            semaphore_controller.throttled(provider.name)
+            continue
+        break
+    return provider.normalize(data)
 
 
 def clean_enumeration(data):
@@ -109,7 +204,15 @@ def clean_enumeration(data):
 
 
 def process_vantage_data(data):
-    """Receives the data as a dictionary of info + values and return the two independent dictionaries"""
+    """
+    Receives the data as a dictionary of info + values and return the two independent dictionaries.
+    Streamed answers (VantageResponse) return the info and the DataFrame already parsed
+    """
+    if isinstance(data, VantageResponse):
+        info = clean_enumeration(data.info)
+        if not info and not data.data.empty:
+            info = {"Last Refreshed": data.data.index[-1].strftime("%Y-%m-%d")}     # csv answers carry no metadata
+        return info, data.data
     metadata = data.get("Meta Data", None)
     if metadata:
         try:
@@ -131,6 +234,7 @@ async def save_stock_info(info_file, info, old_info=None, create=True):
     if write:
         async with aiofiles.open(info_file.as_posix(), mode="w") as f:
             await f.write(json.dumps(into2write, indent=2).encode('ascii', 'ignore').decode('ascii'))
+        catalog.record_info(info_file, into2write)
 
 
 async def read_info_file(info_file, check=True, verbose=VERBOSE):
@@ -185,21 +289,32 @@ def clean_pandas_data(dat):
     return data
 
 
-def save_pandas_data(file_name, dat, old_data=None, verbose=VERBOSE):
+def write_pandas_data(file_name, dat, old_data=None, start=None):
+    """
+    Clean, merge and serialize the data (CPU-heavy, runs in the worker processes, see src.offload).
+    dat: dict of the time series as received from the API, or a DataFrame already parsed (streamed answers).
+    start: with old_data, first stored date replaced (by default the second to last one)
+    Returns the summary of the file for the catalog. Raises ValueError if the data does not reach start
+    """
+    data = dat if isinstance(dat, pd.DataFrame) else clean_pandas_data(dat)
+
+    if old_data is not None:
+        if start is None:
+            # Avoid the last index as it may contain an incomplete week or month
+            start = old_data.index[-2]
+        dates = data.index if isinstance(data.index, pd.DatetimeIndex) else pd.to_datetime(data.index)
+        if not len(dates) or dates[0] > start:
+            # The answer does not overlap the stored data: the file is left unchanged
+            raise ValueError(f"The answer starts after {start}, the first stored date to replace")
+        backend_for(file_name).append(file_name, data[dates >= start], start=start)     # Update (tail only)
+    else:
+        backend_for(file_name).write(file_name, data)                           # Save
+    return data_summary(file_name)
+
+
+def save_pandas_data(file_name, dat, old_data=None, start=None, verbose=VERBOSE):
     try:
-        data = clean_pandas_data(dat)
-
-        if old_data is not None:
-            try:
-                # Avoid the last index as it may contain an incomplete week or month
-                last_dt = old_data.index[-2]
-                idx = data.index.get_loc(last_dt.strftime("%Y-%m-%d"))
-                updated_data = pd.concat((old_data.iloc[:-2, :], data.iloc[idx:, :]), axis=0)
-                updated_data.reset_index().to_csv(file_name, index=False, compression="infer")  # Update
-            except KeyError as err:
-                LOG.error(f"Error updating the data: {err}")
-        else:
-            data.reset_index().to_csv(file_name, index=False, compression="infer")          # Save
+        catalog.record_data(file_name, write_pandas_data(file_name, dat, old_data=old_data, start=start))
 
         if verbose > 1:
             symbol = file_name.parent.name
@@ -209,26 +324,107 @@ def save_pandas_data(file_name, dat, old_data=None, verbose=VERBOSE):
                   f"{err.__repr__()} {traceback.print_tb(err.__traceback__)}")
 
 
-def read_pandas_data(file_name):
+async def store_pandas_data(file_name, dat, old_data=None, start=None, verbose=VERBOSE):
+    """
+    save_pandas_data with the serialization in a worker process, so the loop keeps receiving answers.
+    Returns whether the data was saved
+    """
+    try:
+        summary = await run_off_loop("save", write_pandas_data, file_name, dat, old_data=old_data, start=start)
+        with offload_metrics.on_loop("catalog"):
+            catalog.record_data(file_name, summary)
+
+        if verbose > 1:
+            symbol = file_name.parent.name
+            LOG.info(f"Saved {symbol} data:{get_tabs(symbol, prev=12)}[{file_name.stem}] OK")
+        return True
+    except Exception as err:
+        LOG.error(f"ERROR saving data:\t\t{file_name.parent.name + file_name.stem} "
+                  f"{err.__repr__()} {traceback.print_tb(err.__traceback__)}")
+        return False
+
+
+def read_pandas_data(file_name, columns=None, cache=False):
+    """
+    Read a data file with the backend matching its extension. Use columns to read only a subset.
+    cache: keep it in memory (see src.frame_cache) while the file does not change. The frame shares the cached arrays
+    """
     if not file_name.exists():
         LOG.error(f"ERROR: data not found for {file_name}")
         return None
-    return pd.read_csv(file_name, parse_dates=['date'], index_col='date', date_parser=dateparse)
+    if cache:
+        return frame_cache.read(file_name, columns=columns)
+    return backend_for(file_name).read(file_name, columns=columns)
 
 
-def load_shares_data(symbols, period="daily"):
-    unique_value = False
+def load_universe(symbols, period="daily", columns=None, workers=None):
+    """
+    Data of many symbols, from the frame cache or decoded in parallel (see src.frame_cache).
+    :return: dict symbol -> DataFrame sharing the cached (read-only) arrays, None if there is no data
+    """
     if period not in INFO_VATIATIONS:
         raise ValueError(f"The period {period} is not supported. Please select one among {INFO_VATIATIONS}")
+    files = [build_path_and_file(symbol, period)[1] for symbol in symbols]
+    for file_name in files:
+        if not file_name.exists():
+            LOG.error(f"ERROR: data not found for {file_name}")
+    found = [n for n, file_name in enumerate(files) if file_name.exists()]
+    frames = dict.fromkeys(range(len(files)))
+    frames.update(zip(found, frame_cache.read_many([files[n] for n in found], columns=columns, workers=workers)))
+    return {symbol if isinstance(symbol, str) else tuple(symbol): frames[n] for n, symbol in enumerate(symbols)}
+
+
+def actions_file(symbol, backend=None):
+    """Corporate actions table of a stock (see src.adjust)"""
+    return DATA_FOLDER.joinpath(symbol, DFT_ACTIONS_FILE + get_backend(backend).extension)
+
+
+def write_actions(source_file, file_name):
+    """
+    Merge the corporate actions of a daily-adjusted file into the stored table (runs in the worker processes).
+    Returns True if the table changed
+    """
+    data = read_pandas_data(source_file, columns=["close", "dividend amount", "split coefficient"])
+    stored = read_pandas_data(file_name) if file_name.exists() else None
+    actions = merge_actions(stored, extract_actions(data))
+    if stored is not None and actions.equals(stored):
+        return False
+    backend_for(file_name).write(file_name, actions)
+    return True
+
+
+def load_adjusted(symbols, period="daily", workers=None):
+    """
+    Split/dividend adjusted OHLC and volume of stocks, from the daily-adjusted series and their corporate actions
+    (see src.adjust): no adjusted series is needed for any period.
+    :return: dict symbol -> DataFrame, None if there is no data
+    """
+    if period not in ("daily", "weekly", "monthly"):
+        raise ValueError(f"The period {period} is not supported. Please select one among daily, weekly or monthly")
+    frames = load_universe(symbols, "daily-adjusted", columns=["open", "high", "low", "close", "volume"],
+                           workers=workers)
+    adjusted = {}
+    for symbol, data in frames.items():
+        if data is None:
+            adjusted[symbol] = None
+            continue
+        file_name = actions_file(symbol)
+        if not file_name.exists():
+            write_actions(build_path_and_file(symbol, "daily-adjusted")[1], file_name)
+        factors = factor_cache.factors(symbol, data.index, read_pandas_data(file_name, cache=True))
+        adjusted[symbol] = adjust(data, factors, period=None if period == "daily" else period)
+    return adjusted
+
+
+def load_shares_data(symbols, period="daily", columns=None):
+    unique_value = False
     if isinstance(symbols, str):
         unique_value = True
         symbols = [symbols]
 
-    folders, files = zip(*[build_path_and_file(symbol, period) for symbol in symbols])
     data_group = []
-    for file_name in files:
-        # Read and transform data types
-        data = read_pandas_data(file_name)
+    for data in load_universe(symbols, period=period, columns=columns).values():
+        # Transform data types (no-op for typed backends)
         if "open" in data.columns:
             data.open = data.open.astype(float)
         if "close" in data.columns:
@@ -247,80 +443,175 @@ def load_shares_data(symbols, period="daily"):
         return data_group
 
 
-async def update_stock(symbol, category="daily", max_gap=0, api="vantage", verbose=VERBOSE):
-    folder_name, file_name = build_path_and_file(symbol, category)
-    info_file = build_info_file(folder_name, category)
-    info = None
+def write_derived_data(source_file, file_name, category):
+    """Resample the tail of a derived series (runs in the worker processes). Returns its first date and summary"""
+    source_category, period, adjusted = derived_from(category)
+    daily = select_columns(read_pandas_data(source_file), adjusted)
+    old_data = read_pandas_data(file_name) if file_name.exists() else None
+    if old_data is not None and old_data.columns.tolist() != daily.columns.tolist():
+        old_data = None             # Different layout (e.g. downloaded from the API): rebuild
+    data = daily if period is None else resample_tail(daily, old_data, period)
 
+    if old_data is None or old_data.empty:
+        backend_for(file_name).write(file_name, data)
+    else:
+        # Only the bars from the last stored one on are written
+        cutoff = old_data.index[-1] if period is None else period_start(old_data.index[-1], period)
+        backend_for(file_name).append(file_name, data[data.index >= cutoff], start=cutoff)
+    return data.index[0], data_summary(file_name)
+
+
+async def derive_stock(symbol, category="monthly", verbose=VERBOSE):
+    """
+    Build a weekly/monthly (or unadjusted) series from the stored daily-adjusted data, without API calls.
+    Returns ok, empty (no source data) or error
+    """
     try:
-        if folder_name.exists() and file_name.exists():
-            # Verify how much must be updated
-            data_stored = read_pandas_data(file_name)
-            first_date = data_stored.index[0]
-            last_date = data_stored.index[-1]
-
-            if delta_surpassed(last_date, max_gap, category):
-                LOG.info(f"Updating {symbol} data...")
-                # Retrieve only last range (alpha_vantage 100pts)
-                data = await query_data(symbol, category=category, api="vantage", outputsize="compact")
-                if data in [None, {}]:
-                    LOG.WARNING(f"No data received for {symbol}")
-                    return
+        source_category, _, _ = derived_from(category)
+        folder_name, source_file = build_path_and_file(symbol, source_category)
+        _, file_name = build_path_and_file(symbol, category)
+        if not source_file.exists():
+            LOG.warning(f"Deriving {symbol}:{get_tabs(symbol, prev=10)}No {source_category} data found")
+            return "empty"
+
+        first_ts, summary = await run_off_loop("derive", write_derived_data, source_file, file_name, category)
+        with offload_metrics.on_loop("catalog"):
+            catalog.record_data(file_name, summary)
+
+        source_info = await read_info_file(build_info_file(folder_name, source_category), check=False, verbose=verbose)
+        info = {**source_info, "Information": f"{category.capitalize()} prices derived from {source_category}",
+                "Derived From": source_category, "FirstTimeStamp": ts2datetime(first_ts)}
+        await save_stock_info(build_info_file(folder_name, category), info)
+        if verbose > 1:
+            LOG.info(f"Deriving {symbol}:{get_tabs(symbol, prev=10)}[{category}] OK")
+        return "ok"
+    except Exception as err:
+        LOG.error(f"Deriving {symbol}:{get_tabs(symbol, prev=10)}ERROR [{category}]: {err.__repr__()}")
+        return "error"
 
-                info, dat = process_vantage_data(data)
-                info = add_first_ts(info, first_date)
 
-                save_pandas_data(file_name, dat, old_data=data_stored, verbose=verbose)
-            else:
+async def plan_update(folder_name, category, dates, max_gap=0, verbose=VERBOSE):
+    """Fetch plan of a series (see src.backfill). The gaps found are recorded in the catalog"""
+    info = await read_info_file(build_info_file(folder_name, category), check=False, verbose=verbose)
+    with offload_metrics.on_loop("plan"):
+        confirmed = [Gap(pd.Timestamp(row["first_ts"]), pd.Timestamp(row["last_ts"]), row["sessions"], True)
+                     for row in catalog.gaps(folder_name.name, category, status="confirmed")]
+        plan = plan_fetch(dates, category, info=info, max_gap=max_gap, confirmed=confirmed)
+        if dates is not None:
+            catalog.record_gaps(folder_name.name, category, plan.gaps)
+    return plan
+
+
+async def confirm_gaps(file_name, folder_name, category, plan):
+    """After a full download, the gaps left are not available from the provider: the next plans ignore them"""
+    dates = (await run_off_loop("read", read_pandas_data, file_name, columns=[])).index
+    with offload_metrics.on_loop("plan"):
+        gaps = [gap._replace(confirmed=True) for gap in find_gaps(dates, plan.calendar, period=series_period(category))]
+        catalog.record_gaps(folder_name.name, category, gaps)
+    return gaps
+
+
+async def update_stock(symbol, category="daily", max_gap=0, api=None, verbose=VERBOSE):
+    """
+    Download the data missing in a series: the planner (see src.backfill) compares it with the trading calendar
+    and selects no fetch, a compact one (last 100 sessions) or a full one (new series or older holes).
+    Every call is a trace of src.telemetry with the seconds of its stages. Errors are logged, not raised: returns
+    the status of the trace, ok (updated or up to date), empty (no data received) or error
+    """
+    if api == "derive":
+        return await derive_stock(symbol, category=category, verbose=verbose)
+    folder_name, file_name = build_path_and_file(symbol, category)
+    info_file = build_info_file(folder_name, category)
+    info = None
+
+    with trace("update_stock", symbol=folder_name.name, category=category, status="ok") as current:
+        try:
+            data_stored = None
+            if file_name.exists():
+                # Verify how much must be updated (dates only)
+                with span("read"):
+                    data_stored = await run_off_loop("read", read_pandas_data, file_name, columns=[])
+            dates = None if data_stored is None else data_stored.index
+            with span("plan"):
+                plan = await plan_update(folder_name, category, dates, max_gap=max_gap, verbose=verbose)
+            current.attributes["fetch"] = plan.fetch
+
+            if plan.fetch == "none":
                 if verbose > 1:
-                    LOG.info(f"Updating {symbol}:{get_tabs(symbol, prev=10)}Ignored. Data {category} < {max_gap}d old")
-                return
-        else:
-            # Download and save new data
-            if verbose > 1:
-                LOG.info(f"Updating {symbol} ...")
-            data = await query_data(symbol, semaphore, category=category, api=api)
+                    LOG.info(f"Updating {symbol}:{get_tabs(symbol, prev=10)}Ignored. Data {category} up to date")
+                return "ok"
+            if dates is None:
+                if verbose > 1:
+                    LOG.info(f"Updating {symbol} ...")
+            else:
+                LOG.info(f"Updating {symbol} data... ({plan.missing} sessions missing, {plan.fetch})")
+            with span("query"):
+                data = await query_data(symbol, category=category, api=api, stream=True, outputsize=plan.fetch,
+                                        datatype=VANTAGE_DATATYPE)
             if data in [None, {}]:
-                LOG.WARNING(f"No data received for {symbol}")
-                return
+                LOG.warning(f"No data received for {symbol}")
+                current.attributes["status"] = "empty"
+                return "empty"
 
-            info, dat = process_vantage_data(data)
-            save_pandas_data(file_name, dat, verbose=verbose)
-
-        # Save/Update info
-        if info:
-            await update_stock_info(info_file, info)
+            with span("parse"):
+                info, dat = process_vantage_data(data)
+            with span("save"):
+                if plan.fetch == "compact":
+                    # Only the stored rows from the first missing one on are replaced
+                    info = add_first_ts(info, dates[0])
+                    saved = await store_pandas_data(file_name, dat, old_data=data_stored, start=plan.start,
+                                                    verbose=verbose)
+                else:
+                    # Download and save new data (or rewrite a series with holes older than the compact window)
+                    saved = await store_pandas_data(file_name, dat, verbose=verbose)
+                if not saved:
+                    current.attributes["status"] = "error"
+                    return "error"
+                if plan.fetch != "compact" and dates is not None:
+                    gaps = await confirm_gaps(file_name, folder_name, category, plan)
+                    if gaps and verbose > 0:
+                        LOG.warning(f"Updating {symbol}:{get_tabs(symbol, prev=10)}{len(gaps)} gaps not available")
+            if category == "daily-adjusted" and isinstance(symbol, str):
+                # Splits and dividends, to adjust the prices locally (see load_adjusted)
+                with span("actions"):
+                    await run_off_loop("actions", write_actions, file_name, actions_file(symbol))
+
+            # Save/Update info
+            if info:
+                with span("info"):
+                    await update_stock_info(info_file, info)
 
-        if verbose > 1:
-            LOG.info(f"Updating {symbol}:{get_tabs(symbol, prev=10)}Finished")
-    except Exception as err:
-        LOG.info(f"Updating {symbol}:{get_tabs(symbol, prev=10)}ERROR: {err.__repr__()} {traceback.print_tb(err.__traceback__)}")
+            if verbose > 1:
+                LOG.info(f"Updating {symbol}:{get_tabs(symbol, prev=10)}Finished")
+        except Exception as err:
+            current.attributes["status"] = "error"
+            LOG.info(f"Updating {symbol}:{get_tabs(symbol, prev=10)}ERROR: {err.__repr__()} {traceback.print_tb(err.__traceback__)}")
+        return current.attributes["status"]
 
 
-def retrieve_stock_list(symbols, category="daily", gap=7, api="vantage", verbose=VERBOSE):
+def retrieve_stock_list(symbols, category="daily", gap=7, api=None, verbose=VERBOSE):
     """
     Provided a list of symbols, update the info of the stocks for any stock where there is
     no information in the last (gap) days.
     :param symbols: list of symbols
     :param gap:     max allowed days of missing data before updating again
-    :param api:     api used to perform the queries
-    :param limit:   max number of concurrent connections
+    :param api:     provider, list of candidate providers or None (any provider serving the category)
     :return:
     """
     if not isinstance(symbols, (list, tuple)):
         raise TypeError("symbols must be a list")
 
-    if isinstance(api, list):
-        tasks = (update_stock(nsymbol, category=category, max_gap=gap, api=napi, verbose=verbose)
-                 for nsymbol, napi in zip(symbols, api))
-    else:
-        tasks = (update_stock(symbol, category=category, max_gap=gap, api=api) for symbol in symbols)
+    tasks = (update_stock(symbol, category=category, max_gap=gap, api=api, verbose=verbose) for symbol in symbols)
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(asyncio.gather(*tasks))
 
 
-def search_symbol(symbols=None, api="vantage", verbose=VERBOSE):
+def search_symbol(symbols=None, api=None, local=True, verbose=VERBOSE):
+    """
+    Best matches of every keyword. The local index (see src.symbol_index) answers the keywords it resolves; the
+    API is only queried on a miss (or for every keyword with local=False) and its answers are merged into the index
+    """
     if symbols == None:
         print('Function Help:\n' \
               '\tProvide a list of symbols, references, possible names, ISIN ref, SEDOL ref...\n' \
@@ -330,14 +621,21 @@ def search_symbol(symbols=None, api="vantage", verbose=VERBOSE):
     if isinstance(symbols, str):
         symbols = [symbols]
 
-    if isinstance(api, list):
-        tasks = (query_data(nsymbol, category="search", api=napi, verbose=verbose)
-                 for nsymbol, napi in zip(symbols, api))
-    else:
-        tasks = (query_data(symbol, category="search", api=api, verbose=verbose) for symbol in symbols)
-
-    loop = asyncio.get_event_loop()
-    return loop.run_until_complete(asyncio.gather(*tasks))
+    index = symbol_index.load(catalog=catalog, response_cache=response_cache if RESPONSE_CACHE else None)
+    answers = [index.lookup(symbol) if local else None for symbol in symbols]
+    missing = [n for n, answer in enumerate(answers) if answer is None]
+    if missing:
+        tasks = (query_data(symbols[n], category="search", api=api, verbose=verbose) for n in missing)
+        loop = asyncio.get_event_loop()
+        for n, answer in zip(missing, loop.run_until_complete(asyncio.gather(*tasks))):
+            if isinstance(answer, dict) and "bestMatches" in answer:
+                index.merge_answer(symbols[n], answer)
+                answer = {**answer, "bestMatches": [clean_keys(match) for match in answer["bestMatches"]]}
+            answers[n] = answer
+        index.save()
+    elif verbose > 1:
+        LOG.info(f"Search of {len(symbols)} keywords answered by the symbol index")
+    return answers
 
 
 def find_data(ref, db):
@@ -350,7 +648,7 @@ def find_data(ref, db):
         return {}
 
 
-def update_info_with_search(symbols=None, api="vantage", verbose=VERBOSE):
+def update_info_with_search(symbols=None, api=None, verbose=VERBOSE):
     if symbols is None:
         # Update existing folders (except currencies)
         stock_folders = [x for x in DATA_FOLDER.iterdir() if x.is_dir() and "_" not in x.name]
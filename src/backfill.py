@@ -0,0 +1,118 @@
+"""
+#########################   Backfill   #########################
+Gap detection and fetch planning of the stored series
+
+Every stored series is compared with the trading calendar of its exchange
+(see src.trading_calendar): the runs of missing sessions are gaps (holes inside
+the stored range and the tail after the last stored date). The plan is the
+cheapest query covering them:
+    none:       nothing missing (or only a tail younger than max_gap days)
+    compact:    everything missing is within the last COMPACT_SIZE sessions
+    full:       new series, or holes/tail older than the compact window
+Gaps still missing after a full download are confirmed (the provider has no
+data for them, e.g. one-off closures or a delisted symbol) and ignored by the
+next plans. A confirmed gap filled later on is dropped.
+################################################################
+"""
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from src.alpha_vantage_api import COMPACT_SIZE
+from src.resample import period_keys
+from src.trading_calendar import calendar_name, sessions
+
+
+Gap = namedtuple("Gap", ["start", "end", "sessions", "confirmed"], defaults=[False])
+FetchPlan = namedtuple("FetchPlan", ["fetch", "start", "missing", "gaps", "calendar"])
+FetchPlan.__doc__ = """
+fetch:    "none", "compact" or "full"
+start:    first date rewritten by a compact update (the stored rows from it on are replaced)
+missing:  sessions to fetch (the ones not confirmed)
+gaps:     every gap of the series (confirmed ones included)
+calendar: trading calendar of the series
+"""
+
+
+def series_period(category):
+    """None (daily series), weekly or monthly"""
+    category = category.lower()
+    if "weekly" in category or "keekly" in category:
+        return "weekly"
+    elif "monthly" in category:
+        return "monthly"
+    return None
+
+
+def date_keys(dates, period=None):
+    """Integer id of the day (or week/month) of every date"""
+    if period is None:
+        return dates.values.astype("datetime64[D]").astype("int64")
+    return period_keys(dates, period)
+
+
+def expected_dates(calendar, start, end, period=None):
+    """Trading sessions between start and end; for weekly/monthly series, the last session of every period"""
+    days = sessions(calendar, start, end)
+    if period is None or not len(days):
+        return days
+    keys = period_keys(days, period)
+    return days[np.r_[keys[1:] != keys[:-1], True]]
+
+
+def covered(dates, confirmed):
+    """Mask of the dates inside any of the confirmed gaps"""
+    mask = np.zeros(len(dates), dtype=bool)
+    for gap in confirmed:
+        mask |= (dates >= gap.start) & (dates <= gap.end)
+    return mask
+
+
+def find_gaps(dates, calendar, period=None, as_of=None, confirmed=()):
+    """
+    Runs of sessions missing in the stored dates, up to as_of (today by default), as a list of Gap.
+    A run is split where it enters or leaves a confirmed gap, so a growing tail keeps its confirmed part
+    """
+    as_of = pd.Timestamp.now().normalize() if as_of is None else pd.Timestamp(as_of).normalize()
+    dates = pd.DatetimeIndex(dates)
+    expected = expected_dates(calendar, dates[0], max(as_of, dates[-1]), period)
+    missing = expected[~np.isin(date_keys(expected, period), date_keys(dates, period))]
+    if not len(missing):
+        return []
+    flags = covered(missing, confirmed)
+    positions = expected.get_indexer(missing)
+    breaks = np.flatnonzero((np.diff(positions) != 1) | (flags[1:] != flags[:-1])) + 1
+    bounds = np.r_[0, breaks, len(missing)]
+    return [Gap(missing[a], missing[b - 1], int(b - a), bool(flags[a])) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def plan_fetch(dates, category, info=None, max_gap=0, as_of=None, confirmed=(), compact_size=COMPACT_SIZE):
+    """
+    Cheapest fetch completing a series.
+    :param dates:     stored dates (None or empty if there is no data)
+    :param info:      info of the series (its region selects the calendar)
+    :param max_gap:   days the tail may be missing without fetching (holes are always fetched)
+    :param confirmed: gaps that the provider does not have (see Catalog.gaps)
+    :return: FetchPlan
+    """
+    calendar = calendar_name(category, info)
+    if dates is None or not len(dates):
+        return FetchPlan("full", None, None, [], calendar)
+    as_of = pd.Timestamp.now().normalize() if as_of is None else pd.Timestamp(as_of).normalize()
+    dates = pd.DatetimeIndex(dates)
+    period = series_period(category)
+    gaps = find_gaps(dates, calendar, period=period, as_of=as_of, confirmed=confirmed)
+    pending = [gap for gap in gaps if not gap.confirmed]
+    holes = [gap for gap in pending if gap.start < dates[-1]]
+    missing = sum(gap.sessions for gap in pending)
+    if not pending or (not holes and (as_of - dates[-1]).days <= max_gap):
+        return FetchPlan("none", None, missing, gaps, calendar)
+
+    # Rewrite from the first hole, or the second to last row (the last one may be an incomplete week or month)
+    start = dates[max(len(dates) - 2, 0)]
+    if holes:
+        start = min(start, holes[0].start)
+    window = expected_dates(calendar, start, as_of, period)
+    window = window[~covered(window, confirmed)]
+    # Weekly and monthly answers are never truncated
+    fetch = "compact" if period is not None or len(window) <= compact_size else "full"
+    return FetchPlan(fetch, start, missing, gaps, calendar)
@@ -0,0 +1,242 @@
+"""
+#########################   Backtest   #########################
+Signal strategies evaluated over a grid of parameters
+
+    backtest(["AMZN", "DGE.LON"], "sma_cross", {"fast": [10, 20], "slow": [50, 100, 200]}, base="GBP")
+
+The closes of the symbols are converted into the base currency (see
+src.currency) and forward filled. Every parameter set of the grid gives a
+signal per date and symbol (-1 short, 0 flat, 1 long; no short with
+long_only), computed at the close and held from the next bar. All the
+parameter sets of a chunk are stacked in a (sets, dates, symbols) array, so
+positions, costs (cost_bps of the traded value every time the signal
+changes) and returns are computed at once. The portfolio of every set is
+rebalanced equally between the symbols already listed.
+
+With workers > 0 the grid is split in chunks run in a process pool. The
+closes are written once to an .npy file under CACHE_FOLDER that the workers
+open memory-mapped (read-only): they share the same pages and only the
+parameters and the results are pickled.
+################################################################
+"""
+import os
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from src.config import CACHE_FOLDER, PROCESS_WORKERS, VERBOSE
+from src.currency import load_converted
+from src.indicators import sma, std
+from src.portfolio import forward_fill
+from src.utils import LOG
+
+
+BACKTEST_FOLDER = CACHE_FOLDER.joinpath("backtests")
+DFT_COST_BPS = 5.0
+PERIODS_PER_YEAR = {"daily": 252, "weekly": 52, "monthly": 12}
+STATS = ("total return", "cagr", "volatility", "sharpe", "max drawdown", "turnover", "exposure", "trades")
+_shared = {}                # Closes opened by a worker, by file
+
+
+def sma_cross(x, cache, fast, slow):
+    """Long when the fast moving average is above the slow one, short below"""
+    fast_sma, slow_sma = _sma(x, cache, fast), _sma(x, cache, slow)
+    return np.sign(fast_sma - slow_sma)
+
+
+def momentum(x, cache, lookback):
+    """Sign of the return over the last `lookback` bars"""
+    lookback = int(lookback)
+    signal = np.full(x.shape, np.nan)
+    signal[lookback:] = np.sign(x[lookback:] / x[:-lookback] - 1)
+    return signal
+
+
+def bollinger(x, cache, window, k=2.0):
+    """Mean reversion: long below the lower band, short above the upper one, flat inside"""
+    mid = _sma(x, cache, window)
+    key = ("std", int(window))
+    if key not in cache:
+        cache[key] = std(x, 0, {}, int(window))[0][0]
+    dev = cache[key]
+    return np.where(x < mid - k * dev, 1.0, np.where(x > mid + k * dev, -1.0, np.where(np.isnan(dev), np.nan, 0.0)))
+
+
+def _sma(x, cache, window):
+    """Moving average shared by the parameter sets of a chunk"""
+    key = ("sma", int(window))
+    if key not in cache:
+        cache[key] = sma(x, 0, {}, int(window))[0][0]
+    return cache[key]
+
+
+# Strategy -> (signal function, check of a parameter set)
+STRATEGIES = {"sma_cross": (sma_cross, lambda p: p["fast"] < p["slow"]),
+              "momentum": (momentum, lambda p: p["lookback"] > 0),
+              "bollinger": (bollinger, lambda p: p["window"] > 1 and p.get("k", 2.0) > 0)}
+
+
+def expand_grid(strategy, grid):
+    """Parameter sets of a grid {name: [values]} (its cartesian product), without the invalid ones"""
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Strategy {strategy} not supported. Please select one among {list(STRATEGIES)}")
+    names = list(grid)
+    values = [grid[name] if isinstance(grid[name], (list, tuple, range, np.ndarray)) else [grid[name]]
+              for name in names]
+    check = STRATEGIES[strategy][1]
+    return [params for params in (dict(zip(names, combination)) for combination in itertools.product(*values))
+            if check(params)]
+
+
+def label(strategy, params):
+    """'sma_cross(fast=10, slow=50)'"""
+    return f"{strategy}({', '.join(f'{name}={value}' for name, value in params.items())})"
+
+
+def run_grid(close, strategy, param_sets, cost_bps=DFT_COST_BPS, long_only=False, first=0):
+    """
+    Portfolio returns of every parameter set over a (dates x symbols) matrix of forward filled closes.
+    :param first: first row evaluated (the rows before only warm up the signals)
+    :return: (returns (sets, dates), turnover (sets, dates), exposure (sets, dates), trades (sets,))
+    """
+    close = np.asarray(close, dtype="<f8")
+    func = STRATEGIES[strategy][0]
+    cache = {}
+    signals = np.stack([func(close, cache, **params) for params in param_sets])[:, first:]
+    signals = np.nan_to_num(signals, nan=0.0)
+    if long_only:
+        signals = np.clip(signals, 0, None)
+    close = close[first:]
+
+    listed = ~np.isnan(close)
+    counts = listed.sum(axis=1, keepdims=True)
+    weights = np.where(listed, 1.0, 0.0) / np.maximum(counts, 1)            # Equal weights of the listed symbols
+    with np.errstate(divide="ignore", invalid="ignore"):
+        asset_returns = np.nan_to_num(close[1:] / close[:-1] - 1, nan=0.0, posinf=0.0, neginf=0.0)
+    signals = np.where(listed, signals, 0.0)
+    positions = np.zeros_like(signals)
+    positions[:, 1:] = signals[:, :-1]                                      # Held from the next bar
+    traded = np.abs(np.diff(signals, axis=1, prepend=0.0))
+    gross = np.zeros_like(signals)
+    gross[:, 1:] = positions[:, 1:] * asset_returns
+    returns = ((gross - cost_bps / 1e4 * traded) * weights).sum(axis=-1)
+    turnover = (traded * weights).sum(axis=-1)
+    exposure = (np.abs(positions) * weights).sum(axis=-1)
+    return returns, turnover, exposure, (traded > 0).sum(axis=(1, 2))
+
+
+def _shared_close(source):
+    """Closes given inline or opened memory-mapped once per worker"""
+    if isinstance(source, np.ndarray):
+        return source
+    if source not in _shared:
+        _shared[source] = np.load(source, mmap_mode="r")
+    return _shared[source]
+
+
+def _run_chunk(source, strategy, param_sets, cost_bps, long_only, first):
+    return run_grid(_shared_close(source), strategy, param_sets, cost_bps=cost_bps, long_only=long_only,
+                    first=first)
+
+
+def summary_stats(returns, turnover, exposure, trades, periods_per_year):
+    """Summary of every parameter set (rows) from its portfolio returns"""
+    equity = np.cumprod(1 + returns, axis=1)
+    n_rows = returns.shape[1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = returns.mean(axis=1)
+        deviation = returns.std(axis=1, ddof=1) if n_rows > 1 else np.full(len(returns), np.nan)
+        final = equity[:, -1] if n_rows else np.ones(len(returns))
+        stats = {"total return": final - 1,
+                 "cagr": np.where(final > 0, final ** (periods_per_year / max(n_rows, 1)) - 1, -1.0),
+                 "volatility": deviation * np.sqrt(periods_per_year),
+                 "sharpe": np.where(deviation > 0, mean / deviation * np.sqrt(periods_per_year), np.nan),
+                 "max drawdown": (equity / np.maximum.accumulate(equity, axis=1) - 1).min(axis=1, initial=0.0),
+                 "turnover": turnover.mean(axis=1) * periods_per_year,
+                 "exposure": exposure.mean(axis=1),
+                 "trades": trades}
+    return equity, stats
+
+
+class BacktestResult:
+    """Equity curves (sets, dates) and summary of every parameter set of a grid"""
+
+    def __init__(self, dates, symbols, strategy, param_sets, equity, returns, stats):
+        self.dates = dates
+        self.symbols = symbols
+        self.strategy = strategy
+        self.param_sets = param_sets
+        self.labels = [label(strategy, params) for params in param_sets]
+        self.equity = equity
+        self.returns = returns
+        self.stats = pd.DataFrame(stats, index=self.labels, columns=list(STATS))
+
+    def __repr__(self):
+        return f"BacktestResult({self.strategy}, {len(self.param_sets)} parameter sets, {len(self.dates)} dates x " \
+               f"{len(self.symbols)} symbols)"
+
+    def frame(self):
+        """Equity curves (dates x parameter sets), starting from 1"""
+        return pd.DataFrame(self.equity.T, index=self.dates, columns=self.labels)
+
+    def best(self, metric="sharpe", n=5):
+        """Parameter sets with the highest metric (drawdowns are negative: the smallest first)"""
+        return self.stats.sort_values(metric, ascending=False, na_position="last").head(n)
+
+
+def backtest(symbols, strategy, grid, base="GBP", period="daily", start=None, end=None, cost_bps=DFT_COST_BPS,
+             long_only=False, workers=PROCESS_WORKERS, chunk_size=None, verbose=VERBOSE):
+    """
+    Backtest a strategy over every parameter set of a grid.
+    :param symbols:    shares and crypto pairs (from, to)
+    :param strategy:   sma_cross, momentum or bollinger (see STRATEGIES)
+    :param grid:       {parameter: [values]}, e.g. {"fast": [10, 20], "slow": [50, 100]}
+    :param base:       currency of the prices (and of the equity curves)
+    :param start, end: dates evaluated (the history before start warms up the signals)
+    :param cost_bps:   cost of every trade in basis points of the traded value
+    :param workers:    processes running the chunks of the grid (0: inline)
+    :param chunk_size: parameter sets per chunk (the grid spread over 2 chunks per worker by default)
+    :return: BacktestResult
+    """
+    param_sets = expand_grid(strategy, grid)
+    if not param_sets:
+        raise ValueError(f"No valid parameter set in the grid {grid} of {strategy}")
+    panel = load_converted(symbols, base=base, period=period, fields=["close"])
+    dates = panel.dates
+    in_range = np.ones(len(dates), dtype=bool)
+    if end is not None:
+        in_range &= dates <= pd.Timestamp(end)
+    close = forward_fill(np.array(panel["close"][in_range], dtype="<f8"))
+    dates = dates[in_range]
+    first = 0 if start is None else int(dates.searchsorted(pd.Timestamp(start)))
+    dates = dates[first:]
+
+    chunk_size = chunk_size or max(1, -(-len(param_sets) // max(2 * workers, 1)))
+    chunks = [param_sets[n:n + chunk_size] for n in range(0, len(param_sets), chunk_size)]
+    if workers <= 0 or len(chunks) == 1:
+        results = [run_grid(close, strategy, chunk, cost_bps, long_only, first) for chunk in chunks]
+    else:
+        BACKTEST_FOLDER.mkdir(parents=True, exist_ok=True)
+        shared_file = BACKTEST_FOLDER.joinpath(f"close.{os.getpid()}.{id(close)}.npy")
+        np.save(shared_file, close)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [pool.submit(_run_chunk, str(shared_file), strategy, chunk, cost_bps, long_only, first)
+                           for chunk in chunks]
+                results = [future.result() for future in futures]
+        finally:
+            shared_file.unlink(missing_ok=True)
+    if verbose > 1:
+        LOG.info(f"Backtested {len(param_sets)} parameter sets of {strategy} over {len(panel.symbols)} symbols in "
+                 f"{len(chunks)} chunks")
+
+    returns, turnover, exposure, trades = (np.concatenate(parts) for parts in zip(*results))
+    periods_per_year = PERIODS_PER_YEAR.get(period.split("-")[0], 252)
+    equity, stats = summary_stats(returns, turnover, exposure, trades, periods_per_year)
+    return BacktestResult(dates, panel.symbols, strategy, param_sets, equity, returns, stats)
+
+
+if __name__ == "__main__":
+    result = backtest(["AMZN", "GOOG", "MMM"], "sma_cross", {"fast": [10, 20, 50], "slow": [50, 100, 200]})
+    print(result, result.best())
@@ -0,0 +1,429 @@
+"""
+#########################   Benchmark   #########################
+Timing of the load, update and table-building hot paths
+
+Synthesizes Alpha Vantage-shaped payloads and a data folder of N symbols and
+times each stage (clean_enumeration, clean_pandas_data, the streaming parser,
+save_pandas_data, read_pandas_data, get_shares_table and update_stock). The
+network is replaced by a local stub server that answers with the rate-limit
+"Note" once its own quota is exceeded, so the throttling path is exercised as
+well.
+
+Every universe size runs in a fresh interpreter (with DATA_FOLDER pointing to
+a temporary folder), so the peak memory of one size does not leak into the
+next. Results are stored as JSON to compare them across commits:
+
+    python -m src.benchmark --symbols 40 500 5000
+    python -m src.benchmark --compare cache/benchmarks/<old>.json cache/benchmarks/<new>.json
+#################################################################
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import socket
+import pathlib
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from aiohttp import web
+from src.config import ROOT, CACHE_FOLDER, STORAGE_BACKEND
+from src.api_manager import (build_path_and_file, build_info_file, clean_enumeration, clean_pandas_data,
+                             save_pandas_data, read_pandas_data, update_stock_info, query_data, load_universe,
+                             semaphore_controller, catalog, frame_cache)
+from src.overall_commands import get_shares_table
+from src.scheduler import UpdateJob, run_jobs
+from src.ingest import STREAM_CHUNK_SIZE, parse_body
+from src.offload import metrics as offload_metrics, shutdown_pool
+from src.utils import LOG
+
+
+BENCHMARK_FOLDER = CACHE_FOLDER.joinpath("benchmarks")
+DFT_SIZES = (40, 500)
+DFT_ROWS = 2500
+COMPACT_ROWS = 100
+LAST_DATE = "2020-01-31"
+SYMBOL_PLACEHOLDER = "__SYMBOL__"
+VANTAGE_NOTE = ("Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute and "
+                "500 calls per day. Please visit https://www.alphavantage.co/premium/ if you would like to target "
+                "a higher API call frequency.")
+DAILY_COLUMNS = ["1. open", "2. high", "3. low", "4. close", "5. volume"]
+ADJUSTED_COLUMNS = ["1. open", "2. high", "3. low", "4. close", "5. adjusted close", "6. volume",
+                    "7. dividend amount", "8. split coefficient"]
+
+
+def symbol_names(n, prefix="SYM"):
+    return [f"{prefix}{i:05d}" for i in range(n)]
+
+
+def vantage_payload(symbol, rows=DFT_ROWS, adjusted=True, seed=0):
+    """Daily time series with the shape (enumerated keys, string values) of the Alpha Vantage answers"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end=LAST_DATE, periods=rows).strftime("%Y-%m-%d")
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, rows)))
+    open_ = close * (1 + rng.normal(0, 0.005, rows))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.005, rows)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.005, rows)))
+    volume = rng.integers(1e5, 1e7, rows)
+    if adjusted:
+        fields = [open_, high, low, close, close, volume, np.zeros(rows), np.ones(rows)]
+        columns, information = ADJUSTED_COLUMNS, "Daily Time Series with Splits and Dividend Events"
+    else:
+        fields = [open_, high, low, close, volume]
+        columns, information = DAILY_COLUMNS, "Daily Prices (open, high, low, close) and Volumes"
+    values = [[f"{v}" for v in field] if np.issubdtype(field.dtype, np.integer) else [f"{v:.4f}" for v in field]
+              for field in fields]
+    series = {date: dict(zip(columns, row)) for date, row in zip(dates[::-1], zip(*(col[::-1] for col in values)))}
+    return {"Meta Data": {"1. Information": information, "2. Symbol": symbol, "3. Last Refreshed": LAST_DATE,
+                          "4. Output Size": "Full size", "5. Time Zone": "US/Eastern"},
+            "Time Series (Daily)": series}
+
+
+def intraday_payload(symbol, interval="5min", rows=COMPACT_ROWS, end=None):
+    """Intraday bars up to `end` (default: now). Values only depend on the timestamp, so polls overlap exactly"""
+    dates = pd.date_range(end=pd.Timestamp(end or datetime.now()).floor(interval), periods=rows, freq=interval)
+    seconds = dates.values.astype("datetime64[s]").astype(np.int64)
+    close = 100 + 10 * np.sin(seconds / 3600)
+    fields = [close - 0.1, close + 0.2, close - 0.2, close]
+    values = [[f"{v:.4f}" for v in field] for field in fields] + [[f"{v}" for v in (seconds // 60) % 1000 * 100]]
+    series = {date: dict(zip(DAILY_COLUMNS, row))
+              for date, row in zip(dates.strftime("%Y-%m-%d %H:%M:%S")[::-1], zip(*(col[::-1] for col in values)))}
+    return {"Meta Data": {"1. Information": "Intraday Prices and Volumes", "2. Symbol": symbol,
+                          "3. Last Refreshed": dates[-1].strftime("%Y-%m-%d %H:%M:%S"), "4. Interval": interval,
+                          "5. Output Size": "Compact", "6. Time Zone": "US/Eastern"},
+            f"Time Series ({interval})": series}
+
+
+class PayloadFactory:
+    """A few serialized payloads reused for every symbol (generating one per symbol would dominate the timings)"""
+
+    def __init__(self, rows=DFT_ROWS, variants=8):
+        self.rows = rows
+        self.templates = {}
+        for adjusted in (True, False):
+            for seed in range(variants):
+                payload = vantage_payload(SYMBOL_PLACEHOLDER, rows=rows, adjusted=adjusted, seed=seed)
+                compact = {**payload, "Time Series (Daily)": dict(list(payload["Time Series (Daily)"].items())
+                                                                  [:COMPACT_ROWS])}
+                self.templates[adjusted, seed, "full"] = json.dumps(payload)
+                self.templates[adjusted, seed, "compact"] = json.dumps(compact)
+        self.variants = variants
+
+    def body(self, symbol, adjusted=True, output_size="full"):
+        seed = zlib.crc32(symbol.encode()) % self.variants
+        return self.templates[adjusted, seed, output_size].replace(SYMBOL_PLACEHOLDER, symbol)
+
+    def payload(self, symbol, adjusted=True, output_size="full"):
+        return json.loads(self.body(symbol, adjusted=adjusted, output_size=output_size))
+
+
+class StubVantageServer:
+    """
+    Local HTTP server answering /query like Alpha Vantage (TIME_SERIES_DAILY[_ADJUSTED] and TIME_SERIES_INTRADAY).
+    Over `calls` requests within `period` seconds it answers with the rate-limit Note instead of data.
+    """
+
+    def __init__(self, factory, calls=100, period=1.0, host="127.0.0.1", port=0):
+        self.factory = factory
+        self.calls = calls
+        self.period = period
+        self.host = host
+        self.port = port
+        self.served = 0
+        self.notes = 0
+        self._recent = deque()
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/query"
+
+    async def handle(self, request):
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= self.period:
+            self._recent.popleft()
+        if len(self._recent) >= self.calls:
+            self.notes += 1
+            return web.json_response({"Note": VANTAGE_NOTE})
+        self._recent.append(now)
+
+        function = request.query.get("function", "")
+        if function == "TIME_SERIES_INTRADAY":
+            self.served += 1
+            return web.json_response(intraday_payload(request.query.get("symbol", ""),
+                                                      interval=request.query.get("interval", "5min")))
+        if function not in ("TIME_SERIES_DAILY", "TIME_SERIES_DAILY_ADJUSTED"):
+            return web.json_response({"Error Message": f"Invalid API call. Function {function} not supported"})
+        self.served += 1
+        body = self.factory.body(request.query.get("symbol", ""), adjusted=function.endswith("_ADJUSTED"),
+                                 output_size=request.query.get("outputsize", "full"))
+        return web.Response(text=body, content_type="application/json")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/query", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class Stage:
+    """
+    Accumulated time of a benchmark stage, process max RSS at its end and, when traced, the peak of the
+    memory allocated inside it (tracing slows down the stages: timings are only comparable between runs
+    with the same setting)
+    """
+
+    def __init__(self, name, trace=False):
+        self.name = name
+        self.trace = trace
+        self.seconds = 0.0
+        self.items = 0
+        self.peak = 0
+        self.max_rss = 0
+
+    @contextmanager
+    def timer(self, items=1):
+        if self.trace:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.items += items
+            self.max_rss = max_rss_mb()
+            if self.trace:
+                self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - baseline)
+
+    def result(self):
+        return {"seconds": round(self.seconds, 6), "items": self.items,
+                "throughput": round(self.items / self.seconds, 3) if self.seconds else None,
+                "max_rss_mb": round(self.max_rss, 3),
+                "peak_mb": round(self.peak / 1024 ** 2, 3) if self.trace else None}
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024
+
+
+def run_stages(n_symbols, rows=DFT_ROWS, stub_calls=100, stub_period=1.0, client_calls=None, port=0, trace=False):
+    """
+    Time every stage on a universe of n_symbols. Must run with DATA_FOLDER pointing to an empty folder and
+    ALPHA_VANTAGE_URI to the stub server (started here on the given port). The client quota is client_calls
+    per stub_period (by default 20% over the stub one, so the stub answers with Notes under load).
+    """
+    if trace:
+        tracemalloc.start()
+    factory = PayloadFactory(rows=rows)
+    symbols = symbol_names(n_symbols)
+    stages = {name: Stage(name, trace=trace) for name in (
+        "clean_enumeration", "clean_pandas_data", "parse_json_stream", "save_pandas_data", "save_pandas_data_tail",
+        "read_pandas_data", "read_pandas_data_column", "load_universe", "load_universe_warm", "catalog_rebuild",
+        "get_shares_table", "query_data_stub", "update_stock_stub")}
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    for symbol in symbols:
+        payload = factory.payload(symbol)
+        meta, dat = payload["Meta Data"], payload["Time Series (Daily)"]
+        with stages["clean_enumeration"].timer():
+            info = clean_enumeration(meta)
+            clean_enumeration(list(next(iter(dat.values()))))
+        with stages["clean_pandas_data"].timer(items=rows):
+            clean_pandas_data(dat)
+        body = factory.body(symbol).encode()
+        with stages["parse_json_stream"].timer(items=rows):
+            parse_body(body[n:n + STREAM_CHUNK_SIZE] for n in range(0, len(body), STREAM_CHUNK_SIZE))
+
+        folder_name, file_name = build_path_and_file(symbol, "daily-adjusted")
+        with stages["save_pandas_data"].timer(items=rows):
+            save_pandas_data(file_name, dat, verbose=0)
+        loop.run_until_complete(update_stock_info(build_info_file(folder_name, "daily-adjusted"), info, verbose=0))
+
+        compact = factory.payload(symbol, output_size="compact")["Time Series (Daily)"]
+        old_data = read_pandas_data(file_name, columns=[])
+        with stages["save_pandas_data_tail"].timer(items=COMPACT_ROWS):
+            save_pandas_data(file_name, compact, old_data=old_data, verbose=0)
+
+    for symbol in symbols:
+        _, file_name = build_path_and_file(symbol, "daily-adjusted")
+        with stages["read_pandas_data"].timer(items=rows):
+            read_pandas_data(file_name)
+        with stages["read_pandas_data_column"].timer(items=rows):
+            read_pandas_data(file_name, columns=["adjusted close"])
+    frame_cache.clear()
+    with stages["load_universe"].timer(items=n_symbols * rows):
+        load_universe(symbols, period="daily-adjusted")
+    with stages["load_universe_warm"].timer(items=n_symbols * rows):
+        load_universe(symbols, period="daily-adjusted")
+
+    with stages["catalog_rebuild"].timer(items=n_symbols):
+        catalog.rebuild()
+    for _ in range(3):
+        with stages["get_shares_table"].timer(items=n_symbols):
+            get_shares_table()
+
+    server = loop.run_until_complete(StubVantageServer(factory, calls=stub_calls, period=stub_period,
+                                                       port=port).start())
+    client_calls = int(stub_calls * 1.2) if client_calls is None else client_calls
+    semaphore_controller.set_rate_limits("vantage", [(client_calls, stub_period)])
+    jobs = [UpdateJob(symbol, "daily", None) for symbol in symbols]
+    try:
+        # Requests only (compact answers), enough of them to go over the stub quota
+        queries = [symbols[n % n_symbols] for n in range(2 * stub_calls)]
+        with stages["query_data_stub"].timer(items=len(queries)):
+            loop.run_until_complete(asyncio.gather(*(query_data(symbol, category="daily-adjusted", verbose=0,
+                                                                outputsize="compact") for symbol in queries)))
+        # First download of every symbol ("daily"): request, parse, save and info
+        offload_metrics.reset()
+        with stages["update_stock_stub"].timer(items=n_symbols):
+            loop.run_until_complete(run_jobs(jobs, verbose=0))
+    finally:
+        loop.run_until_complete(server.stop())
+        loop.run_until_complete(semaphore_controller.close_sessions())
+        loop.close()
+        shutdown_pool()
+    if trace:
+        tracemalloc.stop()
+
+    downloaded = sum(build_path_and_file(symbol, "daily")[1].exists() for symbol in symbols)
+    return {"symbols": n_symbols, "rows": rows, "traced": trace,
+            "stages": {name: stage.result() for name, stage in stages.items()},
+            "stub": {"served": server.served, "notes": server.notes, "downloaded": downloaded,
+                     "calls": stub_calls, "period": stub_period, "client_calls": client_calls},
+            "loop": offload_metrics.stats(),
+            "max_rss_mb": round(max_rss_mb(), 3)}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmark(sizes=DFT_SIZES, rows=DFT_ROWS, stub_calls=100, stub_period=1.0, trace=False, output=None):
+    """Run every size in its own interpreter and store the results. Returns (results, result file)"""
+    results = {"commit": git_commit(), "date": datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+               "backend": STORAGE_BACKEND, "runs": []}
+    for n_symbols in sizes:
+        with tempfile.TemporaryDirectory(prefix="pythia_bench_") as tmp:
+            result_file = os.path.join(tmp, "result.json")
+            port = _free_port()
+            env = {**os.environ, "DATA_FOLDER": os.path.join(tmp, "data"), "RESPONSE_CACHE": "0", "VERBOSE": "0",
+                   "ALPHA_VANTAGE_URI": f"http://127.0.0.1:{port}/query"}
+            cmd = [sys.executable, "-m", "src.benchmark", "--child", result_file, "--symbols", str(n_symbols),
+                   "--rows", str(rows), "--port", str(port), "--stub-calls", str(stub_calls),
+                   "--stub-period", str(stub_period)] + (["--trace"] if trace else [])
+            LOG.info(f"Benchmark: {n_symbols} symbols x {rows} rows")
+            subprocess.run(cmd, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+            with open(result_file) as f:
+                run = json.load(f)
+        results["runs"].append(run)
+        LOG.info(format_run(run))
+
+    output = BENCHMARK_FOLDER if output is None else output
+    output.mkdir(parents=True, exist_ok=True)
+    result_file = output.joinpath(f"{datetime.now():%Y%m%d-%H%M%S}_{results['commit']}.json")
+    result_file.write_text(json.dumps(results, indent=2))
+    LOG.info(f"Benchmark results saved in {result_file}")
+    return results, result_file
+
+
+def format_run(run):
+    lines = [f"{run['symbols']} symbols x {run['rows']} rows (max rss {run['max_rss_mb']:.1f} MB, "
+             f"stub notes: {run['stub']['notes']})"]
+    for name, stage in run["stages"].items():
+        peak = f"\trss {stage['max_rss_mb']:.1f} MB" + ("" if stage["peak_mb"] is None else
+                                                       f"\tpeak {stage['peak_mb']:.2f} MB")
+        lines.append(f"  {name:<26}{stage['seconds']:>10.3f} s\t{stage['throughput'] or 0:>14.1f} items/s{peak}")
+    for name, step in run.get("loop", {}).items():
+        lines.append(f"  update_stock_stub[{name}]".ljust(28) + f"on loop {step['on_loop']:.3f} s\t"
+                     f"off loop {step['off_loop']:.3f} s\twait {step['wait']:.3f} s\t({step['calls']} calls)")
+    return "\n".join(lines)
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Throughput change of every (symbols, stage) present in both result files.
+    :return: DataFrame with the baseline/current throughput, the relative change and a regression flag
+    """
+    def table(results):
+        return {(run["symbols"], name): stage["throughput"] for run in results["runs"]
+                for name, stage in run["stages"].items() if stage["throughput"]}
+
+    old, new = table(baseline), table(current)
+    keys = [key for key in new if key in old]
+    data = pd.DataFrame({"symbols": [k[0] for k in keys], "stage": [k[1] for k in keys],
+                         "baseline": [old[k] for k in keys], "current": [new[k] for k in keys]})
+    data["change"] = data["current"] / data["baseline"] - 1
+    data["regression"] = data["change"] < -threshold
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the load, update and table-building paths")
+    parser.add_argument("--symbols", type=int, nargs="+", default=list(DFT_SIZES), help="universe sizes")
+    parser.add_argument("--rows", type=int, default=DFT_ROWS, help="daily rows per symbol")
+    parser.add_argument("--stub-calls", type=int, default=100, help="calls allowed by the stub server per period")
+    parser.add_argument("--stub-period", type=float, default=1.0, help="seconds of the stub rate-limit window")
+    parser.add_argument("--trace", action="store_true", help="trace the peak memory of every stage (slower)")
+    parser.add_argument("--output", type=str, default=None, help="folder of the result files")
+    parser.add_argument("--compare", type=str, nargs="+", default=None, help="baseline [current] result files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="throughput drop reported as regression")
+    parser.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run = run_stages(args.symbols[0], rows=args.rows, stub_calls=args.stub_calls, stub_period=args.stub_period,
+                         port=args.port, trace=args.trace)
+        with open(args.child, "w") as f:
+            json.dump(run, f)
+    elif args.compare:
+        files = args.compare[:2] if len(args.compare) > 1 else [args.compare[0], max(BENCHMARK_FOLDER.glob("*.json"))]
+        baseline, current = (json.loads(pathlib.Path(file_name).read_text()) for file_name in files)
+        comparison = compare_results(baseline, current, threshold=args.threshold)
+        print(comparison.to_string(index=False))
+        return 1 if comparison["regression"].any() else 0
+    else:
+        output = None if args.output is None else ROOT.joinpath(args.output)
+        run_benchmark(args.symbols, rows=args.rows, stub_calls=args.stub_calls, stub_period=args.stub_period,
+                      trace=args.trace, output=output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
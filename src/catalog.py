@@ -0,0 +1,215 @@
+"""
+#########################   Catalog   #########################
+SQLite index of every stored series (one row per folder and period)
+
+Keeps the info fields, first/last dates, number of rows, column names and a
+checksum of the data file, so tables of shares/currencies are a single query instead of a
+glob + json read per file. Every write path updates it in a transaction; it
+can be rebuilt from the data folder at any time with rebuild().
+The gaps table keeps the missing sessions of every series (see src.backfill).
+###############################################################
+"""
+import re
+import json
+import zlib
+import sqlite3
+from datetime import datetime
+from src.config import (DATA_FOLDER, CATALOG_FILE, DFT_INFO_FILE, DFT_STOCK_FILE, DFT_FX_FILE, DFT_CRIPTO_PREFIX,
+                        DFT_COLUMNAR_EXT, DFT_ACTIONS_FILE)
+from src.storage import BACKENDS, backend_for, ColumnarBackend
+from src.utils import LOG, ts2datetime
+
+
+currency_folder_regex = re.compile(r"\A[A-Z]{3}_[A-Z]{3}\Z")
+crypto_folder_regex = re.compile(r"\A" + DFT_CRIPTO_PREFIX + r"[A-Z]{3,4}_[A-Z]{3}\Z")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    folder      TEXT NOT NULL,
+    period      TEXT NOT NULL,
+    kind        TEXT NOT NULL,
+    info        TEXT,
+    data_file   TEXT,
+    first_ts    TEXT,
+    last_ts     TEXT,
+    rows        INTEGER,
+    checksum    TEXT,
+    updated     TEXT,
+    columns     TEXT,
+    PRIMARY KEY (folder, period)
+);
+CREATE INDEX IF NOT EXISTS series_kind ON series (kind, folder, period);
+CREATE TABLE IF NOT EXISTS gaps (
+    folder      TEXT NOT NULL,
+    period      TEXT NOT NULL,
+    first_ts    TEXT NOT NULL,
+    last_ts     TEXT NOT NULL,
+    sessions    INTEGER,
+    status      TEXT NOT NULL,
+    detected    TEXT,
+    PRIMARY KEY (folder, period, first_ts)
+);
+"""
+MIGRATIONS = {"columns": "ALTER TABLE series ADD COLUMN columns TEXT"}      # Columns added to older catalogs
+
+
+def folder_kind(name):
+    """stock, fx or crypto"""
+    if crypto_folder_regex.match(name):
+        return "crypto"
+    elif currency_folder_regex.match(name):
+        return "fx"
+    return "stock"
+
+
+def info_period(info_file):
+    """info_data_daily-adjusted.json -> daily-adjusted"""
+    return info_file.stem[len(DFT_INFO_FILE) + 1:]
+
+
+def data_period(file_name):
+    """stock_data_daily.col -> daily, data_fx_daily.zip -> fx_daily"""
+    for prefix in (DFT_STOCK_FILE + "_", DFT_FX_FILE + "_"):
+        if file_name.stem.startswith(prefix):
+            return file_name.stem[len(prefix):]
+    return file_name.stem
+
+
+def file_checksum(file_name):
+    """Columnar files: combination of the segment crc32 (no need to read the data). Others: crc32 of the file"""
+    storage = backend_for(file_name)
+    if isinstance(storage, ColumnarBackend):
+        crcs = [segment["crc"] for segment in storage.segments(file_name)]
+        return f"{zlib.crc32(json.dumps(crcs).encode()):08x}"
+    crc = 0
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(chunk, crc)
+    return f"{crc:08x}"
+
+
+def data_summary(file_name):
+    """First/last dates, rows, column names (JSON list) and checksum of a data file (reads the dates only)"""
+    storage = backend_for(file_name)
+    index = storage.read(file_name, columns=[]).index
+    return {"data_file": file_name.name,
+            "first_ts": ts2datetime(index[0]) if len(index) else None,
+            "last_ts": ts2datetime(index[-1]) if len(index) else None,
+            "rows": len(index),
+            "columns": json.dumps(list(storage.columns(file_name))),
+            "checksum": file_checksum(file_name)}
+
+
+class Catalog:
+    def __init__(self, db_file=CATALOG_FILE, data_folder=DATA_FOLDER):
+        self.db_file = db_file
+        self.data_folder = data_folder
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_file.as_posix())
+            self._conn.row_factory = sqlite3.Row
+            with self._conn:
+                self._conn.executescript(SCHEMA)
+                existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(series)")}
+                for column, statement in MIGRATIONS.items():
+                    if column not in existing:
+                        self._conn.execute(statement)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _upsert(self, folder, period, **fields):
+        fields["updated"] = ts2datetime(datetime.now())
+        names = ", ".join(fields)
+        values = ", ".join(f":{name}" for name in fields)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in fields)
+        with self.conn:
+            self.conn.execute(f"INSERT INTO series (folder, period, kind, {names}) "
+                              f"VALUES (:folder, :period, :kind, {values}) "
+                              f"ON CONFLICT (folder, period) DO UPDATE SET {updates}",
+                              {"folder": folder, "period": period, "kind": folder_kind(folder), **fields})
+
+    def record_info(self, info_file, info):
+        """Store the info of a series (called after every info file write)"""
+        self._upsert(info_file.parent.name, info_period(info_file), info=json.dumps(info))
+
+    def record_data(self, file_name, summary=None):
+        """Store dates/rows/columns/checksum of a series (called after every data file write). See data_summary"""
+        summary = data_summary(file_name) if summary is None else summary
+        self._upsert(file_name.parent.name, data_period(file_name), **summary)
+
+    def record_gaps(self, folder, period, gaps):
+        """Replace the gaps of a series (list of Gap, see src.backfill)"""
+        detected = ts2datetime(datetime.now())
+        with self.conn:
+            self.conn.execute("DELETE FROM gaps WHERE folder = ? AND period = ?", (folder, period))
+            self.conn.executemany("INSERT INTO gaps VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(folder, period, ts2datetime(gap.start), ts2datetime(gap.end), gap.sessions,
+                                    "confirmed" if gap.confirmed else "open", detected) for gap in gaps])
+
+    def gaps(self, folder=None, period=None, status=None):
+        """Holes of the series as dicts, sorted by folder, period and date"""
+        query, params = "SELECT * FROM gaps WHERE 1", []
+        for name, value in (("folder", folder), ("period", period), ("status", status)):
+            if value is not None:
+                query += f" AND {name} = ?"
+                params.append(value)
+        rows = self.conn.execute(query + " ORDER BY folder, period, first_ts", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def is_empty(self):
+        return self.conn.execute("SELECT COUNT(*) FROM series").fetchone()[0] == 0
+
+    def series(self, kind=None, folder=None):
+        """Rows of the catalog as dicts (info decoded), sorted by folder and period"""
+        query, params = "SELECT * FROM series WHERE info IS NOT NULL", []
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        if folder is not None:
+            query += " AND folder = ?"
+            params.append(folder)
+        rows = self.conn.execute(query + " ORDER BY folder, period", params).fetchall()
+        return [{**dict(row), "info": json.loads(row["info"])} for row in rows]
+
+    def summary(self, folder, period):
+        """
+        Dates, rows, column names (None if not recorded, e.g. indexed before the columns were) and checksum of one
+        series. None if it is not indexed
+        """
+        row = self.conn.execute("SELECT data_file, first_ts, last_ts, rows, columns, checksum FROM series "
+                                "WHERE folder = ? AND period = ?", (folder, period)).fetchone()
+        if row is None:
+            return None
+        return {**dict(row), "columns": None if row["columns"] is None else json.loads(row["columns"])}
+
+    def rebuild(self, verbose=0):
+        """Scan the data folder and (re)index every info and data file"""
+        with self.conn:
+            self.conn.execute("DELETE FROM series")
+        count = 0
+        for folder in sorted(x for x in self.data_folder.iterdir() if x.is_dir() and not x.name.startswith(".")):
+            for file_name in sorted(folder.iterdir()):
+                try:
+                    if file_name.name.startswith(DFT_INFO_FILE + "_") and file_name.suffix == ".json":
+                        self.record_info(file_name, json.loads(file_name.read_text()))
+                    elif file_name.stem == DFT_ACTIONS_FILE:
+                        continue            # Corporate actions (see src.adjust)
+                    elif any(file_name.suffix == b.extension for b in BACKENDS.values()) and " " not in file_name.name:
+                        if file_name.suffix != DFT_COLUMNAR_EXT and file_name.with_suffix(DFT_COLUMNAR_EXT).exists():
+                            continue            # Already migrated
+                        self.record_data(file_name)
+                    else:
+                        continue
+                    count += 1
+                except Exception as err:
+                    LOG.error(f"ERROR indexing {file_name}: {err.__repr__()}")
+        if verbose > 0:
+            LOG.info(f"Catalog rebuilt: {count} files indexed")
+        return count
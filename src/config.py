@@ -1,6 +1,6 @@
 import yaml
 import logging
-from os import getenv
+from os import getenv, cpu_count
 import pathlib
 from datetime import datetime
 
@@ -12,23 +12,55 @@ DFT_STOCK_FILE = "stock_data"
 DFT_STOCK_EXT = ".zip"
 DFT_FX_FILE = "data"
 DFT_FX_EXT = ".zip"
+DFT_COLUMNAR_EXT = ".col"
+DFT_ACTIONS_FILE = "corporate_actions"
 DFT_CRIPTO_PREFIX = "CRYPTO_"
 INFO_VATIATIONS = ["daily", "daily-adjusted", "weekly", "weekly-adjusted", "monthly", "monthly-adjusted"]
 DFT_HEADER = ("Content-type", 'text/plain; charset=utf-8')
 DFT_UTC_TS = datetime.utcfromtimestamp(datetime.min.toordinal())
 
 ROOT = pathlib.Path(__file__).parents[1]
-DATA_FOLDER = ROOT.joinpath("data")
+DATA_FOLDER = pathlib.Path(getenv("DATA_FOLDER", ROOT.joinpath("data")))
 LOG_FOLDER = ROOT.joinpath("logs")
+CACHE_FOLDER = ROOT.joinpath("cache")
+CATALOG_FILE = DATA_FOLDER.joinpath("catalog.db")
+SYMBOL_INDEX_FILE = DATA_FOLDER.joinpath("symbol_index.json")
 
 ENV = getenv("ENV", "local")
 MAX_CONNECTIONS = int(getenv("MAX_CONNECTIONS", "5"))
 QUERY_RETRY_LIMIT = int(getenv("QUERY_RETRY_LIMIT", 3))
-MIN_SEM_WAIT = int(getenv("MIN_WAIT", "10"))
+KEEPALIVE_TIMEOUT = int(getenv("KEEPALIVE_TIMEOUT", "30"))
 
-VANTAGE_WAIT = int(getenv("VANTAGE_WAIT", "60"))
 VANTAGE_SEMAPHORE_LIMIT = int(getenv("VANTAGE_SEMAPHORE_LIMIT", "5"))
+VANTAGE_CALLS_PER_MINUTE = int(getenv("VANTAGE_CALLS_PER_MINUTE", "5"))
+VANTAGE_CALLS_PER_DAY = int(getenv("VANTAGE_CALLS_PER_DAY", "500"))
+VANTAGE_DATATYPE = getenv("VANTAGE_DATATYPE", "json")            # Time series answers. Valid: json, csv
+MYALLIES_SEMAPHORE_LIMIT = int(getenv("MYALLIES_SEMAPHORE_LIMIT", "2"))
+MYALLIES_CALLS_PER_MINUTE = int(getenv("MYALLIES_CALLS_PER_MINUTE", "30"))
+MYALLIES_CALLS_PER_DAY = int(getenv("MYALLIES_CALLS_PER_DAY", "1000"))
 VERBOSE = int(getenv("VERBOSE", "2"))
+STORAGE_BACKEND = getenv("STORAGE_BACKEND", "columnar")          # Valid: columnar, zip
+COMPACT_SEGMENTS = int(getenv("COMPACT_SEGMENTS", "32"))          # Appended segments before a full rewrite
+INTRADAY_BUFFER_SIZE = int(getenv("INTRADAY_BUFFER_SIZE", "2000"))    # Intraday bars kept in memory per series
+PROCESS_WORKERS = int(getenv("PROCESS_WORKERS", str(min(4, (cpu_count() or 1) - 1))))   # Parse/save processes (0: inline)
+
+RESPONSE_CACHE = int(getenv("RESPONSE_CACHE", "1"))                         # 0 disables the cache
+RESPONSE_CACHE_MAX_BYTES = int(getenv("RESPONSE_CACHE_MAX_BYTES", str(512 * 1024 ** 2)))
+FRAME_CACHE_MAX_BYTES = int(getenv("FRAME_CACHE_MAX_BYTES", str(256 * 1024 ** 2)))       # Data read in memory
+CACHE_TTL_INTRADAY = int(getenv("CACHE_TTL_INTRADAY", "60"))                 # Seconds
+CACHE_TTL_DAILY = int(getenv("CACHE_TTL_DAILY", str(4 * 60 * 60)))
+CACHE_TTL_WEEKLY = int(getenv("CACHE_TTL_WEEKLY", str(24 * 60 * 60)))
+CACHE_TTL_MONTHLY = int(getenv("CACHE_TTL_MONTHLY", str(24 * 60 * 60)))
+CACHE_TTL_SEARCH = int(getenv("CACHE_TTL_SEARCH", str(30 * 24 * 60 * 60)))
+METRICS_FILE = getenv("METRICS_FILE", "")            # Export after every update run (.prom: Prometheus text, else json)
+TRACE_HISTORY = int(getenv("TRACE_HISTORY", "200"))  # Traces of the last update_stock calls kept in memory
+DAEMON_QUEUE_FILE = DATA_FOLDER.joinpath("update_queue.db")          # Persistent job queue of the update daemon
+DAEMON_HOST = getenv("DAEMON_HOST", "127.0.0.1")                     # Status endpoint
+DAEMON_PORT = int(getenv("DAEMON_PORT", "8765"))
+DAEMON_REFRESH_DELAY = int(getenv("DAEMON_REFRESH_DELAY", str(30 * 60)))   # Seconds after the close of the exchange
+DAEMON_RETRY_DELAY = int(getenv("DAEMON_RETRY_DELAY", str(15 * 60)))       # Doubled after every retry
+DAEMON_MAX_RETRIES = int(getenv("DAEMON_MAX_RETRIES", "3"))                # Then wait for the next close
+DAEMON_RESEED = int(getenv("DAEMON_RESEED", str(60 * 60)))                 # Seconds between catalog scans
 
 if ENV == "local":
     LOG_LEVEL = logging.DEBUG
@@ -64,7 +96,7 @@ crypto_parameters = {
     "Information": "Information"}
 
 __FILE_KEYS = ROOT.joinpath("keys.yml")
-__FILE_CURRENCIES = DATA_FOLDER.joinpath("currencies.yml")
+__FILE_CURRENCIES = ROOT.joinpath("data", "currencies.yml")
 
 
 def load_yml(ref):
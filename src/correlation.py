@@ -0,0 +1,194 @@
+"""
+#########################   Correlation   #########################
+Rolling covariance and correlation matrices over a (dates x symbols) panel
+
+Every pair of symbols keeps the sufficient statistics of the window (count,
+sums, sums of squares and of products over the rows where both are valid).
+Each new row is added and the row leaving the window removed, so a step costs
+O(symbols^2) whatever the window, instead of O(window x symbols^2) for
+pandas' rolling().cov()/corr(). NaN values are masked pair by pair, as
+pandas does. The values are centered on the mean of every symbol and the
+statistics recomputed from the window every `resync` rows to bound the
+rounding errors of the add/remove updates.
+
+The result is a 3-D array (dates, symbols, symbols), or (dates, pairs) with
+upper=True: only the upper triangle (diagonal included) is computed and
+stored, in the order of np.triu_indices.
+###################################################################
+"""
+import numpy as np
+import pandas as pd
+from src.config import VERBOSE
+from src.indicators import returns
+from src.panel import load_panel
+
+
+KINDS = ("cov", "corr")
+DFT_RESYNC = 50             # Windows between two exact recomputations of the statistics
+
+
+def pair_indices(n_symbols):
+    """Rows and columns of the upper triangle (diagonal included)"""
+    return np.triu_indices(n_symbols)
+
+
+def unpack(packed, n_symbols):
+    """Full symmetric matrices (..., symbols, symbols) from upper triangles (..., pairs)"""
+    rows, cols = pair_indices(n_symbols)
+    full = np.empty((*packed.shape[:-1], n_symbols, n_symbols), dtype=packed.dtype)
+    full[..., rows, cols] = packed
+    full[..., cols, rows] = packed
+    return full
+
+
+class RollingMoments:
+    """
+    Sufficient statistics of every pair of symbols over the last `window` rows. Rows are pushed one by one, so the
+    matrices can be extended when new dates are appended to the panel
+    """
+
+    def __init__(self, n_symbols, window, min_periods=None, ref=None, resync=DFT_RESYNC):
+        self.n_symbols = n_symbols
+        self.window = int(window)
+        self.min_periods = self.window if min_periods is None else int(min_periods)
+        self.ref = np.zeros(n_symbols) if ref is None else np.where(np.isnan(ref), 0.0, ref)
+        self.resync = resync * self.window
+        self.rows, self.cols = pair_indices(n_symbols)
+        self.buffer = np.zeros((self.window, n_symbols))            # Centered rows of the window (0 if NaN)
+        self.masks = np.zeros((self.window, n_symbols), dtype=bool)
+        self.pushed = 0
+        pairs = len(self.rows)
+        self.n, self.sx, self.sy, self.sxx, self.syy, self.sxy = (np.zeros(pairs) for _ in range(6))
+
+    def _update(self, z, valid, sign):
+        zx, zy = z[self.rows], z[self.cols]
+        mx, my = valid[self.rows], valid[self.cols]
+        self.n += sign * (mx & my)
+        self.sx += sign * zx * my
+        self.sy += sign * zy * mx
+        self.sxx += sign * zx * zx * my
+        self.syy += sign * zy * zy * mx
+        self.sxy += sign * zx * zy
+
+    def _recompute(self):
+        """Exact statistics of the rows in the window"""
+        z, m = self.buffer, self.masks.astype("<f8")
+        pick = (self.rows, self.cols)
+        self.n = (m.T @ m)[pick]
+        self.sx = (z.T @ m)[pick]
+        self.sy = (m.T @ z)[pick]
+        self.sxx = ((z * z).T @ m)[pick]
+        self.syy = (m.T @ (z * z))[pick]
+        self.sxy = (z.T @ z)[pick]
+
+    def push(self, row):
+        """Add a row (values of every symbol, NaN if missing), removing the one leaving the window"""
+        row = np.asarray(row, dtype="<f8")
+        valid = ~np.isnan(row)
+        z = np.where(valid, row - self.ref, 0.0)
+        slot = self.pushed % self.window
+        if self.pushed >= self.window:
+            self._update(self.buffer[slot], self.masks[slot], -1)
+        self.buffer[slot], self.masks[slot] = z, valid
+        self.pushed += 1
+        if self.pushed % self.resync == 0:
+            self._recompute()
+        else:
+            self._update(z, valid, 1)
+
+    def cov(self):
+        """Covariances (ddof=1) of the pairs over the window, NaN with less than min_periods common values"""
+        n = self.n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov = (self.sxy - self.sx * self.sy / n) / (n - 1)
+        return np.where((n >= max(self.min_periods, 2)), cov, np.nan)
+
+    def corr(self):
+        """Correlations of the pairs over the window, NaN with less than min_periods common values or no variance"""
+        n = self.n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var_x = np.clip(self.sxx - self.sx * self.sx / n, 0, None)
+            var_y = np.clip(self.syy - self.sy * self.sy / n, 0, None)
+            denominator = np.sqrt(var_x * var_y)
+            corr = np.clip((self.sxy - self.sx * self.sy / n) / denominator, -1.0, 1.0)
+        # Relative threshold: constant series leave rounding residues instead of a variance of 0
+        scale = np.maximum(self.sxx, 1e-300) * np.maximum(self.syy, 1e-300)
+        return np.where((n >= max(self.min_periods, 2)) & (denominator > 1e-12 * np.sqrt(scale)), corr, np.nan)
+
+
+def rolling_matrices(x, window, kind="corr", min_periods=None, upper=False, dtype="<f8", resync=DFT_RESYNC):
+    """
+    Rolling covariance or correlation matrices of the columns of a (dates x symbols) matrix.
+    :param x:           values (NaN if missing)
+    :param window:      rows of the window
+    :param kind:        cov or corr
+    :param min_periods: common valid values needed by a pair (window by default, as pandas)
+    :param upper:       only the upper triangle: (dates, pairs) instead of (dates, symbols, symbols)
+    :param dtype:       of the result (<f4 halves it again)
+    :return: 3-D array (dates, symbols, symbols) or 2-D array (dates, pairs) if upper
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Kind {kind} not supported. Please select one among {KINDS}")
+    x = np.asarray(x, dtype="<f8")
+    n_dates, n_symbols = x.shape
+    with np.errstate(invalid="ignore"):
+        ref = np.nanmean(x, axis=0) if n_dates else np.zeros(n_symbols)
+    moments = RollingMoments(n_symbols, window, min_periods=min_periods, ref=ref, resync=resync)
+    packed = np.empty((n_dates, len(moments.rows)), dtype=dtype)
+    statistic = moments.cov if kind == "cov" else moments.corr
+    for n, row in enumerate(x):
+        moments.push(row)
+        packed[n] = statistic()
+    return packed if upper else unpack(packed, n_symbols)
+
+
+class RollingMatrices:
+    """Rolling matrices of a group of symbols: values is (dates, symbols, symbols) or (dates, pairs) if upper"""
+
+    def __init__(self, dates, symbols, kind, window, values, upper=False):
+        self.dates = dates
+        self.symbols = symbols
+        self.kind = kind
+        self.window = window
+        self.values = values
+        self.upper = upper
+
+    def __repr__(self):
+        layout = "upper triangle" if self.upper else "full"
+        return f"RollingMatrices({self.kind}, window={self.window}, {len(self.dates)} dates x {len(self.symbols)} " \
+               f"symbols, {layout})"
+
+    def matrix(self, date):
+        """DataFrame (symbols x symbols) on a date (the last one on or before it)"""
+        row = self.dates.searchsorted(pd.Timestamp(date), side="right") - 1
+        if row < 0:
+            raise KeyError(f"No matrix on or before {date}")
+        values = unpack(self.values[row], len(self.symbols)) if self.upper else self.values[row]
+        return pd.DataFrame(values, index=self.symbols, columns=self.symbols)
+
+    def pair(self, first, second):
+        """Series of the rolling value of a pair of symbols"""
+        i, j = sorted((self.symbols.index(first), self.symbols.index(second)))
+        if self.upper:
+            column = i * len(self.symbols) - i * (i - 1) // 2 + j - i
+            return pd.Series(self.values[:, column], index=self.dates, name=f"{first}|{second}")
+        return pd.Series(self.values[:, i, j], index=self.dates, name=f"{first}|{second}")
+
+
+def load_correlations(symbols, window=60, kind="corr", period="daily", field="close", on_returns=True,
+                      min_periods=None, upper=False, dtype="<f8", verbose=VERBOSE):
+    """
+    Rolling correlations (or covariances) of a group of symbols from their aligned panel.
+    :param on_returns: of the simple returns of the field (the prices otherwise)
+    """
+    panel = load_panel(symbols, period=period, fields=[field], verbose=verbose)
+    x = np.asarray(panel[field], dtype="<f8")
+    if on_returns:
+        (x,), _ = returns(x, 0, {})
+    values = rolling_matrices(x, window, kind=kind, min_periods=min_periods, upper=upper, dtype=dtype)
+    return RollingMatrices(panel.dates, panel.symbols, kind, window, values, upper=upper)
+
+
+if __name__ == "__main__":
+    result = load_correlations(["AMZN", "GOOG", "MMM"], window=60)
+    print(result, result.matrix(result.dates[-1]))
@@ -1,8 +1,75 @@
+import time
+import atexit
 import asyncio
-from src.config import VANTAGE_SEMAPHORE_LIMIT
+import aiohttp
+from src.config import MAX_CONNECTIONS, KEEPALIVE_TIMEOUT, HEADERS
+
+
+API_ALIASES = {"alpha_vantage": "vantage"}
+
+
+class TokenBucket:
+    """Allows `capacity` calls per `period` seconds, refilled continuously"""
+
+    def __init__(self, capacity, period, clock=time.monotonic):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self._clock = clock
+        self._tokens = float(capacity)
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """Seconds until one token is available"""
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self._tokens -= 1
+
+    def drain(self):
+        """The server says we are over the limit: no tokens until a whole period has passed"""
+        self._refill()
+        self._tokens = 1 - self.capacity
+
+
+class RateLimiter:
+    """Group of token buckets (e.g. per minute and per day) that must all grant a call"""
+
+    def __init__(self, limits, clock=time.monotonic):
+        self.buckets = [TokenBucket(calls, period, clock=clock) for calls, period in limits]
+        self._lock = None, None         # (lock, event loop it was created in)
+
+    def delay(self):
+        return max((bucket.delay() for bucket in self.buckets), default=0.0)
+
+    async def acquire(self):
+        """Wait (in order of arrival) until every bucket has a token and consume them"""
+        # An asyncio lock is bound to the loop it first waited in: one per event loop
+        loop = asyncio.get_running_loop()
+        if self._lock[1] is not loop:
+            self._lock = asyncio.Lock(), loop
+        async with self._lock[0]:
+            wait = self.delay()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.delay()
+            for bucket in self.buckets:
+                bucket.consume()
+
+    def throttled(self):
+        """Called when the API answers with a rate-limit message"""
+        self.buckets[0].drain()
 
 
 class SemaphoreController:
+    """Concurrency semaphore, rate limiter and pooled HTTP session of every API"""
     _instance = None
 
     def __new__(cls, *args, **kwargs):
@@ -11,12 +78,94 @@ class SemaphoreController:
         return SemaphoreController._instance
 
     def __init__(self):
-        self._vantage_semaphore = asyncio.Semaphore(value=VANTAGE_SEMAPHORE_LIMIT)
+        if getattr(self, "_initialized", False):
+            return
+        self._initialized = True
+        self._concurrency = {}      # Limits of every api, declared by the providers (see add_api)
+        self._semaphores = {}       # api -> (semaphore, event loop it was created in)
+        self._limiters = {}
+        self._sessions = {}
+
+    @staticmethod
+    def api_name(api):
+        return API_ALIASES.get(api, api)
+
+    def add_api(self, api, concurrency, rates):
+        """Declare the max concurrent requests and the quota (rates = [(calls, period in seconds), ...]) of an api"""
+        api = self.api_name(api)
+        if api not in self._concurrency:
+            self._concurrency[api] = concurrency
+            self._limiters[api] = RateLimiter(rates)
+
+    def remove_api(self, api):
+        """Forget the limits of an api (its session is closed by close_sessions)"""
+        api = self.api_name(api)
+        self._concurrency.pop(api, None)
+        self._semaphores.pop(api, None)
+        self._limiters.pop(api, None)
+
+    def delay(self, api):
+        """Seconds until the api quota allows one more call (0: spare quota)"""
+        api = self.api_name(api)
+        return self._limiters[api].delay() if api in self._limiters else 0.0
 
     async def get_semaphore(self, api):
-        if api in ["vantage", "alpha_vantage"]:
-            await self._vantage_semaphore.acquire()
+        api = self.api_name(api)
+        if api in self._concurrency:
+            # An asyncio semaphore is bound to the loop it first waited in: one per event loop, as the sessions
+            loop = asyncio.get_running_loop()
+            semaphore, semaphore_loop = self._semaphores.get(api, (None, None))
+            if semaphore_loop is not loop:
+                semaphore = asyncio.Semaphore(value=self._concurrency[api])
+                self._semaphores[api] = semaphore, loop
+            await semaphore.acquire()
 
     def release_semaphore(self, api):
-        if api in ["vantage", "alpha_vantage"]:
-            self._vantage_semaphore.release()
+        """Release the semaphore acquired by get_semaphore (in the same event loop)"""
+        api = self.api_name(api)
+        if api in self._semaphores:
+            self._semaphores[api][0].release()
+
+    async def wait_for_rate(self, api):
+        """Block until the api quota allows one more call"""
+        api = self.api_name(api)
+        if api in self._limiters:
+            await self._limiters[api].acquire()
+
+    def set_rate_limits(self, api, rates):
+        """Replace the quota of an api: rates = [(calls, period in seconds), ...]"""
+        self._limiters[self.api_name(api)] = RateLimiter(rates)
+
+    def throttled(self, api):
+        api = self.api_name(api)
+        if api in self._limiters:
+            self._limiters[api].throttled()
+
+    def get_session(self, api):
+        """Keep-alive session shared by every request to the same api (within the running event loop)"""
+        api = self.api_name(api)
+        loop = asyncio.get_event_loop()
+        session, session_loop = self._sessions.get(api, (None, None))
+        if session is None or session.closed or session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            session = aiohttp.ClientSession(connector=connector, headers=HEADERS)
+            self._sessions[api] = (session, loop)
+        return session
+
+    async def close_sessions(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session, _ in sessions:
+            if not session.closed:
+                await session.close()
+
+
+def _close_sessions_at_exit():
+    controller = SemaphoreController._instance
+    if controller is None or not controller._sessions:
+        return
+    loop = asyncio.get_event_loop()
+    if not loop.is_closed() and not loop.is_running():
+        loop.run_until_complete(controller.close_sessions())
+
+
+atexit.register(_close_sessions_at_exit)
@@ -0,0 +1,182 @@
+"""
+#########################   Currency   #########################
+Price panels converted into a base currency with the stored FX series
+
+Shares are quoted in the currency of their info file (the LSE ones in pence,
+GBX) and crypto pairs in their quote currency. The rate of every currency
+into the base one comes from the stored fx_daily series: the direct pair,
+its inverse or, when no pair joins them, crossed through GBP (the currency
+every stored pair starts from). Rates are joined as of every date of the
+panel (last close on or before it) with one searchsorted per currency.
+
+The rate vectors are cached for the same base, dates and version of the FX
+files, so converting several panels over the same dates reads and aligns
+every FX series once.
+################################################################
+"""
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from src.config import DATA_FOLDER, DFT_FX_FILE
+from src.catalog import currency_folder_regex
+from src.api_manager import build_info_file, read_pandas_data
+from src.frame_cache import frame_key
+from src.panel import Panel, DFT_FIELDS, load_panel, concat_panels
+from src.storage import BACKENDS
+
+
+PIVOT_CURRENCY = "GBP"
+SUBUNITS = {"GBX": ("GBP", 0.01)}       # Pence
+PRICE_FIELDS = ("open", "high", "low", "close", "adjusted close")
+RATE_CACHE_SIZE = 64
+
+
+def symbol_currency(symbol, period="daily"):
+    """Quote currency of a share (info file) or a crypto pair (from, to)"""
+    if not isinstance(symbol, str):
+        return symbol[1]
+    folder = DATA_FOLDER.joinpath(symbol)
+    for info_file in [build_info_file(folder, period), *sorted(folder.glob("info_data_*.json"))]:
+        if info_file.exists():
+            info = json.loads(info_file.read_text())
+            if info.get("currency"):
+                # Alpha Vantage reports GBP for the LSE shares, quoted in pence
+                if info["currency"] == "GBP" and info.get("region") == "United Kingdom":
+                    return "GBX"
+                return info["currency"]
+    raise ValueError(f"No currency found for {symbol}")
+
+
+def fx_file(pair):
+    """Stored fx_daily file of a (from, to) pair, None if there is none"""
+    folder = DATA_FOLDER.joinpath("_".join(pair))
+    for storage in BACKENDS.values():
+        file_name = folder.joinpath(f"{DFT_FX_FILE}_fx_daily{storage.extension}")
+        if file_name.exists():
+            return file_name
+    return None
+
+
+def stored_pairs():
+    """(from, to) of every stored currency pair"""
+    return {tuple(x.name.split("_")) for x in DATA_FOLDER.iterdir()
+            if x.is_dir() and currency_folder_regex.match(x.name) and fx_file(x.name.split("_"))}
+
+
+def rate_path(currency, base, pairs):
+    """
+    Steps converting currency into base: list of (pair, inverse). Multiplying by the close of every pair (or
+    dividing if inverse) gives the rate. Raises ValueError if the stored pairs can not join them
+    """
+    if currency == base:
+        return []
+    if (currency, base) in pairs:
+        return [((currency, base), False)]
+    if (base, currency) in pairs:
+        return [((base, currency), True)]
+    if PIVOT_CURRENCY not in (currency, base):
+        try:
+            return rate_path(currency, PIVOT_CURRENCY, pairs) + rate_path(PIVOT_CURRENCY, base, pairs)
+        except ValueError:
+            pass
+    raise ValueError(f"No stored FX series to convert {currency} into {base}")
+
+
+def asof(dates, rate_dates, rates):
+    """Last rate on or before every date (NaN before the first one)"""
+    rows = np.searchsorted(rate_dates, dates, side="right") - 1
+    values = rates[np.maximum(rows, 0)]
+    values[rows < 0] = np.nan
+    return values
+
+
+class RateCache:
+    """Rate vectors (currency -> base over some dates) of the last conversions"""
+
+    def __init__(self, max_entries=RATE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def rates(self, dates, currency, base, pairs=None):
+        """Multiplier of the prices in currency into base at every date"""
+        scale = 1.0
+        if currency in SUBUNITS:
+            currency, scale = SUBUNITS[currency]
+        if base in SUBUNITS:
+            base, base_scale = SUBUNITS[base]
+            scale /= base_scale
+        steps = rate_path(currency, base, stored_pairs() if pairs is None else pairs)
+        dates = np.asarray(dates, dtype="datetime64[ns]")
+        key = (currency, base, hashlib.sha1(dates.tobytes()).hexdigest(),
+               tuple(frame_key(fx_file(pair)) for pair, _ in steps))
+        values = self._entries.get(key)
+        if values is None:
+            self.misses += 1
+            values = np.ones(len(dates))
+            for pair, inverse in steps:
+                close = read_pandas_data(fx_file(pair), columns=["close"], cache=True)
+                rates = asof(dates, close.index.values.astype("datetime64[ns]"), close["close"].to_numpy(dtype="<f8"))
+                values = values / rates if inverse else values * rates
+            values.flags.writeable = False
+            self._entries[key] = values
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return values if scale == 1.0 else values * scale
+
+    def matrix(self, dates, currencies, base):
+        """Rates (dates x symbols) of the currency of every symbol into base"""
+        pairs = stored_pairs()
+        unique = sorted(set(currencies))
+        vectors = np.column_stack([self.rates(dates, currency, base, pairs=pairs) for currency in unique])
+        return vectors[:, [unique.index(currency) for currency in currencies]]
+
+    def clear(self):
+        self._entries.clear()
+
+
+rate_cache = RateCache()
+
+
+def convert_panel(panel, currencies, base="GBP", fields=PRICE_FIELDS):
+    """
+    Copy of a panel with the price fields in base currency (volumes and other fields unchanged).
+    :param currencies: quote currency of every symbol of the panel (see symbol_currency)
+    """
+    if len(currencies) != len(panel.symbols):
+        raise ValueError(f"{len(currencies)} currencies given for {len(panel.symbols)} symbols")
+    rates = rate_cache.matrix(panel.dates.values, currencies, base)
+    values = np.array(panel.values, dtype="<f8")
+    for n, field in enumerate(panel.fields):
+        if field in fields:
+            values[n] *= rates
+    return Panel(panel.dates, panel.symbols, panel.fields, values, build=panel.build)
+
+
+def load_converted(symbols, base="GBP", period="daily", fields=DFT_FIELDS):
+    """
+    Aligned panel (see src.panel.load_panel) of shares and crypto pairs (from, to) in base currency.
+    The crypto pairs are read from their digital_<period> series, in their quote currency
+    """
+    symbols = [symbols] if isinstance(symbols, (str, tuple)) else list(symbols)
+    fields = list(fields)
+    shares = [symbol for symbol in symbols if isinstance(symbol, str)]
+    panels = [load_panel(shares, period=period, fields=fields)] if shares else []
+    currencies = [symbol_currency(symbol, period) for symbol in shares]
+    for quote in sorted({symbol[1] for symbol in symbols if not isinstance(symbol, str)}):
+        pairs = [symbol for symbol in symbols if not isinstance(symbol, str) and symbol[1] == quote]
+        quoted = [field if field == "volume" else f"{field} ({quote})" for field in fields]
+        panel = load_panel(pairs, period=f"digital_{period}", fields=quoted)
+        panels.append(Panel(panel.dates, panel.symbols, fields, panel.values, build=panel.build))
+        currencies += [quote] * len(pairs)
+    panel = panels[0] if len(panels) == 1 else concat_panels(panels)
+    converted = convert_panel(panel, currencies, base=base)
+    # Same order as requested
+    order = [converted.symbols.index("_".join(s) if not isinstance(s, str) else s) for s in symbols]
+    return Panel(converted.dates, [converted.symbols[n] for n in order], fields, converted.values[:, :, order],
+                 build=converted.build)
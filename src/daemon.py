@@ -0,0 +1,340 @@
+"""
+#########################   Update daemon   #########################
+Resident service refreshing every series shortly after its exchange closes
+
+Jobs (one per folder and downloaded category) live in a SQLite queue with
+the time they are due: DAEMON_REFRESH_DELAY after the next session close of
+the exchange (see src.trading_calendar), or now for the series missing the
+last finished session. A series still missing it after its update is retried
+with a growing delay, up to DAEMON_MAX_RETRIES times.
+
+The process keeps the catalog, the HTTP sessions and the rate limiters warm
+between runs. A job is marked running while it is updated, so a restart
+puts it back in the queue; every other job keeps its due time. Updating it
+again does not repeat the API call when the data was already saved (the
+planner finds nothing missing) or the answer already cached.
+
+GET /status returns the queue as JSON and GET /metrics the Prometheus text
+of src.telemetry (on DAEMON_HOST:DAEMON_PORT).
+#####################################################################
+"""
+import json
+import signal
+import sqlite3
+import asyncio
+from collections import namedtuple
+from datetime import datetime, timezone
+import pandas as pd
+from aiohttp import web
+from src.config import (DAEMON_QUEUE_FILE, DAEMON_HOST, DAEMON_PORT, DAEMON_REFRESH_DELAY, DAEMON_RETRY_DELAY,
+                        DAEMON_MAX_RETRIES, DAEMON_RESEED, DFT_CRIPTO_PREFIX, VERBOSE)
+from src.api_manager import catalog, update_stock, derive_stock, semaphore_controller
+from src.providers import concurrency
+from src.scheduler import (STOCK_CATEGORIES, FX_CATEGORIES, CRYPTO_CATEGORIES, DERIVED_STOCK_CATEGORIES,
+                           DERIVED_FX_CATEGORIES, DERIVED_CRYPTO_CATEGORIES, queue_depth, jobs_total)
+from src.telemetry import REGISTRY
+from src.trading_calendar import calendar_name, last_close, next_close, market_timezone
+from src.utils import LOG, ts2datetime
+
+
+KIND_CATEGORIES = {"stock": STOCK_CATEGORIES, "fx": FX_CATEGORIES, "crypto": CRYPTO_CATEGORIES}
+FETCHED_CATEGORIES = STOCK_CATEGORIES + FX_CATEGORIES + CRYPTO_CATEGORIES
+DERIVED_CATEGORIES = {**{category: DERIVED_STOCK_CATEGORIES for category in STOCK_CATEGORIES},
+                      **{category: DERIVED_FX_CATEGORIES for category in FX_CATEGORIES},
+                      **{category: DERIVED_CRYPTO_CATEGORIES for category in CRYPTO_CATEGORIES}}
+POLL_SECONDS = 60               # Max sleep between two looks at the queue
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    folder      TEXT NOT NULL,
+    category    TEXT NOT NULL,
+    symbol      TEXT NOT NULL,
+    due         TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    last_run    TEXT,
+    result      TEXT,
+    error       TEXT,
+    PRIMARY KEY (folder, category)
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, due);
+"""
+Job = namedtuple("Job", ["folder", "category", "symbol", "due", "attempts"])
+
+
+def utc_now():
+    return pd.Timestamp(datetime.now(timezone.utc))
+
+
+def folder_symbol(folder, kind):
+    """Symbol given to update_stock: AMZN, [GBP, USD] (fx) or [BTC, GBP] (crypto)"""
+    if kind == "crypto":
+        return folder[len(DFT_CRIPTO_PREFIX):].split("_")
+    if kind == "fx":
+        return folder.split("_")
+    return folder
+
+
+class JobQueue:
+    """Update jobs and their due time (UTC), persisted in SQLite"""
+
+    def __init__(self, db_file=DAEMON_QUEUE_FILE):
+        self.db_file = db_file
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_file.as_posix())
+            self._conn.row_factory = sqlite3.Row
+            with self._conn:
+                self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def _job(row):
+        return Job(row["folder"], row["category"], json.loads(row["symbol"]), pd.Timestamp(row["due"], tz="UTC"),
+                   row["attempts"])
+
+    def add(self, folder, category, symbol, due):
+        """Queue a new job (the known ones keep their due time). Returns True if added"""
+        with self.conn:
+            cursor = self.conn.execute("INSERT OR IGNORE INTO jobs (folder, category, symbol, due, status) "
+                                       "VALUES (?, ?, ?, ?, 'pending')",
+                                       (folder, category, json.dumps(symbol), ts2datetime(due)))
+        return cursor.rowcount > 0
+
+    def resume(self):
+        """Put back the jobs interrupted by a restart. Returns how many"""
+        with self.conn:
+            return self.conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'").rowcount
+
+    def claim(self, now, limit):
+        """Mark as running and return the due jobs (oldest first)"""
+        with self.conn:
+            rows = self.conn.execute("SELECT * FROM jobs WHERE status = 'pending' AND due <= ? ORDER BY due LIMIT ?",
+                                     (ts2datetime(now), limit)).fetchall()
+            self.conn.executemany("UPDATE jobs SET status = 'running' WHERE folder = ? AND category = ?",
+                                  [(row["folder"], row["category"]) for row in rows])
+        return [self._job(row) for row in rows]
+
+    def finish(self, job, due, attempts, result, error=None):
+        """Schedule the next run of a job"""
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET status = 'pending', due = ?, attempts = ?, last_run = ?, result = ?, "
+                              "error = ? WHERE folder = ? AND category = ?",
+                              (ts2datetime(due), attempts, ts2datetime(utc_now()), result, error, job.folder,
+                               job.category))
+
+    def next_due(self):
+        """Due time of the next pending job (None if there is none)"""
+        due = self.conn.execute("SELECT MIN(due) FROM jobs WHERE status = 'pending'").fetchone()[0]
+        return None if due is None else pd.Timestamp(due, tz="UTC")
+
+    def counts(self, now=None):
+        counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        if now is not None:
+            counts["due"] = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending' AND due <= ?",
+                                              (ts2datetime(now),)).fetchone()[0]
+        return counts
+
+    def jobs(self, status=None, retrying=False, limit=None):
+        """Rows of the queue as dicts, by due time"""
+        query, params = "SELECT * FROM jobs WHERE 1", []
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        if retrying:
+            query += " AND attempts > 0"
+        query += " ORDER BY due"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [{**dict(row), "symbol": json.loads(row["symbol"])} for row in self.conn.execute(query, params)]
+
+
+class UpdateDaemon:
+    """
+    :param queue:   JobQueue (default: the DAEMON_QUEUE_FILE one)
+    :param workers: concurrent updates (default: the max concurrent requests of the providers)
+    :param clock:   current time (UTC Timestamp)
+    """
+
+    def __init__(self, queue=None, workers=None, host=DAEMON_HOST, port=DAEMON_PORT, clock=utc_now,
+                 verbose=VERBOSE):
+        self.queue = JobQueue() if queue is None else queue
+        self.workers = concurrency(FETCHED_CATEGORIES) if workers is None else workers
+        self.host, self.port = host, port
+        self.clock = clock
+        self.verbose = verbose
+        self.started = None
+        self.done = 0
+        self.failed = 0
+        self._running = {}
+        self._seeded = None
+        self._wake = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._runner = None
+
+    # Scheduling
+    @staticmethod
+    def series_info(folder, category):
+        """Info and last stored date of a series (info of any period of the folder if it has none)"""
+        rows = catalog.series(folder=folder)
+        row = next((row for row in rows if row["period"] == category), None)
+        info = row["info"] if row is not None else (rows[0]["info"] if rows else {})
+        last_ts = row["last_ts"] if row is not None else None
+        return info, None if last_ts is None else pd.Timestamp(last_ts)
+
+    def missing_session(self, category, info, last_ts, now):
+        """True if the series lacks the last session whose refresh time has passed"""
+        name = calendar_name(category, info)
+        close = last_close(name, now - pd.Timedelta(seconds=DAEMON_REFRESH_DELAY), info=info)
+        session = close.tz_convert(market_timezone(name, info)).tz_localize(None).normalize()
+        return last_ts is None or last_ts.normalize() < session
+
+    def next_refresh(self, category, info, now):
+        """DAEMON_REFRESH_DELAY after the next close of the exchange"""
+        delay = pd.Timedelta(seconds=DAEMON_REFRESH_DELAY)
+        return next_close(calendar_name(category, info), now - delay, info=info) + delay
+
+    def seed(self):
+        """Queue a job for every new series of the catalog. Returns how many"""
+        if catalog.is_empty():
+            catalog.rebuild(verbose=self.verbose)
+        now, added = self.clock(), 0
+        for kind, categories in KIND_CATEGORIES.items():
+            for folder in dict.fromkeys(row["folder"] for row in catalog.series(kind=kind)):
+                for category in categories:
+                    info, last_ts = self.series_info(folder, category)
+                    due = now if self.missing_session(category, info, last_ts, now) else \
+                        self.next_refresh(category, info, now)
+                    added += self.queue.add(folder, category, folder_symbol(folder, kind), due)
+        self._seeded = now
+        if added and self.verbose > 0:
+            LOG.info(f"Daemon: {added} series added to the queue")
+        return added
+
+    # Jobs
+    async def run_job(self, job):
+        """Update a series and its derived ones, then schedule its next run"""
+        error = None
+        try:
+            # update_stock and derive_stock log their errors and return the status of the update
+            status = await update_stock(job.symbol, category=job.category, max_gap=0, verbose=self.verbose)
+            if status == "error":
+                error = f"update_stock {status}"
+            for category in DERIVED_CATEGORIES.get(job.category, ()):
+                if await derive_stock(job.symbol, category=category, verbose=self.verbose) == "error":
+                    error = error or f"derive_stock error [{category}]"
+        except Exception as err:
+            error = err.__repr__()
+        if error is not None:
+            LOG.error(f"Daemon: ERROR updating {job.folder} [{job.category}]: {error}")
+
+        now = self.clock()
+        info, last_ts = self.series_info(job.folder, job.category)
+        result = "error" if error is not None else "missing" if self.missing_session(job.category, info, last_ts,
+                                                                                      now) else "ok"
+        if result != "ok" and job.attempts < DAEMON_MAX_RETRIES:
+            due, attempts, result = now + pd.Timedelta(seconds=DAEMON_RETRY_DELAY * 2 ** job.attempts), \
+                job.attempts + 1, "retry"
+        else:
+            # Up to date, or retried enough (e.g. the exchange was closed): wait for the next close
+            due, attempts = self.next_refresh(job.category, info, now), 0
+        self.queue.finish(job, due, attempts, result, error=error)
+        if result == "ok":
+            self.done += 1
+        else:
+            self.failed += 1
+        jobs_total.inc(category=job.category, status=result)
+
+    def _finished(self, key):
+        def callback(_):
+            self._running.pop(key, None)
+            self._wake.set()
+        return callback
+
+    def dispatch(self):
+        """Start the due jobs (up to the free workers). Returns the seconds until the next look at the queue"""
+        now = self.clock()
+        if self._seeded is None or (now - self._seeded).total_seconds() >= DAEMON_RESEED:
+            self.seed()
+        for job in self.queue.claim(now, limit=max(0, self.workers - len(self._running))):
+            key = (job.folder, job.category)
+            self._running[key] = asyncio.ensure_future(self.run_job(job))
+            self._running[key].add_done_callback(self._finished(key))
+        queue_depth.set(self.queue.counts(now).get("due", 0))
+        next_due = self.queue.next_due()
+        if next_due is None:
+            return POLL_SECONDS
+        return min(max((next_due - now).total_seconds(), 0), POLL_SECONDS)
+
+    # Service
+    def status(self):
+        now = self.clock()
+        return {"started": None if self.started is None else self.started.isoformat(),
+                "uptime": None if self.started is None else (now - self.started).total_seconds(),
+                "workers": self.workers, "done": self.done, "failed": self.failed,
+                "jobs": self.queue.counts(now),
+                "running": [{"folder": folder, "category": category} for folder, category in self._running],
+                "next": self.queue.jobs(status="pending", limit=10),
+                "retrying": self.queue.jobs(retrying=True)}
+
+    async def _status(self, request):
+        return web.json_response(self.status())
+
+    async def _metrics(self, request):
+        return web.Response(text=REGISTRY.prometheus(), content_type="text/plain")
+
+    async def start_server(self):
+        app = web.Application()
+        app.add_routes([web.get("/status", self._status), web.get("/metrics", self._metrics)])
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        if self.verbose > 0:
+            LOG.info(f"Daemon: status on http://{self._runner.addresses[0][0]}:{self._runner.addresses[0][1]}/status")
+
+    async def serve(self):
+        """Run until stop() is called"""
+        self.started = self.clock()
+        self._stop.clear()
+        resumed = self.queue.resume()
+        if resumed and self.verbose > 0:
+            LOG.info(f"Daemon: {resumed} interrupted jobs resumed")
+        await self.start_server()
+        try:
+            while not self._stop.is_set():
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.dispatch())
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+            if self._running:
+                await asyncio.gather(*self._running.values(), return_exceptions=True)
+        finally:
+            await self._runner.cleanup()
+            await semaphore_controller.close_sessions()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+def run_daemon(verbose=VERBOSE):
+    daemon = UpdateDaemon(verbose=verbose)
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, daemon.stop)
+    loop.run_until_complete(daemon.serve())
+    LOG.info(f"Daemon stopped: {daemon.done} updates, {daemon.failed} failed")
+
+
+if __name__ == "__main__":
+    run_daemon()
@@ -0,0 +1,138 @@
+"""
+#########################   Dataset   #########################
+Lazy handle on stored series: date range and columns pushed down to storage
+
+    dataset(["AMZN", "DGE.LON"], "daily").between("2019-01-01").select(["close"]).collect()
+
+between() and select() return new handles, nothing is read until collect().
+The columnar files then read only the segments and rows in the range and the
+selected columns (see src.storage); the zipped CSV ones are filtered once
+parsed. A file held whole in the frame cache is sliced in memory instead.
+
+estimate() gives the rows and bytes of the result from the catalog (first
+and last dates, rows and columns of every series) without opening any data
+file, assuming the rows are evenly spread between the first and last dates.
+###############################################################
+"""
+import numpy as np
+import pandas as pd
+from src.api_manager import build_path_and_file, catalog, frame_cache
+from src.catalog import data_period
+from src.frame_cache import frame_key, decode_files
+from src.storage import INDEX_NAME
+from src.utils import LOG
+
+
+def dataset(symbols, period="daily"):
+    """Lazy handle on the series of one symbol (or (from, to) pair) or a list of them"""
+    return Dataset(symbols, period)
+
+
+def symbol_key(symbol):
+    return symbol if isinstance(symbol, str) else tuple(symbol)
+
+
+def slice_dates(frame, start=None, end=None):
+    """Rows of a frame (sorted dates) from start to end, both included (no copy)"""
+    dates = frame.index
+    first = 0 if start is None else dates.searchsorted(pd.Timestamp(start), side="left")
+    last = len(dates) if end is None else dates.searchsorted(pd.Timestamp(end), side="right")
+    return frame.iloc[first:last]
+
+
+class Dataset:
+    def __init__(self, symbols, period="daily", start=None, end=None, columns=None):
+        self.single = isinstance(symbols, (str, tuple))
+        self.symbols = [symbols] if self.single else list(symbols)
+        self.period = period
+        self.start = None if start is None else pd.Timestamp(start)
+        self.end = None if end is None else pd.Timestamp(end)
+        self.columns = None if columns is None else list(columns)
+
+    def __repr__(self):
+        columns = "all columns" if self.columns is None else self.columns
+        return (f"Dataset({len(self.symbols)} symbols, {self.period}, {self.start or '...'} to {self.end or '...'}, "
+                f"{columns})")
+
+    def _copy(self, **changes):
+        fields = {"start": self.start, "end": self.end, "columns": self.columns, **changes}
+        return Dataset(self.symbols[0] if self.single else self.symbols, self.period, **fields)
+
+    def between(self, start=None, end=None):
+        """Rows from start to end (both included, None: no limit). Narrows the current range"""
+        if start is not None:
+            start = pd.Timestamp(start) if self.start is None else max(self.start, pd.Timestamp(start))
+        if end is not None:
+            end = pd.Timestamp(end) if self.end is None else min(self.end, pd.Timestamp(end))
+        return self._copy(start=self.start if start is None else start, end=self.end if end is None else end)
+
+    def select(self, columns):
+        """Only these columns (a name or a list)"""
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        if self.columns is not None:
+            unknown = [column for column in columns if column not in self.columns]
+            if unknown:
+                raise ValueError(f"Columns {unknown} not selected before. Selected: {self.columns}")
+        return self._copy(columns=columns)
+
+    def files(self):
+        """Data file of every symbol"""
+        return {symbol_key(symbol): build_path_and_file(symbol, self.period)[1] for symbol in self.symbols}
+
+    def estimate(self):
+        """
+        Rows, columns and bytes (index included) of the result of every symbol, from the catalog only: no data file
+        is opened. NaN for the symbols not indexed (and for the columns of the series indexed before their column
+        names were recorded, if none is selected: see Catalog.rebuild)
+        """
+        estimates = {}
+        for symbol, file_name in self.files().items():
+            summary = catalog.summary(file_name.parent.name, data_period(file_name))
+            if summary is None or summary["rows"] is None:
+                rows = np.nan
+            else:
+                rows = self._rows(summary["rows"], summary["first_ts"], summary["last_ts"])
+            if self.columns is not None:
+                columns = len(self.columns)
+            else:
+                columns = np.nan if summary is None or summary["columns"] is None else len(summary["columns"])
+            name = symbol if isinstance(symbol, str) else "_".join(symbol)
+            estimates[name] = {"rows": rows, "columns": columns, "bytes": rows * 8 * (1 + columns)}
+        return pd.DataFrame.from_dict(estimates, orient="index", columns=["rows", "columns", "bytes"])
+
+    def _rows(self, rows, first_ts, last_ts):
+        """Rows of a series between start and end, spread evenly between its first and last dates"""
+        if not rows or first_ts is None:
+            return 0
+        first, last = pd.Timestamp(first_ts), pd.Timestamp(last_ts)
+        start = first if self.start is None else max(first, self.start)
+        end = last if self.end is None else min(last, self.end)
+        if end < start:
+            return 0
+        if last == first:
+            return rows
+        return min(rows, int(np.ceil(rows * (end - start) / (last - first))) + 1)
+
+    def collect(self, workers=None):
+        """
+        Read the data: a DataFrame for a single symbol, otherwise dict symbol -> DataFrame (None if there is no
+        data). The frames sliced from the frame cache share its read-only arrays
+        """
+        files = self.files()
+        frames = dict.fromkeys(files)
+        cold = []
+        for symbol, file_name in files.items():
+            if not file_name.exists():
+                LOG.error(f"ERROR: data not found for {file_name}")
+                continue
+            cached = frame_cache.get(frame_key(file_name, self.columns))
+            if cached is not None:
+                frames[symbol] = slice_dates(cached, self.start, self.end).copy(deep=False)
+            else:
+                cold.append(symbol)
+        decoded = decode_files([files[symbol] for symbol in cold], columns=self.columns, workers=workers,
+                               start=self.start, end=self.end)
+        for symbol, arrays in zip(cold, decoded):
+            index = pd.DatetimeIndex(arrays.pop(INDEX_NAME).view("datetime64[ns]"), name=INDEX_NAME)
+            frames[symbol] = pd.DataFrame(arrays, index=index)
+        return next(iter(frames.values())) if self.single else frames
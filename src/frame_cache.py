@@ -0,0 +1,142 @@
+"""
+#########################   Frame cache   #########################
+In-process LRU cache of the data files read by the notebooks
+
+Entries are keyed on (path, mtime, size, columns), so a rewritten or appended
+file is read again, and the cache is bounded in bytes (least recently used
+entries are evicted first). A request for some columns is served from the
+whole file when it is cached. The cached arrays are read-only and every
+caller gets a frame sharing them: modifying it copies the modified column
+(copy-on-write), the cached one never changes. This relies on pandas >= 3,
+where copy-on-write is always on (see requirements.txt): with older pandas a
+write to a returned frame would fail on the read-only arrays or change the
+cached ones.
+
+Cold files are decoded in parallel: threads for the columnar files (their
+reads release the GIL) and the process pool of src.offload for the zipped CSV
+ones.
+###################################################################
+"""
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from src.config import FRAME_CACHE_MAX_BYTES
+from src.storage import INDEX_NAME, backend_for, ZipCsvBackend, ColumnarBackend
+from src.offload import get_pool
+
+
+def frame_key(file_name, columns=None):
+    stat = file_name.stat()
+    return file_name.as_posix(), stat.st_mtime_ns, stat.st_size, None if columns is None else tuple(columns)
+
+
+def decode_file(file_name, columns=None, start=None, end=None):
+    """Arrays {name: ndarray} of a data file, the index (int64 nanoseconds) included (rows from start to end)"""
+    storage = backend_for(file_name)
+    if isinstance(storage, ColumnarBackend):
+        return storage.read_arrays(file_name, columns=columns, start=start, end=end)
+    data = storage.read(file_name, columns=columns, start=start, end=end)
+    return {INDEX_NAME: data.index.values.astype("datetime64[ns]").view("<i8"),
+            **{col: data[col].to_numpy() for col in data.columns}}
+
+
+def frozen_frame(arrays):
+    """DataFrame backed by the arrays, made read-only (no copy), and its size in bytes"""
+    for values in arrays.values():
+        values.flags.writeable = False
+    index = pd.DatetimeIndex(arrays[INDEX_NAME].view("datetime64[ns]"), name=INDEX_NAME)
+    columns = [name for name in arrays if name != INDEX_NAME]
+    frame = pd.DataFrame({name: arrays[name] for name in columns}, index=index, columns=columns, copy=False)
+    return frame, sum(values.nbytes for values in arrays.values())
+
+
+def decode_files(files, columns=None, workers=None, start=None, end=None):
+    """decode_file of every file, in parallel. Returns the arrays in the same order"""
+    pool = get_pool()
+    workers = workers or min(len(files), os.cpu_count() or 1)
+    if workers <= 1 and pool is None:
+        return [decode_file(f, columns, start, end) for f in files]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as threads:
+        futures = [(pool if pool is not None and isinstance(backend_for(f), ZipCsvBackend) else threads)
+                   .submit(decode_file, f, columns, start, end) for f in files]
+        return [future.result() for future in futures]
+
+
+class FrameCache:
+    def __init__(self, max_bytes=FRAME_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()       # key -> (frame, bytes)
+        self._versions = {}                 # path -> keys (every version and column subset)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Cached frame (the shared one, do not modify) or None"""
+        entry = self._entries.get(key)
+        if entry is None and key[3] is not None:
+            whole = self._entries.get(key[:3] + (None,))
+            if whole is not None:
+                self.hits += 1
+                self._entries.move_to_end(key[:3] + (None,))
+                return whole[0][list(key[3])]
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, arrays):
+        """Store the arrays of a file (see decode_file) and drop its previous versions. Returns the cached frame"""
+        for old_key in [k for k in self._versions.get(key[0], ()) if k[1:3] != key[1:3]]:
+            self.discard(old_key)
+        frame, size = frozen_frame(arrays)
+        self.discard(key)
+        self._entries[key] = (frame, size)
+        self._versions.setdefault(key[0], set()).add(key)
+        self.bytes += size
+        self.evict()
+        return frame
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+            self._versions[key[0]].discard(key)
+
+    def evict(self):
+        """Remove the least recently used frames until the cache fits in max_bytes"""
+        while self.bytes > self.max_bytes and self._entries:
+            self.discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def read(self, file_name, columns=None):
+        """Frame of a data file (from memory if it did not change)"""
+        key = frame_key(file_name, columns)
+        frame = self.get(key)
+        if frame is None:
+            frame = self.put(key, decode_file(file_name, columns=columns))
+        return frame.copy(deep=False)
+
+    def read_many(self, files, columns=None, workers=None):
+        """Frames of several data files, the cold ones decoded in parallel (see decode_files)"""
+        keys = [frame_key(f, columns) for f in files]
+        frames = [self.get(key) for key in keys]
+        cold = [n for n, frame in enumerate(frames) if frame is None]
+        for n, arrays in zip(cold, decode_files([files[n] for n in cold], columns=columns, workers=workers)):
+            frames[n] = self.put(keys[n], arrays)
+        return [frame.copy(deep=False) for frame in frames]
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0, "entries": len(self._entries),
+                "bytes": self.bytes}
+
+    def clear(self):
+        self._entries.clear()
+        self._versions.clear()
+        self.bytes = 0
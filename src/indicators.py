@@ -0,0 +1,226 @@
+"""
+#########################   Indicators   #########################
+Technical indicators computed on (dates x symbols) matrices
+
+Indicators are declared by name, e.g. ["returns", "sma_20", "ema_12", "std_20",
+"rsi_14", "bollinger_20_2"], and computed with numpy over every symbol at
+once. Results are cached on disk keyed by the panel version; when history is
+appended only the new rows are computed: rolling windows read back the last
+(window - 1) inputs and recursive indicators (ema, rsi) resume from the state
+saved at the last complete row.
+##################################################################
+"""
+import os
+import json
+import zlib
+import hashlib
+import numpy as np
+from src.config import CACHE_FOLDER, VERBOSE
+from src.panel import Panel, load_panel
+from src.utils import LOG
+
+
+INDICATORS_FOLDER = CACHE_FOLDER.joinpath("indicators")
+DFT_INDICATORS = ("returns", "sma_20", "sma_50", "ema_12", "ema_26", "std_20", "rsi_14", "bollinger_20_2")
+RECURSIVE = ("ema", "rsi")
+
+
+def parse_indicator(name):
+    """'bollinger_20_2' -> ('bollinger', [20.0, 2.0])"""
+    kind, *params = name.split("_")
+    if kind not in INDICATOR_FUNCTIONS:
+        raise ValueError(f"Indicator {kind} not supported. Please select one among {list(INDICATOR_FUNCTIONS)}")
+    return kind, [float(p) for p in params]
+
+
+def output_names(name):
+    kind, _ = parse_indicator(name)
+    if kind == "bollinger":
+        return [name + "_lower", name + "_mid", name + "_upper"]
+    return [name]
+
+
+def rolling_sums(x, window, start):
+    """Rolling sum, sum of squares and count of valid values over rows [start, n)"""
+    lo = max(start - window + 1, 0)
+    xs = x[lo:]
+    valid = ~np.isnan(xs)
+    ref = np.nanmean(xs, axis=0) if xs.size else 0.0       # Shift to reduce cancellation errors
+    ref = np.where(np.isnan(ref), 0.0, ref)
+    centered = np.where(valid, xs - ref, 0.0)
+    zeros = np.zeros((1, x.shape[1]))
+    cs = np.vstack([zeros, np.cumsum(centered, axis=0)])
+    cs2 = np.vstack([zeros, np.cumsum(centered ** 2, axis=0)])
+    cc = np.vstack([zeros, np.cumsum(valid, axis=0)])
+    rows = np.arange(start - lo, len(xs)) + 1
+    prev = np.clip(rows - window, 0, None)
+    return cs[rows] - cs[prev], cs2[rows] - cs2[prev], cc[rows] - cc[prev], ref
+
+
+def sma(x, start, state, window):
+    window = int(window)
+    s, _, count, ref = rolling_sums(x, window, start)
+    return [np.where(count == window, s / window + ref, np.nan)], state
+
+
+def std(x, start, state, window):
+    window = int(window)
+    s, s2, count, _ = rolling_sums(x, window, start)
+    var = np.clip((s2 - s ** 2 / window) / (window - 1), 0, None)
+    return [np.where(count == window, np.sqrt(var), np.nan)], state
+
+
+def bollinger(x, start, state, window, k=2.0):
+    (mid,), _ = sma(x, start, state, window)
+    (dev,), _ = std(x, start, state, window)
+    return [mid - k * dev, mid, mid + k * dev], state
+
+
+def returns(x, start, state):
+    prev = x[max(start - 1, 0):-1]
+    out = x[max(start, 1):] / prev - 1
+    if start == 0:
+        out = np.vstack([np.full((1, x.shape[1]), np.nan), out])
+    return [out], state
+
+
+def log_returns(x, start, state):
+    (out,), _ = returns(x, start, state)
+    return [np.log1p(out)], state
+
+
+def _smooth(values, alpha, last, snapshot_row):
+    """
+    Exponential smoothing row by row (vectorized over symbols). NaN inputs keep the previous value.
+    Returns the smoothed rows and the value after snapshot_row (state to resume from)
+    """
+    out = np.empty_like(values)
+    snapshot = last.copy()
+    for i, row in enumerate(values):
+        last = np.where(np.isnan(row), last, np.where(np.isnan(last), row, last + alpha * (row - last)))
+        out[i] = last
+        if i == snapshot_row:
+            snapshot = last.copy()
+    return out, snapshot
+
+
+def ema(x, start, state, span):
+    n_symbols = x.shape[1]
+    last = state.get("ema", np.full(n_symbols, np.nan)) if start else np.full(n_symbols, np.nan)
+    out, snapshot = _smooth(x[start:], 2 / (span + 1), last, len(x) - 2 - start)
+    return [out], {"ema": snapshot}
+
+
+def rsi(x, start, state, window):
+    """Wilder's RSI (smoothing with alpha = 1 / window)"""
+    n_symbols = x.shape[1]
+    delta = np.diff(x[max(start - 1, 0):], axis=0)
+    if start == 0:
+        delta = np.vstack([np.full((1, n_symbols), np.nan), delta])
+    gain = np.where(np.isnan(delta), np.nan, np.clip(delta, 0, None))
+    loss = np.where(np.isnan(delta), np.nan, np.clip(-delta, 0, None))
+    empty = np.full(n_symbols, np.nan)
+    snapshot_row = len(x) - 2 - start
+    avg_gain, gain_state = _smooth(gain, 1 / window, state.get("gain", empty) if start else empty, snapshot_row)
+    avg_loss, loss_state = _smooth(loss, 1 / window, state.get("loss", empty) if start else empty, snapshot_row)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = np.where(avg_loss == 0, 100.0, 100 - 100 / (1 + avg_gain / avg_loss))
+    out = np.where(np.isnan(avg_gain) | np.isnan(avg_loss), np.nan, out)
+    return [out], {"gain": gain_state, "loss": loss_state}
+
+
+INDICATOR_FUNCTIONS = {"returns": returns, "logreturns": log_returns, "sma": sma, "ema": ema, "std": std,
+                       "rsi": rsi, "bollinger": bollinger}
+
+
+def compute_indicators(x, names, start=0, states=None, previous=None):
+    """
+    Compute the indicators over a (dates x symbols) matrix.
+    :param x:        input matrix (e.g. close prices)
+    :param names:    declared indicators
+    :param start:    first row to compute (rows before it are taken from previous)
+    :param states:   {name: state} saved at row start - 1 (recursive indicators)
+    :param previous: 3-D array of outputs already computed for rows < start
+    :return: (3-D array (outputs, dates, symbols), {name: state at row n - 2})
+    """
+    x = np.asarray(x, dtype="<f8")
+    states = states or {}
+    outputs, new_states = [], {}
+    for name in names:
+        kind, params = parse_indicator(name)
+        results, new_states[name] = INDICATOR_FUNCTIONS[kind](x, start, states.get(name, {}), *params)
+        outputs.extend(results)
+    values = np.empty((len(outputs), *x.shape), dtype="<f8")
+    if start:
+        values[:, :start] = previous[:, :start]
+    for n, out in enumerate(outputs):
+        values[n, start:] = out
+    return values, new_states
+
+
+def _crc(array):
+    return zlib.crc32(np.ascontiguousarray(array).tobytes())
+
+
+def _save(key, values, states, manifest):
+    INDICATORS_FOLDER.mkdir(parents=True, exist_ok=True)
+    pid = os.getpid()
+    for suffix, writer in ((".values.npy", lambda f: np.save(f, values)),
+                           (".state.npz", lambda f: np.savez(f, **{f"{name}|{k}": v for name, state in states.items()
+                                                                   for k, v in state.items()}))):
+        file_name = INDICATORS_FOLDER.joinpath(key + suffix)
+        tmp_file = file_name.with_name(f"{file_name.name}.{pid}.tmp")
+        with open(tmp_file, "wb") as f:
+            writer(f)
+        os.replace(tmp_file, file_name)
+    manifest_file = INDICATORS_FOLDER.joinpath(key + ".json")
+    tmp_file = manifest_file.with_name(f"{manifest_file.name}.{pid}.tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_file, manifest_file)
+
+
+def _load_states(key):
+    states = {}
+    with np.load(INDICATORS_FOLDER.joinpath(key + ".state.npz")) as data:
+        for full_name in data.files:
+            name, k = full_name.split("|")
+            states.setdefault(name, {})[k] = data[full_name]
+    return states
+
+
+def load_indicators(symbols, period="daily", names=DFT_INDICATORS, field="close", verbose=VERBOSE):
+    """
+    Indicators of a group of symbols as a Panel (fields are the indicator outputs).
+    Cached on disk; only new rows are computed after an update of the data.
+    """
+    names = list(names)
+    panel = load_panel(symbols, period=period, fields=[field], verbose=verbose)
+    x, dates = panel[field], panel.dates.values.astype("datetime64[ns]")
+    fields = [out for name in names for out in output_names(name)]
+    key = hashlib.sha1(json.dumps([period, panel.symbols, field, names]).encode()).hexdigest()[:16]
+    manifest_file = INDICATORS_FOLDER.joinpath(key + ".json")
+    values_file = INDICATORS_FOLDER.joinpath(key + ".values.npy")
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+
+    if manifest.get("build") == panel.build and values_file.exists():
+        return Panel(panel.dates, panel.symbols, fields, np.load(values_file, mmap_mode="r"), build=panel.build)
+
+    # Every row but the last one (possibly incomplete) is final: resume from there if the history matches
+    start, previous, states = 0, None, None
+    stable = manifest.get("rows", 0) - 1
+    if 0 < stable < len(dates) and values_file.exists() \
+            and manifest.get("inputs_crc") == _crc(x[:stable]) and manifest.get("dates_crc") == _crc(dates[:stable]):
+        start, previous, states = stable, np.load(values_file), _load_states(key)
+    if verbose > 1:
+        LOG.info(f"Computing indicators {key}:\t{len(names)} indicators, rows {start}-{len(dates)}")
+
+    values, states = compute_indicators(x, names, start=start, states=states, previous=previous)
+    stable = len(dates) - 1
+    _save(key, values, states, {"build": panel.build, "rows": len(dates), "names": names,
+                                "inputs_crc": _crc(x[:stable]), "dates_crc": _crc(dates[:stable])})
+    return Panel(panel.dates, panel.symbols, fields, values, build=panel.build)
+
+
+if __name__ == "__main__":
+    result = load_indicators(["AMZN", "GOOG", "MMM"], names=["sma_20", "rsi_14"])
+    print(result, result.frame("rsi_14").tail())
@@ -0,0 +1,259 @@
+"""
+#########################   Ingestion   #########################
+Streaming parsers of the Alpha Vantage time series responses
+
+Full-history answers are parsed while they are received: the complete bars of
+every chunk are converted at once into typed numpy columns, so neither the
+whole body nor the dict of dicts of the time series is built.
+- json: {"Meta Data": {...}, "Time Series (Daily)": {"2020-01-31": {"1. open": "..."}, ...}}
+- csv (datatype=csv): timestamp,open,high,low,close,... (most recent first)
+Any other answer (errors, rate-limit notes, search results) is small and is
+returned as the usual dict.
+#################################################################
+"""
+import os
+import re
+import json
+import time
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from src.storage import INDEX_NAME
+from src.offload import metrics, run_off_loop
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_HEAD_SIZE = 64 * 1024           # Bytes buffered looking for the "Meta Data" object
+VantageResponse = namedtuple("VantageResponse", ["info", "data"])
+enum_regex = re.compile(r"\A\w*\.\s*")
+key_regex = re.compile(rb'\s*\{\s*"([^"]*)"')
+head_regex = re.compile(rb'\s*\{\s*"Meta Data"\s*:\s*(\{[^{}]*\})\s*,\s*"[^"]+"\s*:\s*\{')
+series_end_regex = re.compile(rb'\}\s*\}')          # Last bar and end of the series object
+
+
+def clean_column(name):
+    """'5. adjusted close' (json) or 'adjusted_close' (csv) -> 'adjusted close'"""
+    return enum_regex.sub("", name).replace("_", " ")
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+class ColumnBuffers:
+    """
+    Typed buffers filled with blocks of bars. Columns are float64, or int64 when none of their values has
+    decimals (the same types pd.to_numeric gives to the strings of the API)
+    """
+
+    def __init__(self):
+        self.names = None
+        self.dates = []
+        self._blocks = None
+        self._decimals = None
+
+    def set_names(self, names):
+        self.names = [clean_column(name) for name in names]
+        self._blocks = [[] for _ in names]
+        self._decimals = [False] * len(names)
+
+    def add(self, dates, columns):
+        """dates: the n dates of a block of bars. columns: n values (bytes) per column"""
+        if len(columns) != len(self.names) or any(len(column) != len(dates) for column in columns):
+            raise ValueError(f"Block of {len(dates)} bars with inconsistent values")
+        self.dates.extend(dates)
+        for n, column in enumerate(columns):
+            try:
+                block = np.array(column).astype("<f8")
+            except ValueError:
+                block = np.array([_to_float(value) for value in column], dtype="<f8")
+                self._decimals[n] = True
+            if not self._decimals[n]:
+                joined = b"".join(column)
+                self._decimals[n] = b"." in joined or b"e" in joined or b"E" in joined
+            self._blocks[n].append(block)
+
+    def frame(self):
+        """DataFrame sorted by date (the API sends the most recent bar first)"""
+        index = pd.DatetimeIndex(pd.to_datetime([date.decode() for date in self.dates]), name=INDEX_NAME)
+        columns = {}
+        for name, blocks, decimals in zip(self.names or [], self._blocks or [], self._decimals or []):
+            column = np.concatenate(blocks) if blocks else np.empty(0, dtype="<f8")
+            columns[name] = column if decimals else column.astype("<i8")
+        data = pd.DataFrame(columns, index=index)
+        if data.index.is_monotonic_decreasing:
+            data = data.iloc[::-1]
+        elif not data.index.is_monotonic_increasing:
+            data = data.sort_index()
+        return data
+
+
+class VantageJsonParser:
+    """Incremental parser of the json answers, fed with the chunks of the body"""
+
+    def __init__(self):
+        self.columns = ColumnBuffers()
+        self.info = None
+        self._buffer = b""
+        self._raw = []
+        self._state = "head"            # head -> series -> tail, or raw (any other answer)
+
+    def feed(self, chunk):
+        if self._state == "raw":
+            self._raw.append(chunk)
+            return
+        if self._state == "tail":
+            return
+        buffer = self._buffer + chunk
+        if self._state == "head":
+            match = head_regex.match(buffer)
+            if match is None:
+                key = key_regex.match(buffer)
+                if (key is not None and key.group(1) != b"Meta Data") or len(buffer) > MAX_HEAD_SIZE:
+                    self._state, self._raw, self._buffer = "raw", [buffer], b""
+                else:
+                    self._buffer = buffer
+                return
+            self.info = json.loads(match.group(1))
+            self._state = "series"
+            buffer = buffer[match.end() - 1:]           # From the opening brace of the series
+
+        # Complete bars only: up to the end of the series or to the last closing brace (kept in the buffer,
+        # the end of the series may be the next character)
+        end = series_end_regex.search(buffer)
+        if end is not None:
+            block, self._buffer, self._state = buffer[:end.start() + 1], b"", "tail"
+        else:
+            last = buffer.rfind(b"}")
+            block, self._buffer = buffer[:last + 1], buffer[max(last, 0):]
+        # The quoted strings of a block repeat as: date, name 1, value 1, name 2, value 2, ...
+        strings = block.split(b'"')[1::2]
+        if not strings:
+            return
+        if self.columns.names is None:
+            first = block[:block.index(b"}")].split(b'"')[1::2]
+            self.columns.set_names([name.decode() for name in first[1::2]])
+        group = 1 + 2 * len(self.columns.names)
+        if len(strings) % group:
+            raise ValueError(f"Unexpected time series layout: {len(strings)} strings in blocks of {group}")
+        self.columns.add(strings[::group], [strings[2 + 2 * n::group] for n in range(len(self.columns.names))])
+
+    def close(self):
+        """VantageResponse(info, DataFrame) for a time series, otherwise the decoded dict"""
+        if self._state == "raw":
+            return json.loads(b"".join(self._raw))
+        if self._state == "head":
+            return json.loads(self._buffer) if self._buffer.strip() else {}
+        if self._state == "series":
+            raise ValueError("Truncated time series response")
+        return VantageResponse(self.info, self.columns.frame())
+
+
+class VantageCsvParser:
+    """Incremental parser of the csv answers (errors and notes are still sent as json)"""
+
+    def __init__(self):
+        self.columns = ColumnBuffers()
+        self._buffer = b""
+        self._raw = None
+
+    def feed(self, chunk):
+        if self._raw is not None:
+            self._raw.append(chunk)
+            return
+        buffer = self._buffer + chunk
+        if self.columns.names is None and buffer.lstrip()[:1] == b"{":
+            self._raw, self._buffer = [buffer], b""
+            return
+        last = buffer.rfind(b"\n") + 1
+        self._buffer = buffer[last:]                    # Incomplete line
+        self._parse(buffer[:last])
+
+    def _parse(self, block):
+        lines = block.replace(b"\r", b"").split(b"\n")
+        lines = [line for line in lines if line]
+        if lines and self.columns.names is None:
+            self.columns.set_names([name.decode() for name in lines.pop(0).split(b",")[1:]])
+        if not lines:
+            return
+        width = len(self.columns.names) + 1
+        tokens = b",".join(lines).split(b",")
+        if len(tokens) != len(lines) * width:
+            raise ValueError(f"Block of {len(lines)} lines with {len(tokens)} values, expected {width} per line")
+        self.columns.add(tokens[::width], [tokens[n::width] for n in range(1, width)])
+
+    def close(self):
+        if self._raw is not None:
+            return json.loads(b"".join(self._raw))
+        self._parse(self._buffer)
+        self._buffer = b""
+        if self.columns.names is None:
+            return {}
+        return VantageResponse({}, self.columns.frame())
+
+
+def parser_for(datatype="json"):
+    if datatype == "csv":
+        return VantageCsvParser()
+    elif datatype == "json":
+        return VantageJsonParser()
+    raise ValueError(f"Datatype {datatype} not supported. Please select one among ['json', 'csv']")
+
+
+def parse_body(chunks, datatype="json"):
+    """Parse an iterable of byte chunks"""
+    parser = parser_for(datatype)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def iter_file(file_name, chunk_size=STREAM_CHUNK_SIZE):
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield chunk
+
+
+def load_body(file_name, datatype="json", stream=True):
+    """Answer stored on disk: parsed as a stream or decoded as a plain dict"""
+    if stream:
+        return parse_body(iter_file(file_name), datatype=datatype)
+    return json.loads(file_name.read_bytes())
+
+
+async def read_response(resp, datatype="json", body_file=None, chunk_size=STREAM_CHUNK_SIZE, offload=False):
+    """
+    Parse an aiohttp response while it is received. The body is copied to body_file if provided.
+    offload: parse it once received in a worker process (see src.offload) if larger than a chunk
+    """
+    parser = None if offload else parser_for(datatype)
+    chunks, parsing = [], 0.0
+    f = open(body_file, "wb") if body_file is not None else None
+    try:
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            if parser is None:
+                chunks.append(chunk)
+            else:
+                start = time.perf_counter()
+                parser.feed(chunk)
+                parsing += time.perf_counter() - start
+            if f is not None:
+                f.write(chunk)
+        if parser is None and sum(len(chunk) for chunk in chunks) > chunk_size:
+            return await run_off_loop("parse", parse_body, chunks, datatype=datatype)
+        start = time.perf_counter()
+        data = parser.close() if parser is not None else parse_body(chunks, datatype=datatype)
+        metrics.add("parse", on_loop=parsing + time.perf_counter() - start)
+        return data
+    except BaseException:
+        if f is not None:
+            f.close()
+            os.remove(body_file)
+            f = None
+        raise
+    finally:
+        if f is not None:
+            f.close()
@@ -0,0 +1,237 @@
+"""
+#########################   Intraday   #########################
+Live cache of intraday bars (1min ... 60min) for a watchlist
+
+The last INTRADAY_BUFFER_SIZE bars of every series are kept in memory in
+preallocated ring buffers (int64 timestamps + one typed array per column), so
+readers get the latest bars without touching disk. New bars are flushed to
+date-partitioned files:
+    data/<SYMBOL>/stock_data_intraday_5min/2020-01-31.col
+A polling loop refreshes the watchlist within the rate budget of the
+providers serving the category.
+################################################################
+"""
+import time
+import asyncio
+import numpy as np
+import pandas as pd
+from src.config import INTRADAY_BUFFER_SIZE, VANTAGE_DATATYPE, VERBOSE
+from src.alpha_vantage_api import intraday_interval, is_vantage_data
+from src.api_manager import query_data, build_path_and_file, process_vantage_data, clean_pandas_data
+from src.providers import calls_per_minute
+from src.storage import INDEX_NAME, backend_for
+from src.ingest import VantageResponse
+from src.utils import LOG, get_tabs
+
+
+class RingBuffer:
+    """Last `capacity` bars of a series. Bars are only appended (or the last one replaced) in time order"""
+
+    def __init__(self, capacity, columns, dtypes):
+        self.capacity = capacity
+        self.columns = list(columns)
+        self._index = np.zeros(capacity, dtype="<i8")
+        self._values = [np.zeros(capacity, dtype=dtype) for dtype in dtypes]
+        self._end = 0               # Bars ever written: the next one goes to _end % capacity
+        self._flushed = 0           # Bars written to disk
+
+    @classmethod
+    def like(cls, data, capacity=INTRADAY_BUFFER_SIZE):
+        return cls(capacity, data.columns, [data[col].dtype for col in data.columns])
+
+    def __len__(self):
+        return min(self._end, self.capacity)
+
+    @property
+    def pending(self):
+        """Bars not flushed yet (still in memory)"""
+        return min(self._end - self._flushed, len(self))
+
+    @property
+    def last_timestamp(self):
+        return pd.Timestamp(self._index[(self._end - 1) % self.capacity]) if self._end else None
+
+    def extend(self, data):
+        """Add the bars newer than the last one (which is replaced if received again). Returns the new bars"""
+        if data.columns.tolist() != self.columns:
+            raise ValueError(f"Columns {data.columns.tolist()} differ from the buffered ones {self.columns}")
+        index = np.asarray(pd.DatetimeIndex(data.index).values.astype("datetime64[ns]").view("<i8"))
+        start, replaced = 0, 0
+        if self._end:
+            last = self._index[(self._end - 1) % self.capacity]
+            start = int(np.searchsorted(index, last, side="left"))
+            if start < len(index) and index[start] == last:
+                self._end, replaced = self._end - 1, 1      # Replace the last (possibly incomplete) bar
+                self._flushed = min(self._flushed, self._end)
+        index = index[start:]
+        new = len(index) - replaced
+        if len(index) > self.capacity:
+            start, index = start + len(index) - self.capacity, index[-self.capacity:]
+        positions = (self._end + np.arange(len(index))) % self.capacity
+        self._index[positions] = index
+        for values, col in zip(self._values, self.columns):
+            values[positions] = data[col].values[start:]
+        self._end += len(index)
+        return new
+
+    def latest(self, n=None):
+        """DataFrame with the last n bars (all the buffered ones by default)"""
+        n = len(self) if n is None else min(n, len(self))
+        positions = np.arange(self._end - n, self._end) % self.capacity
+        index = pd.DatetimeIndex(self._index[positions].view("datetime64[ns]"), name=INDEX_NAME)
+        return pd.DataFrame({col: values[positions] for col, values in zip(self.columns, self._values)}, index=index)
+
+    def take_pending(self):
+        """Bars to flush (marked as flushed)"""
+        data = self.latest(self.pending)
+        self._flushed = self._end
+        return data
+
+
+def partition_file(symbol, category, day):
+    """data/<SYMBOL>/stock_data_<category>/<YYYY-MM-DD>.<ext>"""
+    _, file_name = build_path_and_file(symbol, category)
+    folder = file_name.with_suffix("")
+    folder.mkdir(exist_ok=True)
+    return folder.joinpath(f"{pd.Timestamp(day):%Y-%m-%d}{file_name.suffix}")
+
+
+def write_partitions(symbol, category, data):
+    """Append the bars to the file of their day. Returns the files written"""
+    files = []
+    for day, bars in data.groupby(data.index.normalize()):
+        file_name = partition_file(symbol, category, day)
+        backend_for(file_name).append(file_name, bars, start=bars.index[0])
+        files.append(file_name)
+    return files
+
+
+def read_partitions(symbol, category, start=None, end=None):
+    """Stored bars between two dates (the whole history by default) or None"""
+    _, file_name = build_path_and_file(symbol, category)
+    folder = file_name.with_suffix("")
+    first, last = (None if ts is None else f"{pd.Timestamp(ts):%Y-%m-%d}" for ts in (start, end))
+    files = sorted(f for f in folder.glob(f"*{file_name.suffix}")
+                   if (first is None or f.stem >= first) and (last is None or f.stem <= last)) if folder.exists() else []
+    if not files:
+        return None
+    data = pd.concat([backend_for(f).read(f) for f in files], axis=0)
+    return data.loc[pd.Timestamp(start) if start else None:pd.Timestamp(end) if end else None]
+
+
+def _series_key(symbol, category):
+    return (tuple(symbol) if isinstance(symbol, (list, tuple)) else symbol), category.lower()
+
+
+class IntradayCache:
+    """Ring buffer of every (symbol, category) of the watchlist"""
+
+    def __init__(self, capacity=INTRADAY_BUFFER_SIZE):
+        self.capacity = capacity
+        self._buffers = {}
+
+    def buffer(self, symbol, category):
+        return self._buffers.get(_series_key(symbol, category))
+
+    def update(self, symbol, category, data):
+        """Add the received bars (returns the new ones). Pending bars are flushed before being overwritten"""
+        key = _series_key(symbol, category)
+        if key not in self._buffers:
+            self._buffers[key] = RingBuffer.like(data, capacity=self.capacity)
+        buffer = self._buffers[key]
+        new = 0
+        for start in range(0, len(data), self.capacity):
+            bars = data.iloc[start:start + self.capacity]
+            if buffer.pending + len(bars) > self.capacity:
+                self.flush(symbol, category)
+            new += buffer.extend(bars)
+        return new
+
+    def latest(self, symbol, category, n=None):
+        """Last n bars in memory (None if the series is not watched)"""
+        buffer = self.buffer(symbol, category)
+        return None if buffer is None else buffer.latest(n)
+
+    def flush(self, symbol=None, category=None):
+        """Write the pending bars of one series (every series by default). Returns the files written"""
+        keys = list(self._buffers) if symbol is None else [_series_key(symbol, category)]
+        files = []
+        for key in keys:
+            buffer = self._buffers.get(key)
+            if buffer is not None and buffer.pending:
+                files.extend(write_partitions(*key, buffer.take_pending()))
+        return files
+
+
+live_cache = IntradayCache()
+
+
+def latest_bars(symbol, category="intraday_5min", n=None, cache=None):
+    """Latest bars of a watched series, from memory"""
+    return (live_cache if cache is None else cache).latest(symbol, category, n)
+
+
+def interval_seconds(category):
+    interval = intraday_interval(category)
+    if interval is None:
+        raise ValueError(f"{category} is not an intraday category")
+    return 60 * int(interval[:-len("min")])
+
+
+def answer_bars(answer):
+    """DataFrame of bars of a streamed (VantageResponse) or plain answer (None for errors and notes)"""
+    if isinstance(answer, VantageResponse):
+        return answer.data
+    if is_vantage_data(answer) and answer:
+        _, dat = process_vantage_data(answer)
+        data = clean_pandas_data(dat)
+        data.index = pd.DatetimeIndex(pd.to_datetime(data.index), name=INDEX_NAME)
+        return data.apply(pd.to_numeric)
+    return None
+
+
+def poll_period(symbols, category, api=None):
+    """Seconds between refreshes: the bar interval, or longer if the quota does not allow a request per bar"""
+    budget = len(symbols) * 60 / calls_per_minute([category], api=api)
+    return max(interval_seconds(category), budget)
+
+
+async def poll_watchlist(symbols, category="intraday_5min", rounds=None, period=None, cache=None, api=None,
+                         verbose=VERBOSE):
+    """
+    Refresh the bars of the watchlist every period seconds (by default poll_period) and flush them to disk.
+    :param rounds: number of refreshes (None: forever)
+    """
+    cache = live_cache if cache is None else cache
+    budget = poll_period(symbols, category, api=api)
+    if period is not None and period < budget:
+        LOG.warning(f"WARNING: {len(symbols)} symbols cannot be refreshed every {period}s within the quota. "
+                    f"Polling every {budget:.0f}s")
+    period = budget if period is None else max(period, budget)
+
+    done = 0
+    while rounds is None or done < rounds:
+        start = time.monotonic()
+        answers = await asyncio.gather(*(query_data(symbol, category=category, api=api, stream=True, verbose=verbose,
+                                                    outputsize="compact", datatype=VANTAGE_DATATYPE)
+                                         for symbol in symbols), return_exceptions=True)
+        for symbol, answer in zip(symbols, answers):
+            data = None if isinstance(answer, BaseException) else answer_bars(answer)
+            if data is None or data.empty:
+                LOG.warning(f"Polling {symbol}:{get_tabs(symbol, prev=10)}No bars received")
+                continue
+            new = cache.update(symbol, category, data)
+            if verbose > 1:
+                LOG.info(f"Polling {symbol}:{get_tabs(symbol, prev=10)}{new} new bars")
+        cache.flush()
+        done += 1
+        if rounds is None or done < rounds:
+            await asyncio.sleep(max(0.0, period - (time.monotonic() - start)))
+    return cache
+
+
+def watch(symbols, category="intraday_5min", rounds=None, period=None, api=None, verbose=VERBOSE):
+    """Run the polling loop of the watchlist (see poll_watchlist)"""
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(poll_watchlist(symbols, category=category, rounds=rounds, period=period, api=api,
+                                                  verbose=verbose))
@@ -9,6 +9,9 @@ Main page:   https://www.myallies.com/
 
 
 MY_ALLIES_URI = "https://myallies-breaking-news-v1.p.rapidapi.com"
+MY_ALLIES_HOST = "myallies-breaking-news-v1.p.rapidapi.com"
+MYALLIES_CATEGORIES = ("top-news", "topnews", "top_news", "news", "last-price", "last-value", "lastprice",
+                       "lastvalue")
 
 
 def get_api_function(category):
@@ -26,23 +29,31 @@ def get_api_function(category):
     return function
 
 
-def myallies_query(symbol, category, key=None):
-    url = MY_ALLIES_URI
+def myallies_query(symbol, category, key=None, **kwargs):
+    """Returns the url, the parameters and the (RapidAPI) headers of the query"""
     category = category.lower()
-
-    if category == "news":
-        # Retrieval of news
-        function = get_api_function(category)
-        params = {}
-
-
-    elif category == "sector":
-        function = get_api_function(category)
-        params = {"function": function, "apikey": key}
-
+    function = get_api_function(category)
+
+    if function == "GetTopNews":
+        # Retrieval of the top news (no symbol)
+        url, params = f"{MY_ALLIES_URI}/{function}", {}
+    elif function == "news":
+        # Retrieval of the news of a company
+        url, params = f"{MY_ALLIES_URI}/{function}/{symbol}", {}
     else:
-        raise Exception(f"Category {category} not found")
+        # Retrieval of the company details (including the last price)
+        url, params = f"{MY_ALLIES_URI}/{function}", {"symbol": symbol}
 
+    headers = {"x-rapidapi-host": MY_ALLIES_HOST, "x-rapidapi-key": key}
     # Use extra parameters provided
-    params = {**params}
-    return url, params
\ No newline at end of file
+    params = {**params, **kwargs}
+    return url, params, headers
+
+
+def manage_myallies_errors(response, status):
+    """RapidAPI answers 429 (with a message) when the plan quota is exceeded"""
+    if status == 429:
+        return "longWait"
+    if status != 200 or (isinstance(response, dict) and "message" in response):
+        return "error"
+    return None
@@ -0,0 +1,127 @@
+"""
+#########################   Offload   #########################
+Bounded process pool for the CPU-heavy steps of the updates
+
+Parsing the answers, merging the tail and serializing the data files run in
+PROCESS_WORKERS worker processes, so the event loop keeps receiving the other
+responses meanwhile. At most 2 jobs per worker are in flight (the arguments of
+the queued ones are already pickled in memory). With PROCESS_WORKERS=0 the
+steps run inline on the loop, as before.
+
+metrics tracks the seconds of every step spent on the loop thread (on_loop),
+in the workers (off_loop) and awaiting a worker (wait: the worker time plus
+the queue and the pickling of arguments and results). Every call is also
+observed in the pythia_step_seconds histogram of src.telemetry.
+###############################################################
+"""
+import time
+import asyncio
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from src.config import PROCESS_WORKERS
+from src.telemetry import REGISTRY
+
+
+class LoopMetrics:
+    def __init__(self, clock=time.perf_counter, registry=None):
+        self._clock = clock
+        self._steps = {}
+        self._histogram = None
+        if registry is not None:
+            self._histogram = registry.histogram("pythia_step_seconds", "Seconds of the parse, save, read... steps",
+                                                 ("step", "where"))
+
+    def _step(self, name):
+        return self._steps.setdefault(name, {"calls": 0, "on_loop": 0.0, "off_loop": 0.0, "wait": 0.0})
+
+    def add(self, name, on_loop=0.0, off_loop=0.0, wait=0.0):
+        step = self._step(name)
+        step["calls"] += 1
+        step["on_loop"] += on_loop
+        step["off_loop"] += off_loop
+        step["wait"] += wait
+        if self._histogram is not None:
+            if on_loop or not off_loop:
+                self._histogram.observe(on_loop, step=name, where="on_loop")
+            if off_loop:
+                self._histogram.observe(off_loop, step=name, where="off_loop")
+                self._histogram.observe(wait, step=name, where="wait")
+
+    @contextmanager
+    def on_loop(self, name):
+        """Time a synchronous step run on the loop thread"""
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.add(name, on_loop=self._clock() - start)
+
+    def stats(self):
+        return {name: {key: round(value, 6) if isinstance(value, float) else value for key, value in step.items()}
+                for name, step in self._steps.items()}
+
+    def table(self):
+        """DataFrame with one row per step and the totals"""
+        table = pd.DataFrame.from_dict(self._steps, orient="index", columns=["calls", "on_loop", "off_loop", "wait"])
+        if not table.empty:
+            table.loc["total"] = table.sum()
+        return table
+
+    def reset(self):
+        self._steps = {}
+
+
+metrics = LoopMetrics(registry=REGISTRY)
+_in_flight = REGISTRY.gauge("pythia_offload_in_flight", "Steps sent to the process pool and not finished yet")
+_pool, _slots = None, None
+
+
+def _timed_call(func, args, kwargs):
+    """Run in the worker: result and seconds spent"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def get_pool():
+    """The process pool (created on first use; None if disabled)"""
+    global _pool
+    if PROCESS_WORKERS <= 0:
+        return None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool():
+    global _pool, _slots
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+    _pool, _slots = None, None
+
+
+async def run_off_loop(name, func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) in the process pool and await its result (inline on the loop if disabled).
+    func and its arguments must be picklable (module level functions, DataFrames, paths...)
+    """
+    global _slots
+    pool = get_pool()
+    if pool is None:
+        with metrics.on_loop(name):
+            return func(*args, **kwargs)
+
+    loop = asyncio.get_event_loop()
+    if _slots is None or _slots[1] is not loop:
+        _slots = asyncio.Semaphore(2 * PROCESS_WORKERS), loop
+    async with _slots[0]:
+        start = time.perf_counter()
+        _in_flight.inc()
+        try:
+            result, elapsed = await loop.run_in_executor(pool, _timed_call, func, args, kwargs)
+        finally:
+            _in_flight.dec()
+        metrics.add(name, off_loop=elapsed, wait=time.perf_counter() - start)
+    return result
@@ -1,13 +1,14 @@
 import re
 import pandas as pd
-from src.config import DATA_FOLDER, DFT_CRIPTO_PREFIX, DFT_INFO_FILE, DFT_INFO_EXT, VERBOSE, share_parameters, fx_parameters, crypto_parameters
-from src.api_manager import gather_info, retrieve_stock_list
+from src.config import DATA_FOLDER, DFT_CRIPTO_PREFIX, VERBOSE, share_parameters, fx_parameters, crypto_parameters
+from src.api_manager import catalog
+from src.scheduler import (update_groups, STOCK_CATEGORIES, FX_CATEGORIES, CRYPTO_CATEGORIES,
+                           DERIVED_STOCK_CATEGORIES, DERIVED_FX_CATEGORIES, DERIVED_CRYPTO_CATEGORIES)
 from src.utils import LOG
 
 
 currency_regex = re.compile(r"\A[A-Z]{3}_[A-Z]{3}")
 crypto_regex = re.compile(r"\A" + DFT_CRIPTO_PREFIX + r"[A-Z]{3,4}_[A-Z]{3}")
-info_data_pattern = DFT_INFO_FILE + r"*" + DFT_INFO_EXT
 FX_UPDATES = (
     ["GBP", "EUR"],
     ["GBP", "USD"],
@@ -68,50 +69,54 @@ def get_crypto_references():
     return crypto_names, crypto_folders
 
 
-def update_all_stock_data(stocks=None, gap=7, verbose=VERBOSE):
-    """Get all existing stocks and update their info"""
+def stock_group(stocks=None):
     if stocks is None:
         stocks, _ = get_share_references()
     validate_list(stocks)
-
-    retrieve_stock_list(stocks, category="daily", gap=gap, verbose=verbose)
-    retrieve_stock_list(stocks, category="monthly", gap=gap, verbose=verbose)
-    retrieve_stock_list(stocks, category="daily-adjusted", gap=gap, verbose=verbose)
-    retrieve_stock_list(stocks, category="monthly-adjusted", gap=gap, verbose=verbose)
-    LOG.info("Stocks update finished!")
+    return stocks, STOCK_CATEGORIES, DERIVED_STOCK_CATEGORIES
 
 
-def update_all_fx_data(fx_pairs=None, gap=7, verbose=VERBOSE, v=None):
-    """Get all existing currencies and update their info"""
-    verbose = verbose if v is None else v
+def fx_group(fx_pairs=None):
     if fx_pairs is None:
         fx_pairs, _ = get_fx_references()
     # Validation
     validate_list(fx_pairs)
     validate_list(fx_pairs[0])
-    # Retrieval
-    retrieve_stock_list(fx_pairs, category="fx_daily", gap=gap, verbose=verbose)
-    retrieve_stock_list(fx_pairs, category="fx_monthly", gap=gap, verbose=verbose)
-    LOG.info("FX update finished!")
+    return fx_pairs, FX_CATEGORIES, DERIVED_FX_CATEGORIES
 
 
-def update_all_crypto_data(crypto_pairs=None, gap=7, verbose=VERBOSE):
-    """Get all existing cryptocurrencies and update their info"""
+def crypto_group(crypto_pairs=None):
     if crypto_pairs is None:
         crypto_pairs, _ = get_crypto_references()
     validate_list(crypto_pairs)
     validate_list(crypto_pairs[0])
+    return crypto_pairs, CRYPTO_CATEGORIES, DERIVED_CRYPTO_CATEGORIES
+
+
+def update_all_stock_data(stocks=None, gap=7, verbose=VERBOSE):
+    """Get all existing stocks and update their info"""
+    update_groups([stock_group(stocks)], gap=gap, verbose=verbose)
+    LOG.info("Stocks update finished!")
+
+
+def update_all_fx_data(fx_pairs=None, gap=7, verbose=VERBOSE, v=None):
+    """Get all existing currencies and update their info"""
+    verbose = verbose if v is None else v
+    update_groups([fx_group(fx_pairs)], gap=gap, verbose=verbose)
+    LOG.info("FX update finished!")
 
-    retrieve_stock_list(crypto_pairs, category="digital_daily", gap=gap, verbose=verbose)
-    retrieve_stock_list(crypto_pairs, category="digital_monthly", gap=gap, verbose=verbose)
+
+def update_all_crypto_data(crypto_pairs=None, gap=7, verbose=VERBOSE):
+    """Get all existing cryptocurrencies and update their info"""
+    update_groups([crypto_group(crypto_pairs)], gap=gap, verbose=verbose)
     LOG.info("Crypto update finished!")
 
 
 def update_all(gap=3, verbose=VERBOSE, v=None):
+    """Update stocks, currencies and cryptocurrencies in a single run (most outdated first)"""
     verbose = verbose if v is None else v
-    update_all_stock_data(gap=gap, verbose=verbose)
-    update_all_fx_data(gap=gap, verbose=verbose)
-    update_all_crypto_data(gap=gap, verbose=verbose)
+    progress = update_groups([stock_group(), fx_group(), crypto_group()], gap=gap, verbose=verbose)
+    LOG.info(f"Update finished! {progress}")
 
 
 def test_update_crypto():
@@ -123,42 +128,32 @@ def map_field(array, field):
     return [x.get(field, None) for x in array]
 
 
+def catalog_series(kind, verbose=VERBOSE):
+    """Series of the catalog of the given kind (the catalog is built on first use)"""
+    if catalog.is_empty():
+        catalog.rebuild(verbose=verbose)
+    return catalog.series(kind=kind)
+
+
 def get_fx_table(mode="fx", verbose=VERBOSE, v=None):
     verbose = verbose if v is None else v
-    if mode == "fx":
-        id_refs, id_folders = get_fx_references()
-    elif mode == "crypto":
-        id_refs, id_folders = get_crypto_references()
-    else:
+    if mode not in ("fx", "crypto"):
         raise ValueError(f"Invalid mode {mode}. Valid modes include 'fx' and 'crypto'")
-    return __create_table(zip(id_folders, id_refs), variant=mode, verbose=verbose)
-
-
-def __create_table(refs, variant="fx", verbose=VERBOSE):
-    rows = []
-    for id_folder, id_refs in refs:
-        if isinstance(id_refs, (list, tuple)):
-            from_fx, to_fx = id_refs
-        else:
-            from_fx, to_fx = id_refs.split("_")
-        info_files = list(id_folder.glob(info_data_pattern))
+    return __create_table(catalog_series(mode, verbose=verbose), variant=mode)
 
-        if info_files:
-            for info_ref in info_files:
-                rows.append((from_fx, to_fx, info_ref))
-        else:
-            rows.append((from_fx, to_fx, None))
 
+def __create_table(series, variant="fx"):
     if variant == "fx":
         parameters = fx_parameters
+        pairs = [row["folder"].split("_") for row in series]
     elif variant == "crypto":
         parameters = crypto_parameters
+        pairs = [row["folder"][len(DFT_CRIPTO_PREFIX):].split("_") for row in series]
 
-    # Read info from files
-    info = gather_info(map(lambda x: x[2], rows), verbose=verbose)
-    table_dict = {"From": list(map(lambda x: x[0], rows)),
-                  "To": list(map(lambda x: x[1], rows)),
-                  "Period": list(map(lambda x: x[2].stem.split("_")[-1], rows)),
+    info = [row["info"] for row in series]
+    table_dict = {"From": [pair[0] for pair in pairs],
+                  "To": [pair[1] for pair in pairs],
+                  "Period": [row["period"].split("_")[-1] for row in series],
                   **{val: map_field(info, key) for key, val in parameters.items()}}
 
     table = pd.DataFrame(table_dict)
@@ -171,21 +166,11 @@ def get_shares_table(verbose=0, v=None):
     :return: table
     """
     verbose = verbose if v is None else v
-    rows = []
-    for share, id_folder in zip(*get_share_references()):
-        info_files = list(id_folder.glob(info_data_pattern))
-
-        if info_files:
-            for info_ref in info_files:
-                rows.append((share, info_ref))
-        else:
-            rows.append((share, None))
-
-    # Read info from files
-    info = gather_info(map(lambda x: x[1], rows), verbose=verbose)
+    series = catalog_series("stock", verbose=verbose)
+    info = [row["info"] for row in series]
     table_dict = {
-        "Symbol": list(map(lambda x: x[0], rows)),
-        "Period": list(map(lambda x: x[1].stem.split("_")[-1], rows)),
+        "Symbol": [row["folder"] for row in series],
+        "Period": [row["period"] for row in series],
         **{val: map_field(info, key) for key, val in share_parameters.items()}}
 
     table = pd.DataFrame(table_dict)
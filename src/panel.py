@@ -0,0 +1,159 @@
+"""
+#########################   Panel   #########################
+Aligned (dates x symbols) matrices for a group of symbols
+
+The panel is built once from the stored data files and cached as .npy files under
+CACHE_FOLDER. It is opened memory-mapped (read-only), so every process loading
+the same universe shares the same pages. The cache is rebuilt only when one of
+the source files changes (mtime/size).
+#############################################################
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from src.config import CACHE_FOLDER, INFO_VATIATIONS, VERBOSE
+from src.api_manager import build_path_and_file, read_pandas_data
+from src.storage import backend_for
+from src.utils import LOG
+
+
+PANEL_FOLDER = CACHE_FOLDER.joinpath("panels")
+DFT_FIELDS = ("open", "high", "low", "close", "volume")
+
+
+def symbol_label(symbol):
+    """Column label of a symbol: 'AMZN' or 'GBP_USD' for pairs"""
+    return symbol if isinstance(symbol, str) else "_".join(symbol)
+
+
+def file_signature(file_name):
+    if not file_name.exists():
+        return [file_name.as_posix(), None, None]
+    stat = file_name.stat()
+    return [file_name.as_posix(), stat.st_mtime_ns, stat.st_size]
+
+
+class Panel:
+    """
+    Aligned price matrices: values[field] is a float64 array of shape (dates, symbols).
+    Missing observations are NaN.
+    """
+
+    def __init__(self, dates, symbols, fields, values, build=None):
+        self.dates = dates
+        self.symbols = symbols
+        self.fields = fields
+        self.values = values            # 3-D array (fields, dates, symbols), usually a read-only memmap
+        self.build = build              # Version of the source files the panel was built from
+
+    def __getitem__(self, field):
+        return self.values[self.fields.index(field)]
+
+    def __repr__(self):
+        return f"Panel({len(self.dates)} dates x {len(self.symbols)} symbols, fields={self.fields})"
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def frame(self, field):
+        """DataFrame view (dates x symbols) of one field"""
+        return pd.DataFrame(self[field], index=self.dates, columns=self.symbols, copy=False)
+
+
+def build_panel_arrays(files, fields):
+    """Read the files and align them over the union of their dates"""
+    frames = []
+    for file_name in files:
+        if not file_name.exists():
+            LOG.warning(f"WARNING: No data for {file_name}. Filled with NaN")
+            frames.append(None)
+            continue
+        available = [f for f in fields if f in backend_for(file_name).columns(file_name)]
+        frames.append(read_pandas_data(file_name, columns=available))
+
+    indexes = [frame.index.values.astype("datetime64[ns]") for frame in frames if frame is not None]
+    dates = np.unique(np.concatenate(indexes)) if indexes else np.empty(0, dtype="datetime64[ns]")
+    values = np.full((len(fields), len(dates), len(files)), np.nan, dtype="<f8")
+    for j, frame in enumerate(frames):
+        if frame is None:
+            continue
+        rows = np.searchsorted(dates, frame.index.values.astype("datetime64[ns]"))
+        for name in frame.columns:
+            values[fields.index(name), rows, j] = frame[name].values
+    return dates, values
+
+
+def concat_panels(panels):
+    """Panels side by side (symbols concatenated) over the union of their dates. The values are in memory"""
+    dates = np.unique(np.concatenate([panel.dates.values.astype("datetime64[ns]") for panel in panels]))
+    fields = panels[0].fields
+    values = np.full((len(fields), len(dates), sum(len(panel.symbols) for panel in panels)), np.nan, dtype="<f8")
+    column = 0
+    for panel in panels:
+        rows = np.searchsorted(dates, panel.dates.values.astype("datetime64[ns]"))
+        values[:, rows, column:column + len(panel.symbols)] = panel.values
+        column += len(panel.symbols)
+    return Panel(pd.DatetimeIndex(dates, name="date"), [s for panel in panels for s in panel.symbols], fields, values)
+
+
+def _write_array(file_name, array):
+    """Write an .npy file atomically"""
+    tmp_file = file_name.with_name(f"{file_name.name}.{os.getpid()}.tmp")
+    with open(tmp_file, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_file, file_name)
+
+
+def load_panel(symbols, period="daily", fields=DFT_FIELDS, rebuild=False, verbose=VERBOSE):
+    """
+    Load an aligned panel (dates x symbols) for every field.
+    :param symbols: list of symbols (stocks) or pairs (fx/crypto)
+    :param period:  daily, monthly... (same values as load_shares_data)
+    :param fields:  columns to load (open, high, low, close, volume, ...)
+    :param rebuild: force the rebuild of the cached panel
+    :return: Panel backed by memory-mapped arrays
+    """
+    if isinstance(symbols, (str, tuple)):
+        symbols = [symbols]         # A single stock or a single (from, to) pair
+    if period not in INFO_VATIATIONS and not period.startswith(("fx", "digital")):
+        raise ValueError(f"The period {period} is not supported. Please select one among {INFO_VATIATIONS}")
+    fields = list(fields)
+    labels = [symbol_label(symbol) for symbol in symbols]
+    files = [build_path_and_file(symbol, period)[1] for symbol in symbols]
+    signatures = [file_signature(file_name) for file_name in files]
+
+    key = hashlib.sha1(json.dumps([period, labels, fields]).encode()).hexdigest()[:16]
+    build_id = hashlib.sha1(json.dumps(signatures).encode()).hexdigest()[:16]
+    PANEL_FOLDER.mkdir(parents=True, exist_ok=True)
+    manifest_file = PANEL_FOLDER.joinpath(key + ".json")
+    values_file = PANEL_FOLDER.joinpath(f"{key}-{build_id}.values.npy")
+    dates_file = PANEL_FOLDER.joinpath(f"{key}-{build_id}.dates.npy")
+
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+    if rebuild or manifest.get("build") != build_id or not values_file.exists() or not dates_file.exists():
+        if verbose > 1:
+            LOG.info(f"Building panel {key}:\t{len(labels)} symbols [{period}] {fields}")
+        dates, values = build_panel_arrays(files, fields)
+        _write_array(dates_file, dates)
+        _write_array(values_file, values)
+        old_build = manifest.get("build")
+        manifest = {"build": build_id, "period": period, "symbols": labels, "fields": fields, "sources": signatures}
+        tmp_manifest = manifest_file.with_name(f"{manifest_file.name}.{os.getpid()}.tmp")
+        tmp_manifest.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_manifest, manifest_file)
+        if old_build and old_build != build_id:
+            # Processes that already mapped the old files keep their pages until they close them
+            for old_file in PANEL_FOLDER.glob(f"{key}-{old_build}.*.npy"):
+                old_file.unlink()
+
+    dates = pd.DatetimeIndex(np.load(dates_file), name="date")
+    values = np.load(values_file, mmap_mode="r")
+    return Panel(dates, labels, fields, values, build=build_id)
+
+
+if __name__ == "__main__":
+    panel = load_panel(["AMZN", "GOOG", "MMM"], period="daily", fields=["close", "volume"])
+    print(panel, panel.frame("close").tail())
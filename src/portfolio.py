@@ -0,0 +1,174 @@
+"""
+#########################   Portfolio   #########################
+Daily valuation of the holdings of several accounts (ISA, SIPP...)
+
+The ledger lists every trade: date, account, symbol, quantity (negative to
+sell), price and fees (in the currency of the symbol, the close of the day
+if no price is given). Crypto pairs are written as BTC_GBP.
+
+Positions are the cumulative sum of the trades over the dates of the close
+panel in base currency (see src.currency), so NAV, flows, P&L, time-weighted
+returns and drawdowns of every account (and the total) are vectorized over
+the date axis. Buys are flows in at the start of the day and sells flows out
+at the end of it: r = (NAV - outflow) / (previous NAV + inflow) - 1.
+
+The state after the last valued date (positions, last prices, invested
+amount, NAV, return index and peak) is kept, so new bars or new trades after
+it only value the new dates.
+#################################################################
+"""
+import re
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from src.currency import load_converted, rate_cache, symbol_currency
+
+
+pair_regex = re.compile(r"\A([A-Z0-9]{2,5})_([A-Z]{3})\Z")
+LEDGER_COLUMNS = ["date", "account", "symbol", "quantity", "price", "fees"]
+METRICS = ("nav", "flows", "pnl", "returns", "twr", "drawdown")
+State = namedtuple("State", ["date", "positions", "prices", "invested", "nav", "index", "peak"])
+
+
+def ledger_symbol(symbol):
+    """'AMZN' -> 'AMZN', 'BTC_GBP' -> ('BTC', 'GBP')"""
+    match = pair_regex.match(symbol)
+    return match.groups() if match else symbol
+
+
+def read_ledger(ledger):
+    """Ledger from a csv file or a DataFrame, sorted by date (price and fees are optional)"""
+    data = pd.read_csv(ledger) if not isinstance(ledger, pd.DataFrame) else ledger.copy()
+    missing = [column for column in LEDGER_COLUMNS[:4] if column not in data.columns]
+    if missing:
+        raise ValueError(f"The ledger has no {missing} columns. Expected columns: {LEDGER_COLUMNS}")
+    for column in ("price", "fees"):
+        data[column] = data[column].astype(float) if column in data.columns else np.nan
+    data["date"] = pd.to_datetime(data["date"])
+    data["account"] = data["account"].astype(str)
+    return data[LEDGER_COLUMNS].sort_values("date", kind="stable").reset_index(drop=True)
+
+
+def forward_fill(values, last=None):
+    """Fill the NaN of every column with its previous value (starting from the `last` row if given)"""
+    if last is not None:
+        values = np.vstack((last, values))
+    rows = np.where(np.isnan(values), 0, np.arange(len(values))[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    filled = values[rows, np.arange(values.shape[1])]
+    return filled[1:] if last is not None else filled
+
+
+class Portfolio:
+    """
+    :param ledger: csv file or DataFrame (see read_ledger)
+    :param base:   currency of the valuation
+    :param period: series valued (daily, weekly or monthly bars)
+    """
+
+    def __init__(self, ledger, base="GBP", period="daily"):
+        self.ledger = read_ledger(ledger)
+        self.base = base
+        self.period = period
+        self.symbols = list(dict.fromkeys(self.ledger["symbol"]))
+        self.accounts = list(dict.fromkeys(self.ledger["account"]))
+        self.dates = pd.DatetimeIndex([], name="date")
+        self._values = {metric: np.empty((0, len(self.accounts) + 1)) for metric in METRICS}
+        self.state = None
+
+    def load(self):
+        """Close panel of the symbols in base currency and the rates of their own currencies"""
+        symbols = [ledger_symbol(symbol) for symbol in self.symbols]
+        panel = load_converted(symbols, base=self.base, period=self.period, fields=["close"])
+        currencies = [symbol_currency(symbol, self.period) for symbol in symbols]
+        return panel.dates, panel["close"], rate_cache.matrix(panel.dates.values, currencies, self.base)
+
+    def empty_state(self):
+        accounts, symbols = len(self.accounts), len(self.symbols)
+        return State(None, np.zeros((accounts, symbols)), np.full(symbols, np.nan), np.zeros(accounts + 1),
+                     np.zeros(accounts + 1), np.ones(accounts + 1), np.ones(accounts + 1))
+
+    def add_trades(self, trades):
+        """Add trades to the ledger. Trades after the last valued date keep the state, older ones reset it"""
+        trades = read_ledger(trades)
+        unknown = set(trades["symbol"]) - set(self.symbols) or set(trades["account"]) - set(self.accounts)
+        if self.state is not None and (unknown or trades["date"].min() <= self.state.date):
+            self.state = None
+        self.ledger = read_ledger(pd.concat((self.ledger, trades), ignore_index=True))
+        self.symbols = list(dict.fromkeys(self.ledger["symbol"]))
+        self.accounts = list(dict.fromkeys(self.ledger["account"]))
+
+    def value(self, dates=None, close=None, rates=None):
+        """Value every date from scratch (the panel is loaded if not given)"""
+        self.state = None
+        return self.update(dates, close, rates)
+
+    def update(self, dates=None, close=None, rates=None):
+        """Value the dates after the last valued one (every date if there is no state)"""
+        if dates is None:
+            dates, close, rates = self.load()
+        if self.state is None:
+            self.state = self.empty_state()
+            self.dates = pd.DatetimeIndex([], name="date")
+            self._values = {metric: np.empty((0, len(self.accounts) + 1)) for metric in METRICS}
+        start = 0 if self.state.date is None else dates.searchsorted(self.state.date, side="right")
+        if start >= len(dates):
+            return self
+        values, self.state = self.value_rows(dates[start:], np.asarray(close)[start:], np.asarray(rates)[start:],
+                                             self.state)
+        self.dates = self.dates.append(dates[start:])
+        for metric in METRICS:
+            self._values[metric] = np.vstack((self._values[metric], values[metric]))
+        return self
+
+    def value_rows(self, dates, close, rates, state):
+        """Metrics of some consecutive dates following the state. Returns (dict of arrays, new state)"""
+        rows, accounts, symbols = len(dates), len(self.accounts), len(self.symbols)
+        trades = self.ledger[self.ledger["date"] > state.date] if state.date is not None else self.ledger
+        # Trades on a non trading day go to the next date (the ones after the last date wait for new bars)
+        row = dates.searchsorted(trades["date"].values)
+        trades, row = trades[row < rows], row[row < rows]
+        account = trades["account"].map(self.accounts.index).to_numpy(dtype=int)
+        symbol = trades["symbol"].map(self.symbols.index).to_numpy(dtype=int)
+        quantity = trades["quantity"].to_numpy(dtype="<f8")
+
+        prices = forward_fill(close, last=state.prices)
+        trade_price = np.where(trades["price"].isna(), prices[row, symbol],
+                               trades["price"].to_numpy() * rates[row, symbol])
+        amount = quantity * trade_price + trades["fees"].fillna(0).to_numpy() * rates[row, symbol]
+        if np.isnan(amount).any():
+            raise ValueError(f"No price for the trades of {trades[np.isnan(amount)]['symbol'].unique().tolist()}")
+
+        changes = np.zeros((rows, accounts, symbols))
+        np.add.at(changes, (row, account, symbol), quantity)
+        positions = state.positions + np.cumsum(changes, axis=0)
+        nav = np.nansum(positions * np.where(positions != 0, prices[:, None, :], 0), axis=2)
+        flows = np.zeros((rows, accounts))
+        np.add.at(flows, (row, account), amount)
+        inflows = np.zeros((rows, accounts))
+        np.add.at(inflows, (row, account), np.maximum(amount, 0))
+        # Last column: every account together
+        nav, flows, inflows = (np.column_stack((x, x.sum(axis=1))) for x in (nav, flows, inflows))
+
+        previous = np.vstack((state.nav, nav[:-1]))
+        base = previous + inflows
+        with np.errstate(divide="ignore", invalid="ignore"):
+            returns = np.where(base > 0, (nav - (flows - inflows)) / base - 1, 0.0)
+        index = state.index * np.cumprod(1 + returns, axis=0)
+        peak = np.maximum.accumulate(np.vstack((state.peak, index)), axis=0)[1:]
+        invested = state.invested + np.cumsum(flows, axis=0)
+        values = {"nav": nav, "flows": flows, "pnl": nav - invested, "returns": returns, "twr": index - 1,
+                  "drawdown": index / peak - 1}
+        return values, State(dates[-1], positions[-1], prices[-1], invested[-1], nav[-1], index[-1], peak[-1])
+
+    def frame(self, metric):
+        """DataFrame (dates x accounts and total) of nav, flows, pnl, returns, twr or drawdown"""
+        if metric not in METRICS:
+            raise ValueError(f"Metric {metric} not supported. Please select one among {METRICS}")
+        return pd.DataFrame(self._values[metric], index=self.dates, columns=self.accounts + ["total"])
+
+    def summary(self):
+        """Last NAV, P&L, time-weighted return and max drawdown of every account"""
+        return pd.DataFrame({"nav": self._values["nav"][-1], "pnl": self._values["pnl"][-1],
+                             "twr": self._values["twr"][-1], "max drawdown": self._values["drawdown"].min(axis=0)},
+                            index=self.accounts + ["total"])
@@ -0,0 +1,154 @@
+"""
+#########################   Providers   #########################
+Registry of the data providers used by query_data
+
+Every provider declares how to build its queries, the categories it serves,
+its limits (max concurrent requests and quotas) and how to read and
+normalize its answers. A request may name several providers (or none: every
+provider serving the category); each attempt goes to the candidate with spare
+quota, so a throttled provider fails over to the others and the update
+throughput is the sum of their quotas.
+#################################################################
+"""
+from src.config import (KEYS_SET, PROCESS_WORKERS, VANTAGE_SEMAPHORE_LIMIT, VANTAGE_CALLS_PER_MINUTE,
+                        VANTAGE_CALLS_PER_DAY, MYALLIES_SEMAPHORE_LIMIT, MYALLIES_CALLS_PER_MINUTE, MYALLIES_CALLS_PER_DAY)
+from src.crawler_semaphore import SemaphoreController
+from src.alpha_vantage_api import alpha_vantage_query, manage_vantage_errors, is_vantage_data, VANTAGE_CATEGORIES
+from src.myallies_api import myallies_query, manage_myallies_errors, MYALLIES_CATEGORIES
+from src.ingest import VantageResponse, read_response
+
+
+class Provider:
+    """
+    :param name:       name used in query_data(api=...)
+    :param query:      function (symbol, category, key, **kwargs) -> (url, params, headers)
+    :param categories: categories served
+    :param limits:     (max concurrent requests, [(calls, period in seconds), ...])
+    :param key_name:   entry of keys.yml with the api key (the provider is unavailable without it)
+    :param check:      function (answer, status, symbol) -> "longWait" (throttled), "error" or None
+    :param valid:      function answer -> True if the answer can be cached
+    :param normalize:  function answer -> common format (VantageResponse(info, DataFrame) for time series)
+    :param stream:     time series answers can be parsed as a stream (see src.ingest)
+    """
+
+    def __init__(self, name, query, categories, limits, key_name=None, check=None, valid=None, normalize=None,
+                 stream=False):
+        self.name = name
+        self.query = query
+        self.categories = tuple(categories)
+        self.limits = limits
+        self.key_name = key_name
+        self.check = check or (lambda answer, status, symbol: None if status == 200 else "error")
+        self.valid = valid or (lambda answer: True)
+        self.normalize = normalize or (lambda answer: answer)
+        self.stream = stream
+
+    @property
+    def key(self):
+        return KEYS_SET.get(self.key_name) if self.key_name else None
+
+    @property
+    def available(self):
+        return self.key_name is None or bool(self.key)
+
+    @property
+    def calls_per_minute(self):
+        _, rates = self.limits
+        return min((calls * 60 / period for calls, period in rates), default=float("inf"))
+
+    def serves(self, category):
+        return category.lower() in self.categories
+
+    def build(self, symbol, category, **kwargs):
+        return self.query(symbol, category, key=self.key, **kwargs)
+
+    async def read(self, resp, params, stream=False, body_file=None):
+        """Parse the answer (as a stream when requested and supported, in a worker process if enabled)"""
+        if stream and self.stream:
+            return await read_response(resp, datatype=params.get("datatype", "json"), body_file=body_file,
+                                       offload=PROCESS_WORKERS > 0)
+        try:
+            return await resp.json(content_type=None)
+        except ValueError:
+            return {"message": await resp.text()}           # Plain text errors (e.g. quota exceeded)
+
+    def __repr__(self):
+        return f"Provider({self.name})"
+
+
+PROVIDERS = {}
+
+
+def register_provider(provider):
+    """Add a provider and declare its limits to the semaphore controller"""
+    PROVIDERS[provider.name] = provider
+    SemaphoreController().add_api(provider.name, *provider.limits)
+    return provider
+
+
+def unregister_provider(name):
+    """Remove a provider and its limits from the semaphore controller"""
+    SemaphoreController().remove_api(name)
+    return PROVIDERS.pop(name, None)
+
+
+def get_provider(name):
+    name = SemaphoreController.api_name(name)
+    if name not in PROVIDERS:
+        raise ValueError(f"Not supported api {name}. Please select one among {list(PROVIDERS)}")
+    return PROVIDERS[name]
+
+
+def providers_for(category, api=None):
+    """
+    Available providers serving the category, in order of preference.
+    :param api: provider name, list of names or None (every registered provider)
+    """
+    names = list(PROVIDERS) if api is None else [api] if isinstance(api, str) else list(api)
+    providers = [get_provider(name) for name in names]
+    candidates = [provider for provider in providers if provider.serves(category) and provider.available]
+    if not candidates:
+        raise ValueError(f"No available provider for category {category} among {names}")
+    return candidates
+
+
+def pick_provider(candidates):
+    """The candidate with spare quota (shortest wait); ties go to the first one"""
+    controller = SemaphoreController()
+    return min(candidates, key=lambda provider: controller.delay(provider.name))
+
+
+def concurrency(categories, api=None):
+    """Max concurrent requests over the providers serving any of the categories"""
+    return max((sum(provider.limits[0] for provider in providers_for(category, api=api))
+                for category in categories), default=1)
+
+
+def calls_per_minute(categories, api=None):
+    """Combined quota (calls per minute) of the providers serving the categories (the slowest category)"""
+    return min((sum(provider.calls_per_minute for provider in providers_for(category, api=api))
+                for category in categories), default=float("inf"))
+
+
+def _vantage_query(symbol, category, key=None, **kwargs):
+    url, params = alpha_vantage_query(symbol, category, key=key, **kwargs)
+    return url, params, {}
+
+
+def _vantage_check(answer, status, symbol):
+    if status == 429:
+        return "longWait"
+    return manage_vantage_errors(answer, symbol) if isinstance(answer, dict) else None
+
+
+register_provider(Provider(
+    "vantage", _vantage_query, VANTAGE_CATEGORIES,
+    (VANTAGE_SEMAPHORE_LIMIT, [(VANTAGE_CALLS_PER_MINUTE, 60), (VANTAGE_CALLS_PER_DAY, 24 * 60 * 60)]),
+    key_name="alpha_vantage", check=_vantage_check,
+    valid=lambda answer: isinstance(answer, VantageResponse) or is_vantage_data(answer), stream=True))
+
+register_provider(Provider(
+    "myallies", myallies_query, MYALLIES_CATEGORIES,
+    (MYALLIES_SEMAPHORE_LIMIT, [(MYALLIES_CALLS_PER_MINUTE, 60), (MYALLIES_CALLS_PER_DAY, 24 * 60 * 60)]),
+    key_name="myallies", check=lambda answer, status, symbol: manage_myallies_errors(answer, status),
+    valid=lambda answer: isinstance(answer, (dict, list)) and not (isinstance(answer, dict) and "message" in answer)))
@@ -0,0 +1,111 @@
+"""
+#########################   Resample   #########################
+Builds weekly/monthly bars from daily bars with numpy reductions
+
+Bars are labelled with the last trading day of the period (as the API does):
+open=first, high=max, low=min, close=last, volume=sum, dividends=sum,
+split coefficient=product. Only the periods from the last stored bar onwards
+are recomputed when new daily rows arrive.
+################################################################
+"""
+import numpy as np
+import pandas as pd
+
+
+PERIODS = ("weekly", "monthly")
+ADJUSTED_ONLY_COLUMNS = ("adjusted close", "dividend amount", "split coefficient")
+
+
+def base_name(column):
+    """'open (GBP)' -> 'open'"""
+    return column.split(" (")[0]
+
+
+def aggregation(column):
+    name = base_name(column)
+    if name == "open":
+        return "first"
+    elif name == "high":
+        return "max"
+    elif name == "low":
+        return "min"
+    elif name in ("volume", "dividend amount"):
+        return "sum"
+    elif name == "split coefficient":
+        return "prod"
+    else:
+        return "last"          # close, adjusted close, market cap...
+
+
+def period_keys(dates, period):
+    """Integer id of the week (starting on Monday) or month of every date"""
+    days = dates.values.astype("datetime64[D]").astype("int64")
+    if period == "weekly":
+        return (days + 3) // 7          # 1970-01-01 was a Thursday
+    elif period == "monthly":
+        return dates.values.astype("datetime64[M]").astype("int64")
+    raise ValueError(f"The period {period} is not supported. Please select one among {PERIODS}")
+
+
+def period_start(date, period):
+    """First day of the week/month containing date"""
+    date = pd.Timestamp(date).normalize()
+    if period == "weekly":
+        return date - pd.Timedelta(days=date.weekday())
+    return date.replace(day=1)
+
+
+def resample_bars(data, period):
+    """Aggregate a (sorted) daily DataFrame into weekly or monthly bars"""
+    if data.empty:
+        return data.copy()
+    keys = period_keys(data.index, period)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)] - 1
+
+    columns = {}
+    for column in data.columns:
+        values = data[column].values
+        how = aggregation(column)
+        if how == "first":
+            columns[column] = values[starts]
+        elif how == "last":
+            columns[column] = values[ends]
+        elif how == "max":
+            columns[column] = np.maximum.reduceat(values, starts)
+        elif how == "min":
+            columns[column] = np.minimum.reduceat(values, starts)
+        elif how == "sum":
+            columns[column] = np.add.reduceat(values, starts)
+        elif how == "prod":
+            columns[column] = np.multiply.reduceat(values, starts)
+    return pd.DataFrame(columns, index=data.index[ends], columns=data.columns)
+
+
+def resample_tail(daily, derived, period):
+    """
+    Update previously derived bars with new daily rows: the last stored period (possibly
+    incomplete) and the new ones are recomputed, the rest is kept as is.
+    """
+    if derived is None or derived.empty:
+        return resample_bars(daily, period)
+    cutoff = period_start(derived.index[-1], period)
+    tail = resample_bars(daily[daily.index >= cutoff], period)
+    return pd.concat((derived[derived.index < cutoff], tail[derived.columns]), axis=0)
+
+
+def select_columns(data, adjusted):
+    """Unadjusted series drop the adjustment columns; adjusted weekly/monthly series have no split coefficient"""
+    drop = ("split coefficient",) if adjusted else ADJUSTED_ONLY_COLUMNS
+    return data[[c for c in data.columns if c not in drop]]
+
+
+def derived_from(category):
+    """(source category, period or None, adjusted) used to derive a category locally"""
+    if category in ("daily", "weekly", "monthly", "weekly-adjusted", "monthly-adjusted"):
+        period = category.replace("-adjusted", "")
+        return "daily-adjusted", (None if period == "daily" else period), category.endswith("-adjusted")
+    for prefix in ("fx_", "digital_"):
+        if category in (prefix + "weekly", prefix + "monthly"):
+            return prefix + "daily", category[len(prefix):], False
+    raise ValueError(f"The category {category} can not be derived from other series")
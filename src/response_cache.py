@@ -0,0 +1,204 @@
+"""
+#########################   Response cache   #########################
+On-disk cache of API responses
+
+Entries are keyed on the hash of the normalized query parameters (without the
+api key), so the same request made by update_stock, search_symbol or
+update_info_with_search is served from disk while it is fresh. Freshness
+depends on the category (intraday, daily, weekly, monthly, search). Stale
+entries keep their ETag/Last-Modified headers to revalidate them with a
+conditional request. The folder is bounded in bytes (least recently used
+entries are evicted first). Streamed answers are stored as the raw body next
+to the entry (<key>.body) and returned as its path, to be parsed again as a
+stream.
+######################################################################
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+from src.config import (CACHE_FOLDER, RESPONSE_CACHE_MAX_BYTES, CACHE_TTL_INTRADAY, CACHE_TTL_DAILY,
+                        CACHE_TTL_WEEKLY, CACHE_TTL_MONTHLY, CACHE_TTL_SEARCH)
+from src.utils import LOG
+
+
+RESPONSES_FOLDER = CACHE_FOLDER.joinpath("responses")
+IGNORED_PARAMS = ("apikey",)
+
+
+def ttl_for(category):
+    """Seconds a response of the given category is considered fresh"""
+    category = category.lower()
+    if category == "search":
+        return CACHE_TTL_SEARCH
+    elif "intraday" in category:
+        return CACHE_TTL_INTRADAY
+    elif "weekly" in category or "keekly" in category:
+        return CACHE_TTL_WEEKLY
+    elif "monthly" in category:
+        return CACHE_TTL_MONTHLY
+    else:
+        return CACHE_TTL_DAILY
+
+
+def cache_key(params, url=None):
+    """Hash of the query parameters (and url, when it identifies the provider), independent of their order and of
+    the api key"""
+    normalized = {str(k): str(v) for k, v in params.items() if k not in IGNORED_PARAMS}
+    if url is not None:
+        normalized[" url"] = url
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, folder=RESPONSES_FOLDER, max_bytes=RESPONSE_CACHE_MAX_BYTES, clock=time.time):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._index = None          # key -> [size, last access]
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    def _file(self, key):
+        return self.folder.joinpath(key + ".json")
+
+    def body_file(self, key):
+        return self.folder.joinpath(key + ".body")
+
+    def body_tmp_file(self, key):
+        """
+        Temporary file to copy a body while it is received (then stored with put_body). Unique per call: the same
+        query can be received twice at once
+        """
+        self._load_index()
+        return self.folder.joinpath(f"{key}.body.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+
+    def _load_index(self):
+        if self._index is None:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self._index = {}
+            for entry in self.folder.glob("*.json"):
+                stat = entry.stat()
+                body = self.body_file(entry.stem)
+                size = stat.st_size + (body.stat().st_size if body.exists() else 0)
+                self._index[entry.stem] = [size, stat.st_atime]
+        return self._index
+
+    def lookup(self, key):
+        """Return the stored entry (fresh or not) or None"""
+        index = self._load_index()
+        file_name = self._file(key)
+        if key not in index or not file_name.exists():
+            index.pop(key, None)
+            return None
+        try:
+            entry = json.loads(file_name.read_text())
+        except (OSError, ValueError):
+            LOG.warning(f"WARNING: Corrupted cache entry {file_name.name}. Removed")
+            self.discard(key)
+            return None
+        if entry.get("body") and not self.body_file(key).exists():
+            self.discard(key)
+            return None
+        now = self._clock()
+        index[key][1] = now
+        os.utime(file_name, (now, os.stat(file_name).st_mtime))
+        return entry
+
+    def get(self, key, ttl):
+        """Fresh payload or None. Updates the hit/miss counters"""
+        entry = self.lookup(key)
+        if entry is not None and self._clock() - entry["stored"] <= ttl:
+            self.hits += 1
+            return self.payload(key, entry)
+        self.misses += 1
+        return None
+
+    def payload(self, key, entry):
+        """Stored data, or the path of the stored body for streamed answers"""
+        return self.body_file(key) if entry.get("body") else entry["data"]
+
+    def _write(self, key, data, params=None, etag=None, last_modified=None, body=False):
+        index = self._load_index()
+        entry = {"stored": self._clock(), "params": {k: v for k, v in (params or {}).items() if k not in IGNORED_PARAMS},
+                 "etag": etag, "last_modified": last_modified, "data": data, "body": body}
+        file_name = self._file(key)
+        tmp_file = file_name.with_name(f"{file_name.name}.{os.getpid()}.tmp")
+        tmp_file.write_text(json.dumps(entry))
+        os.replace(tmp_file, file_name)
+        body_size = self.body_file(key).stat().st_size if body else 0
+        index[key] = [file_name.stat().st_size + body_size, self._clock()]
+        self.evict()
+
+    def put(self, key, data, params=None, etag=None, last_modified=None):
+        self._write(key, data, params=params, etag=etag, last_modified=last_modified)
+
+    def put_body(self, key, body_tmp_file, params=None, etag=None, last_modified=None):
+        """Store the raw body of a streamed answer (moved from body_tmp_file)"""
+        self._load_index()
+        os.replace(body_tmp_file, self.body_file(key))
+        self._write(key, None, params=params, etag=etag, last_modified=last_modified, body=True)
+
+    def refresh(self, key, entry):
+        """The server confirmed (304) that a stale entry is still valid"""
+        self.revalidated += 1
+        self._write(key, entry["data"], params=entry.get("params"), etag=entry.get("etag"),
+                    last_modified=entry.get("last_modified"), body=bool(entry.get("body")))
+
+    def discard(self, key):
+        self._load_index().pop(key, None)
+        for file_name in (self._file(key), self.body_file(key)):
+            if file_name.exists():
+                file_name.unlink()
+
+    @property
+    def size(self):
+        return sum(size for size, _ in self._load_index().values())
+
+    def evict(self):
+        """Remove the least recently used entries until the folder fits in max_bytes"""
+        index = self._load_index()
+        total = self.size
+        if total <= self.max_bytes:
+            return
+        for key, (size, _) in sorted(index.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            self.discard(key)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "revalidated": self.revalidated,
+                "evictions": self.evictions, "hit_rate": self.hits / requests if requests else 0.0,
+                "entries": len(self._load_index()), "bytes": self.size}
+
+    def stored(self, **params):
+        """Every stored entry (fresh or not) whose query includes the given parameters, e.g. function=SYMBOL_SEARCH"""
+        for key in list(self._load_index()):
+            try:
+                entry = json.loads(self._file(key).read_text())
+            except (OSError, ValueError):
+                continue
+            if all(entry.get("params", {}).get(name) == value for name, value in params.items()):
+                yield entry
+
+    def clear(self):
+        for key in list(self._load_index()):
+            self.discard(key)
+
+
+def conditional_headers(entry):
+    """Validators of a stale entry for a conditional GET"""
+    if entry is None:
+        return {}
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
@@ -0,0 +1,169 @@
+"""
+#########################   Scheduler   #########################
+Runs every (symbol, category) update in a single event loop run
+
+Jobs are put on one priority queue ordered by staleness (the oldest
+'Last Refreshed' in the info files first, missing info first of all) and
+drained by a few workers. Every request goes through query_data, so all
+categories share the same rate limiters and the quota never sits idle between
+batches. The workers and the ETA follow the combined limits of the providers
+serving the categories. Weekly/monthly series are then derived locally from
+the daily ones. The queue depth, the jobs done and the metrics file (if
+METRICS_FILE is set) go through src.telemetry.
+#################################################################
+"""
+import time
+import asyncio
+from datetime import datetime, timedelta
+from collections import namedtuple
+from src.config import VANTAGE_CALLS_PER_MINUTE, VERBOSE, METRICS_FILE
+from src.api_manager import build_path_and_file, build_info_file, read_info_file, update_stock, derive_stock
+from src.providers import concurrency, calls_per_minute
+from src.telemetry import REGISTRY
+from src.utils import LOG
+
+
+# Downloaded from the API / derived locally from the downloaded series
+STOCK_CATEGORIES = ("daily-adjusted",)
+FX_CATEGORIES = ("fx_daily",)
+CRYPTO_CATEGORIES = ("digital_daily",)
+DERIVED_STOCK_CATEGORIES = ("daily", "weekly", "monthly", "weekly-adjusted", "monthly-adjusted")
+DERIVED_FX_CATEGORIES = ("fx_weekly", "fx_monthly")
+DERIVED_CRYPTO_CATEGORIES = ("digital_weekly", "digital_monthly")
+
+queue_depth = REGISTRY.gauge("pythia_queue_depth", "Update jobs waiting in the queue")
+jobs_total = REGISTRY.counter("pythia_jobs_total", "Update jobs run", ("category", "status"))
+UpdateJob = namedtuple("UpdateJob", ["symbol", "category", "staleness"])
+
+
+def parse_last_refreshed(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+async def get_staleness(symbol, category, verbose=VERBOSE):
+    """Days since the last refresh according to the info file (None if never updated)"""
+    folder_name, _ = build_path_and_file(symbol, category)
+    info = await read_info_file(build_info_file(folder_name, category), check=False, verbose=verbose - 1)
+    last_refreshed = parse_last_refreshed(info.get("Last Refreshed"))
+    if last_refreshed is None:
+        return None
+    return (datetime.now() - last_refreshed).total_seconds() / (24 * 60 * 60)
+
+
+async def plan_jobs(groups, gap=7, verbose=VERBOSE):
+    """
+    Build the update jobs of every group and drop the ones updated less than (gap) days ago.
+    :param groups: list of (symbols, categories, derived categories)
+    :return: list of UpdateJob, most stale first
+    """
+    pairs = [(symbol, category) for symbols, categories, _ in groups for category in categories for symbol in symbols]
+    staleness = await asyncio.gather(*(get_staleness(symbol, category, verbose=verbose) for symbol, category in pairs))
+    jobs = [UpdateJob(symbol, category, stale) for (symbol, category), stale in zip(pairs, staleness)
+            if stale is None or stale > gap]
+    jobs.sort(key=job_priority)
+    return jobs
+
+
+def job_priority(job):
+    return float("-inf") if job.staleness is None else -job.staleness
+
+
+class Progress:
+    """Tracks finished jobs and estimates the remaining time"""
+
+    def __init__(self, total, calls_per_minute=VANTAGE_CALLS_PER_MINUTE, clock=time.monotonic):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.calls_per_minute = calls_per_minute
+        self._clock = clock
+        self._start = clock()
+
+    @property
+    def elapsed(self):
+        return self._clock() - self._start
+
+    def eta(self):
+        """Seconds left: observed throughput once available, otherwise the rate limit"""
+        remaining = self.total - self.done
+        if self.done:
+            return remaining * self.elapsed / self.done
+        return remaining * 60 / self.calls_per_minute
+
+    def update(self, ok=True):
+        self.done += 1
+        if not ok:
+            self.failed += 1
+
+    def __str__(self):
+        pct = 100 * self.done / self.total if self.total else 100
+        return (f"{self.done}/{self.total} ({pct:.1f}%) failed: {self.failed} "
+                f"elapsed: {timedelta(seconds=int(self.elapsed))} ETA: {timedelta(seconds=int(self.eta()))}")
+
+
+async def run_jobs(jobs, gap=7, workers=None, verbose=VERBOSE):
+    """
+    Drain the jobs through a priority queue with a pool of workers
+    :param workers: concurrent jobs (default: the max concurrent requests of the providers serving the categories)
+    """
+    queue = asyncio.PriorityQueue()
+    for n, job in enumerate(jobs):
+        queue.put_nowait((job_priority(job), n, job))
+    queue_depth.set(queue.qsize())
+    categories = {job.category for job in jobs}
+    if workers is None:
+        workers = concurrency(categories)
+    progress = Progress(len(jobs), calls_per_minute=calls_per_minute(categories) if jobs else VANTAGE_CALLS_PER_MINUTE)
+    if verbose > 0:
+        LOG.info(f"Scheduled {len(jobs)} updates. Estimated time: {timedelta(seconds=int(progress.eta()))}")
+
+    async def worker():
+        while True:
+            try:
+                _, _, job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            queue_depth.set(queue.qsize())
+            status = "error"
+            try:
+                # update_stock logs its errors and returns the status of the update (ok, empty or error)
+                status = await update_stock(job.symbol, category=job.category, max_gap=gap, verbose=verbose)
+            except Exception as err:
+                LOG.error(f"ERROR updating {job.symbol} [{job.category}]: {err.__repr__()}")
+            finally:
+                progress.update(status == "ok")
+                jobs_total.inc(category=job.category, status=status)
+                queue.task_done()
+            if verbose > 0:
+                LOG.info(f"Progress: {progress}")
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(workers, len(jobs))))))
+    return progress
+
+
+async def derive_groups(groups, verbose=VERBOSE):
+    """Recompute the tail of the derived series of every group (no API calls)"""
+    await asyncio.gather(*(derive_stock(symbol, category=category, verbose=verbose)
+                           for symbols, _, derived in groups for category in derived for symbol in symbols))
+
+
+def update_groups(groups, gap=7, verbose=VERBOSE):
+    """
+    Plan and run the updates of every (symbols, categories, derived categories) group in one event loop run
+    """
+    async def main():
+        jobs = await plan_jobs(groups, gap=gap, verbose=verbose)
+        progress = await run_jobs(jobs, gap=gap, verbose=verbose)
+        await derive_groups(groups, verbose=verbose)
+        return progress
+
+    loop = asyncio.get_event_loop()
+    progress = loop.run_until_complete(main())
+    if METRICS_FILE:
+        REGISTRY.write(METRICS_FILE)
+    return progress
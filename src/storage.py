@@ -0,0 +1,325 @@
+"""
+#########################   Storage   #########################
+Storage backends for the price series saved under data/<SYMBOL>/
+
+- zip:      legacy zipped CSV files (stock_data_daily.zip)
+- columnar: typed binary columns (stock_data_daily.col)
+
+Columnar file layout:
+    MAGIC | segment | segment | ...
+    segment = <uint32 header length> <json header> <index int64[rows]> <column[rows]> ...
+The header describes rows, column names and dtypes (float64 prices, int64
+volumes), first/last timestamps and the size/crc32 of the body, so a read is a
+seek + np.fromfile per requested column (no parsing).
+
+Updates append a new segment instead of rewriting the file: the rows of a
+segment replace every row of the previous segments from its first date on
+(the last, possibly incomplete, bar). A crash while appending leaves a
+truncated/corrupted last segment that is ignored by readers and cut off by the
+next append. Files are compacted into a single segment every COMPACT_SEGMENTS.
+
+Reads can be limited to a date range: segments outside of it are skipped
+from their header, the index of the others is memory-mapped to find the first
+and last rows (binary search) and only those rows of every column are read.
+###############################################################
+"""
+import os
+import re
+import json
+import zlib
+import struct
+import numpy as np
+import pandas as pd
+from src.config import DATA_FOLDER, DFT_STOCK_EXT, DFT_COLUMNAR_EXT, STORAGE_BACKEND, COMPACT_SEGMENTS, VERBOSE
+from src.utils import LOG, get_tabs
+
+
+MAGIC = b"PYCOL001"
+HEADER_STRUCT = struct.Struct("<I")
+INDEX_NAME = "date"
+legacy_file_regex = re.compile(r"\A(stock_data|data)_[\w\-]+\.zip\Z")
+
+
+def _typed_column(values):
+    """Convert a column (possibly strings from the API) into float64 or int64"""
+    values = pd.to_numeric(values)
+    if np.issubdtype(values.dtype, np.integer):
+        return np.asarray(values, dtype="<i8")
+    return np.asarray(values, dtype="<f8")
+
+
+def _typed_index(index):
+    """Dates as int64 nanoseconds since epoch"""
+    return np.asarray(pd.to_datetime(index).values.astype("datetime64[ns]").view("<i8"))
+
+
+def _date_bound(value, default):
+    """Date (anything pd.Timestamp accepts) as int64 nanoseconds, default if None"""
+    return default if value is None else int(_typed_index([value])[0])
+
+
+def merge_tail(old_data, data, start=None):
+    """Keep the old rows before start (by default the first date of data) and add data"""
+    data = data.copy()
+    data.index = pd.DatetimeIndex(pd.to_datetime(data.index), name=INDEX_NAME)
+    if start is None:
+        if data.empty:
+            return old_data
+        start = data.index[0]
+    return pd.concat((old_data[old_data.index < pd.Timestamp(start)], data), axis=0)
+
+
+class ZipCsvBackend:
+    """Legacy backend: one zipped CSV per symbol and period"""
+    name = "zip"
+    extension = DFT_STOCK_EXT
+
+    def read(self, file_name, columns=None, start=None, end=None):
+        """Zipped CSV can not skip rows: the date range (both included) is applied once parsed"""
+        usecols = None if columns is None else [INDEX_NAME, *columns]
+        data = pd.read_csv(file_name, parse_dates=[INDEX_NAME], index_col=INDEX_NAME, usecols=usecols)
+        if start is None and end is None:
+            return data
+        dates = data.index.values.astype("datetime64[ns]").view("<i8")
+        first = np.searchsorted(dates, _date_bound(start, np.iinfo("<i8").min), side="left")
+        last = np.searchsorted(dates, _date_bound(end, np.iinfo("<i8").max), side="right")
+        return data.iloc[first:last]
+
+    def write(self, file_name, data):
+        data.reset_index().to_csv(file_name, index=False, compression="infer")
+
+    def append(self, file_name, data, start=None):
+        """Replace the rows from start (first date of data) on. Zipped files must be fully rewritten"""
+        if not file_name.exists():
+            return self.write(file_name, data)
+        self.write(file_name, merge_tail(self.read(file_name), data, start=start))
+
+    def columns(self, file_name):
+        return pd.read_csv(file_name, nrows=0, index_col=INDEX_NAME).columns.tolist()
+
+
+class ColumnarBackend:
+    """Typed binary columns with a small json header per segment"""
+    name = "columnar"
+    extension = DFT_COLUMNAR_EXT
+
+    @staticmethod
+    def encode_segment(data, start=None):
+        """
+        Serialize a DataFrame (date index) into the bytes of one segment.
+        start: first date replaced by this segment (by default, its first row)
+        """
+        index = _typed_index(data.index)
+        arrays = [_typed_column(data[col]) for col in data.columns]
+        body = b"".join([index.tobytes(), *(arr.tobytes() for arr in arrays)])
+        header = {
+            "rows": len(index),
+            "columns": [[str(col), arr.dtype.str] for col, arr in zip(data.columns, arrays)],
+            "first": int(index[0]) if len(index) else None,
+            "last": int(index[-1]) if len(index) else None,
+            "from": int(_typed_index([start])[0]) if start is not None else None,
+            "size": len(body),
+            "crc": zlib.crc32(body),
+        }
+        header = json.dumps(header).encode("ascii")
+        return HEADER_STRUCT.pack(len(header)) + header + body
+
+    @staticmethod
+    def segments(file_name, verify=None):
+        """
+        Return the headers of every complete segment, with the offset of its body.
+        verify: check the crc32 of the last segment (by default only when it was appended)
+        """
+        segments = []
+        file_size = os.path.getsize(file_name)
+        with open(file_name, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not a columnar file: {file_name}")
+            pos = len(MAGIC)
+            while pos + HEADER_STRUCT.size <= file_size:
+                f.seek(pos)
+                header_len, = HEADER_STRUCT.unpack(f.read(HEADER_STRUCT.size))
+                try:
+                    header = json.loads(f.read(header_len))
+                    header["offset"] = pos + HEADER_STRUCT.size + header_len
+                except ValueError:
+                    header = None
+                if header is None or header["offset"] + header["size"] > file_size:
+                    LOG.warning(f"WARNING: Truncated segment ignored in {file_name}")
+                    break
+                segments.append(header)
+                pos = header["offset"] + header["size"]
+
+            verify = len(segments) > 1 if verify is None else verify
+            if verify and segments:
+                last = segments[-1]
+                f.seek(last["offset"])
+                if zlib.crc32(f.read(last["size"])) != last["crc"]:
+                    LOG.warning(f"WARNING: Corrupted segment ignored in {file_name}")
+                    segments.pop()
+        return segments
+
+    @staticmethod
+    def column_offsets(segment):
+        """Byte offset of the index and of each column inside a segment"""
+        rows = segment["rows"]
+        offsets = {INDEX_NAME: (segment["offset"], "<i8")}
+        pos = segment["offset"] + rows * 8
+        for col, dtype in segment["columns"]:
+            offsets[col] = (pos, dtype)
+            pos += rows * np.dtype(dtype).itemsize
+        return offsets
+
+    def read_arrays(self, file_name, columns=None, start=None, end=None):
+        """
+        Read the raw arrays {name: ndarray} of the requested columns (index always included).
+        start, end: only the rows between these dates (both included)
+        """
+        segments = self.segments(file_name)
+        available = [col for col, _ in segments[0]["columns"]] if segments else []
+        columns = available if columns is None else list(columns)
+        missing = [col for col in columns if col not in available]
+        if missing:
+            raise ValueError(f"Columns {missing} not found in {file_name}. Available: {available}")
+
+        # The rows of a segment are valid until the first date replaced by any later segment
+        no_limit = np.iinfo("<i8").max
+        firsts = [next((seg[k] for k in ("from", "first") if seg.get(k) is not None), no_limit)
+                  for seg in segments[1:]] + [no_limit]
+        limits = np.minimum.accumulate(np.array(firsts, dtype="<i8")[::-1])[::-1]
+        first_ts, last_ts = _date_bound(start, np.iinfo("<i8").min), _date_bound(end, no_limit)
+        ranged = start is not None or end is not None
+
+        parts = {name: [] for name in [INDEX_NAME, *columns]}
+        with open(file_name, "rb") as f:
+            for segment, limit in zip(segments, limits):
+                if not segment["rows"] or (ranged and (segment["first"] > last_ts or segment["last"] < first_ts
+                                                       or segment["first"] >= limit)):
+                    continue            # No row in the range: skipped from its header
+                offsets = self.column_offsets(segment)
+                if ranged:
+                    index = np.memmap(f, dtype="<i8", mode="r", offset=offsets[INDEX_NAME][0],
+                                      shape=(segment["rows"],))
+                    lo = int(np.searchsorted(index, first_ts, side="left"))
+                    hi = int(min(np.searchsorted(index, last_ts, side="right"),
+                                 np.searchsorted(index, limit, side="left")))
+                    index = np.array(index[lo:hi])
+                else:
+                    f.seek(offsets[INDEX_NAME][0])
+                    index = np.fromfile(f, dtype="<i8", count=segment["rows"])
+                    lo, hi = 0, int(np.searchsorted(index, limit, side="left"))
+                    index = index[:hi]
+                parts[INDEX_NAME].append(index)
+                for name in columns:
+                    pos, dtype = offsets[name]
+                    f.seek(pos + lo * np.dtype(dtype).itemsize)
+                    parts[name].append(np.fromfile(f, dtype=dtype, count=hi - lo))
+        dtypes = {INDEX_NAME: "<i8", **dict(segments[0]["columns"] if segments else [])}
+        return {name: np.concatenate(arrs) if arrs else np.empty(0, dtype=dtypes.get(name, "<f8"))
+                for name, arrs in parts.items()}
+
+    def read(self, file_name, columns=None, start=None, end=None):
+        arrays = self.read_arrays(file_name, columns=columns, start=start, end=end)
+        index = pd.DatetimeIndex(arrays.pop(INDEX_NAME).view("datetime64[ns]"), name=INDEX_NAME)
+        return pd.DataFrame(arrays, index=index)
+
+    def write(self, file_name, data):
+        """Rewrite the whole file atomically (write a temporary file and replace)"""
+        tmp_file = file_name.with_name(file_name.name + ".tmp")
+        with open(tmp_file, "wb") as f:
+            f.write(MAGIC)
+            f.write(self.encode_segment(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file_name)
+
+    def append(self, file_name, data, start=None):
+        """
+        Replace the rows from start (by default the first date of data, i.e. the last incomplete bar)
+        and add the new ones by writing a segment at the end of the file. The history is not rewritten.
+        """
+        if not file_name.exists():
+            return self.write(file_name, data)
+        segments = self.segments(file_name, verify=True)
+        layout = [[str(col), _typed_column(data[col]).dtype.str] for col in data.columns]
+        if not segments or segments[0]["columns"] != layout:
+            # Nothing valid stored or a different layout (e.g. int volumes received as floats)
+            old_data = self.read(file_name) if segments else data.iloc[:0]
+            return self.write(file_name, merge_tail(old_data, data, start=start))
+        if data.empty and start is None:
+            return
+
+        end = segments[-1]["offset"] + segments[-1]["size"]
+        with open(file_name, "r+b") as f:
+            f.truncate(end)                 # Leftovers of an interrupted append
+            f.seek(end)
+            f.write(self.encode_segment(data, start=start))
+            f.flush()
+            os.fsync(f.fileno())
+
+        if len(segments) + 1 >= COMPACT_SEGMENTS:
+            self.compact(file_name)
+
+    def compact(self, file_name):
+        """Merge every segment into a single one (atomic rewrite)"""
+        self.write(file_name, self.read(file_name))
+
+    def columns(self, file_name):
+        segments = self.segments(file_name)
+        return [col for col, _ in segments[0]["columns"]] if segments else []
+
+
+BACKENDS = {backend.name: backend for backend in (ZipCsvBackend(), ColumnarBackend())}
+
+
+def get_backend(name=None):
+    name = STORAGE_BACKEND if name is None else name
+    if name not in BACKENDS:
+        raise ValueError(f"Storage backend {name} not supported. Please select one among {list(BACKENDS)}")
+    return BACKENDS[name]
+
+
+def backend_for(file_name):
+    """Select the backend from the file extension"""
+    for backend in BACKENDS.values():
+        if file_name.suffix == backend.extension:
+            return backend
+    raise ValueError(f"No storage backend for files with extension '{file_name.suffix}'")
+
+
+def migrate_file(file_name, backend="columnar", remove=False, verbose=VERBOSE):
+    """Convert one data file into the given backend. Returns the new file name"""
+    source = backend_for(file_name)
+    target = get_backend(backend)
+    new_file = file_name.with_suffix(target.extension)
+    if source is target:
+        return file_name
+
+    data = source.read(file_name)
+    data.index.name = INDEX_NAME
+    target.write(new_file, data)
+    if remove:
+        file_name.unlink()
+    if verbose > 1:
+        symbol = file_name.parent.name
+        LOG.info(f"Migrated {symbol}:{get_tabs(symbol, prev=10)}[{file_name.name}] -> [{new_file.name}]")
+    return new_file
+
+
+def migrate_data_folder(data_folder=DATA_FOLDER, backend="columnar", remove=False, verbose=VERBOSE):
+    """One-shot migration of every stock_data_*.zip and data_*.zip file"""
+    migrated = []
+    for folder in sorted(x for x in data_folder.iterdir() if x.is_dir()):
+        for file_name in sorted(folder.iterdir()):
+            if not legacy_file_regex.match(file_name.name):
+                continue
+            try:
+                migrated.append(migrate_file(file_name, backend=backend, remove=remove, verbose=verbose))
+            except Exception as err:
+                LOG.error(f"ERROR migrating {file_name}: {err.__repr__()}")
+    LOG.info(f"Migration finished! {len(migrated)} files converted to '{backend}'")
+    return migrated
+
+
+if __name__ == "__main__":
+    migrate_data_folder()
@@ -0,0 +1,244 @@
+"""
+#########################   Symbol index   #########################
+Local search over every symbol already resolved, before SYMBOL_SEARCH
+
+The index keeps the market info (symbol, name, type, region, market hours,
+timezone, currency) of every bestMatches result received and of the stored
+info files (read from the catalog), the ISIN/SEDOL codes resolved by a
+search, and the answer of every keyword searched. It is built from the
+catalog and the cached search answers the first time it is used.
+
+Keywords are normalized (upper case, words of letters and digits) and
+matched against:
+    - the symbols, aliases and keywords already searched (exact)
+    - the words of the names (with the words of the region and currency)
+    - the start of the symbols, names and their words (sorted keys + bisect)
+    - the symbols and words of the names with a typo (trigram candidates +
+      difflib ratio)
+Only a match scoring at least HIT_SCORE avoids the API call; the answers of
+the API are merged back into the index.
+####################################################################
+"""
+import os
+import re
+import json
+import bisect
+import difflib
+from collections import defaultdict, Counter
+from src.config import SYMBOL_INDEX_FILE
+from src.utils import LOG
+
+
+SEARCH_FIELDS = ("symbol", "name", "type", "region", "marketOpen", "marketClose", "timezone", "currency")
+HIT_SCORE = 0.85            # Best local score answering a search without the API
+FUZZY_CANDIDATES = 50       # Entries sharing most trigrams scored with difflib
+FUZZY_MIN_RATIO = 0.6
+words_regex = re.compile(r"[A-Z0-9]+")
+isin_regex = re.compile(r"\A[A-Z]{2}[A-Z0-9]{9}[0-9]\Z")
+sedol_regex = re.compile(r"\A[0-9BCDFGHJKLMNPQRSTVWXYZ]{6}[0-9]\Z")
+enum_regex = re.compile(r"\A\d+\.\s*")
+
+
+def normalize(text):
+    """'Johnson&Johnson' -> 'JOHNSON JOHNSON'"""
+    return " ".join(words_regex.findall(str(text).upper()))
+
+
+def is_isin(code):
+    """ISIN with a valid check digit (Luhn over the letters converted to numbers)"""
+    if not isin_regex.match(code):
+        return False
+    digits = "".join(str(int(char, 36)) for char in code[:-1])
+    total = 0
+    for n, digit in enumerate(reversed(digits)):
+        value = int(digit) * (2 if n % 2 == 0 else 1)
+        total += value // 10 + value % 10
+    return (10 - total % 10) % 10 == int(code[-1])
+
+
+def is_sedol(code):
+    """SEDOL with a valid check digit"""
+    if not sedol_regex.match(code):
+        return False
+    total = sum(int(char, 36) * weight for char, weight in zip(code[:-1], (1, 3, 1, 7, 3, 9)))
+    return (10 - total % 10) % 10 == int(code[-1])
+
+
+def trigrams(text):
+    text = f" {text} "
+    return {text[n:n + 3] for n in range(len(text) - 2)}
+
+
+def clean_keys(match):
+    """'1. symbol' -> 'symbol'"""
+    return {enum_regex.sub("", key): value for key, value in match.items()}
+
+
+def clean_match(match):
+    """Market fields of a bestMatches result (numbered keys or clean ones) or of an info file"""
+    match = clean_keys(match)
+    return {field: match[field] for field in SEARCH_FIELDS if match.get(field) is not None}
+
+
+class SymbolIndex:
+    def __init__(self, index_file=SYMBOL_INDEX_FILE):
+        self.index_file = index_file
+        self.entries = {}           # symbol -> market fields
+        self.aliases = {}           # ISIN/SEDOL -> symbol
+        self.queries = {}           # normalized keyword -> [[symbol, score], ...] answered by the API
+        self._keys = None           # sorted (key, symbol) of the symbols and names, for the prefix matches
+        self._field_keys = None     # sorted (key, symbol) of the regions and currencies
+        self._trigrams = None       # trigram -> symbols
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    # Persistence
+    def load(self, catalog=None, response_cache=None):
+        """Read the index file (built from the catalog and the cached answers if there is none)"""
+        if self._loaded:
+            return self
+        self._loaded = True
+        stored = None
+        if self.index_file.exists():
+            try:
+                stored = json.loads(self.index_file.read_text())
+                self.entries, self.aliases, self.queries = stored["entries"], stored["aliases"], stored["queries"]
+            except (OSError, ValueError, KeyError, TypeError):
+                stored = None
+                self.entries, self.aliases, self.queries = {}, {}, {}
+                LOG.warning(f"WARNING: Corrupted symbol index {self.index_file.name}. Rebuilt")
+        if stored is None and response_cache is not None:
+            for entry in response_cache.stored(function="SYMBOL_SEARCH"):
+                self.merge_answer(entry["params"].get("keywords", ""), entry["data"])
+        if catalog is not None:
+            for row in catalog.series(kind="stock"):
+                self.add(row["info"], overwrite=False)
+        return self
+
+    def save(self):
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file.with_name(f"{self.index_file.name}.{os.getpid()}.tmp")
+        tmp_file.write_text(json.dumps({"entries": self.entries, "aliases": self.aliases, "queries": self.queries}))
+        os.replace(tmp_file, self.index_file)
+
+    # Updates
+    def add(self, match, overwrite=True):
+        """Add (or update) the market fields of a symbol. Returns its symbol"""
+        match = clean_match(match)
+        symbol = match.get("symbol")
+        if not symbol:
+            return None
+        if overwrite or symbol not in self.entries:
+            self.entries[symbol] = {**self.entries.get(symbol, {}), **match}
+            self._keys = self._trigrams = None
+        return symbol
+
+    def merge_answer(self, keyword, answer):
+        """Merge the bestMatches of a search answer and remember the answer of the keyword"""
+        matches = (answer or {}).get("bestMatches") if isinstance(answer, dict) else None
+        if matches is None:
+            return
+        keyword = normalize(keyword)
+        scores = [[self.add(match), float(clean_keys(match).get("matchScore", 0.0))] for match in matches]
+        scores = [[symbol, score] for symbol, score in scores if symbol]
+        self.queries[keyword] = scores
+        code = keyword.replace(" ", "")
+        if scores and (is_isin(code) or is_sedol(code)):
+            self.aliases[code] = scores[0][0]
+
+    # Search
+    def _build(self):
+        self._keys, self._field_keys, self._trigrams = [], [], defaultdict(set)
+        for symbol, entry in self.entries.items():
+            name = normalize(entry.get("name", ""))
+            self._keys += [(key, symbol) for key in {normalize(symbol), name, *name.split()} if key]
+            fields = {*normalize(entry.get("region", "")).split(), normalize(entry.get("currency", ""))}
+            self._field_keys += [(key, symbol) for key in fields if key]
+            for gram in trigrams(normalize(symbol)) | trigrams(name):
+                self._trigrams[gram].add(symbol)
+        self._keys.sort()
+        self._field_keys.sort()
+
+    @staticmethod
+    def _prefixed(keys, prefix):
+        """Symbols with a key starting with prefix"""
+        symbols = set()
+        for n in range(bisect.bisect_left(keys, (prefix, "")), len(keys)):
+            if not keys[n][0].startswith(prefix):
+                break
+            symbols.add(keys[n][1])
+        return symbols
+
+    def _score(self, keyword, symbol):
+        """
+        1 for the symbol, 0.95 for the first words of the name, 0.9 for whole words of the name (and region or
+        currency), 0.7 to 0.85 for the start of a word (the longer the prefix the higher) and the difflib ratio of
+        the closest word (typos), up to 0.9
+        """
+        entry = self.entries[symbol]
+        code, name = normalize(symbol), normalize(entry.get("name", ""))
+        if keyword == code or keyword == code.replace(" ", ""):
+            return 1.0
+        if name == keyword or name.startswith(keyword + " "):
+            return 0.95
+        named = set(name.split()) | {code}
+        words = named | set(normalize(entry.get("region", "")).split()) | {normalize(entry.get("currency", ""))}
+        keywords = keyword.split()
+        if all(word in words for word in keywords) and any(word in named for word in keywords):
+            return 0.9
+        prefixes = [key for key in (code, name, *named) if key.startswith(keyword)]
+        score = max((0.7 + 0.15 * len(keyword) / len(key) for key in prefixes), default=0.0)
+        ratio = max(difflib.SequenceMatcher(None, keyword, key).ratio() for key in (code, name, *named))
+        return max(score, min(ratio, 0.9) if ratio >= FUZZY_MIN_RATIO else 0.0)
+
+    def search(self, keyword, limit=10, region=None, currency=None, type=None):
+        """
+        Matches of a keyword as bestMatches results (with matchScore), best first.
+        region, currency, type: keep the matches starting with them (case insensitive)
+        """
+        if self._keys is None:
+            self._build()
+        keyword = normalize(keyword)
+        if not keyword:
+            return []
+        scores = {}
+        code = keyword.replace(" ", "")
+        if code in self.aliases and self.aliases[code] in self.entries:
+            scores[self.aliases[code]] = 1.0
+        for symbol, score in self.queries.get(keyword, []):
+            if symbol in self.entries:
+                scores[symbol] = max(scores.get(symbol, 0.0), score)
+
+        # Candidates: every word of the keyword starts one of their words (one of the symbol or name at least),
+        # the keyword starts their symbol or name, or they share most trigrams with it
+        named = [self._prefixed(self._keys, word) for word in keyword.split()]
+        fields = [self._prefixed(self._field_keys, word) for word in keyword.split()]
+        prefix_words = set.intersection(*(a | b for a, b in zip(named, fields))) & set.union(*named)
+        candidates = self._prefixed(self._keys, keyword) | prefix_words
+        shared = Counter(symbol for gram in trigrams(keyword) for symbol in self._trigrams.get(gram, ()))
+        candidates |= {symbol for symbol, _ in shared.most_common(FUZZY_CANDIDATES)}
+        for symbol in candidates:
+            score = self._score(keyword, symbol)
+            if score > scores.get(symbol, 0.0):
+                scores[symbol] = score
+
+        filters = {"region": region, "currency": currency, "type": type}
+        matches = [{**self.entries[symbol], "matchScore": f"{score:.4f}"}
+                   for symbol, score in sorted(scores.items(), key=lambda item: (-item[1], item[0])) if score > 0
+                   and all(normalize(self.entries[symbol].get(field, "")).startswith(normalize(value))
+                           for field, value in filters.items() if value)]
+        return matches[:limit]
+
+    def lookup(self, keyword, **filters):
+        """
+        bestMatches answer from the index, None on a miss: a keyword never searched without any match scoring at
+        least HIT_SCORE
+        """
+        matches = self.search(keyword, **filters)
+        if normalize(keyword) in self.queries or (matches and float(matches[0]["matchScore"]) >= HIT_SCORE):
+            self.hits += 1
+            return {"bestMatches": matches}
+        self.misses += 1
+        return None
+
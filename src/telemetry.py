@@ -0,0 +1,232 @@
+"""
+#########################   Telemetry   #########################
+Counters, gauges and histograms of the update pipeline, and timing spans
+
+A single registry (REGISTRY) is shared by every module: request latency,
+status and bytes per api, throttle events, seconds of every step (parse,
+save, read... fed by src.offload), queue depths and cache hit rates (read
+from the caches by collectors when exporting). It is exported as a
+Prometheus text file (e.g. for the node exporter textfile collector) or as a
+JSON snapshot.
+
+Every update_stock call is a trace and its stages (plan, query, save...) are
+spans: the last TRACE_HISTORY traces are kept and every span is observed in
+the pythia_stage_seconds histogram.
+#################################################################
+"""
+import os
+import json
+import time
+import pathlib
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from src.config import TRACE_HISTORY
+
+
+DFT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_current_trace = ContextVar("trace", default=None)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text="", labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}           # label values -> value
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric {self.name} expects the labels {self.labels}, not {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels))
+
+    def samples(self):
+        """(labels dict, value) of every label combination"""
+        return [(dict(zip(self.labels, key)), value) for key, value in sorted(self._values.items())]
+
+    def reset(self):
+        self._values.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text="", labels=(), buckets=DFT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry["buckets"][n] += 1
+        entry["sum"] += value
+        entry["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+class Registry:
+    def __init__(self, trace_history=TRACE_HISTORY):
+        self._metrics = {}
+        self._collectors = []
+        self.traces = deque(maxlen=trace_history)
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help_text, labels, **kwargs)
+        elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+            raise ValueError(f"Metric {name} already registered as a {metric.kind} with labels {metric.labels}")
+        return metric
+
+    def counter(self, name, help_text="", labels=()):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", labels=()):
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text="", labels=(), buckets=DFT_BUCKETS):
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def add_collector(self, collector):
+        """collector(registry) is called before every export (e.g. to set gauges from the caches)"""
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            collector(self)
+        return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def snapshot(self):
+        """Every metric and the last traces as a JSON serializable dict"""
+        metrics = {metric.name: {"type": metric.kind, "help": metric.help,
+                                 "samples": [{"labels": labels, "value": value} for labels, value in metric.samples()]}
+                   for metric in self.collect()}
+        return {"time": datetime.now().isoformat(timespec="seconds"), "metrics": metrics, "traces": list(self.traces)}
+
+    def prometheus(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.collect():
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}"]
+            for labels, value in metric.samples():
+                if metric.kind == "histogram":
+                    for bound, count in zip(metric.buckets, value["buckets"]):
+                        lines.append(f"{metric.name}_bucket{_labels({**labels, 'le': bound})} {count}")
+                    lines.append(f"{metric.name}_bucket{_labels({**labels, 'le': '+Inf'})} {value['count']}")
+                    lines.append(f"{metric.name}_sum{_labels(labels)} {value['sum']}")
+                    lines.append(f"{metric.name}_count{_labels(labels)} {value['count']}")
+                else:
+                    lines.append(f"{metric.name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, file_name):
+        """Export atomically: Prometheus text for .prom files, a JSON snapshot otherwise"""
+        file_name = pathlib.Path(file_name)
+        file_name.parent.mkdir(parents=True, exist_ok=True)
+        text = self.prometheus() if file_name.suffix == ".prom" else json.dumps(self.snapshot(), indent=2)
+        tmp_file = file_name.with_name(f"{file_name.name}.{os.getpid()}.tmp")
+        tmp_file.write_text(text)
+        os.replace(tmp_file, file_name)
+        return file_name
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+        self.traces.clear()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = {name: str(value).replace("\\", "\\\\").replace('"', '\\"') for name, value in labels.items()}
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+REGISTRY = Registry()
+
+
+class Trace:
+    """Spans (stage, start offset, seconds) of one operation"""
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.started = datetime.now().isoformat(timespec="milliseconds")
+        self.spans = []
+        self.duration = None
+
+    def as_dict(self):
+        return {"name": self.name, **self.attributes, "started": self.started, "seconds": round(self.duration, 6),
+                "spans": [{"stage": stage, "offset": round(offset, 6), "seconds": round(seconds, 6)}
+                          for stage, offset, seconds in self.spans]}
+
+
+@contextmanager
+def trace(name, registry=REGISTRY, **attributes):
+    """Trace an operation (the spans opened in it, even in awaited coroutines, are added to it)"""
+    current = Trace(name, **attributes)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_trace.reset(token)
+        registry.traces.append(current.as_dict())
+        registry.histogram("pythia_trace_seconds", "Duration of the traced operations", ("name",)) \
+            .observe(current.duration, name=name)
+
+
+@contextmanager
+def span(stage, registry=REGISTRY):
+    """Time a stage of the current trace (and of the pythia_stage_seconds histogram)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        current = _current_trace.get()
+        if current is not None:
+            current.spans.append((stage, start - current.start, seconds))
+        registry.histogram("pythia_stage_seconds", "Duration of the stages of the traced operations", ("stage",)) \
+            .observe(seconds, stage=stage)
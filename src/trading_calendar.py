@@ -0,0 +1,133 @@
+"""
+#########################   Trading calendar   #########################
+Trading sessions of the exchanges of the stored symbols
+
+The exchange is derived from the 'region' of the info file (as returned by
+the symbol search). Holidays follow the regular rules of every exchange;
+one-off closures are not listed (a full download confirms them, see
+src.backfill). FX pairs trade on weekdays and cryptocurrencies every day.
+
+Sessions close at the 'marketClose' of the info file (the usual close of the
+exchange otherwise) in the timezone of the exchange, so the closes follow
+daylight saving time. FX days end at 17:00 New York time and crypto days at
+midnight UTC.
+########################################################################
+"""
+import re
+from datetime import time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+import pandas as pd
+from pandas.tseries.holiday import (AbstractHolidayCalendar, Holiday, GoodFriday, EasterMonday, USMartinLutherKingJr,
+                                    USPresidentsDay, USMemorialDay, USLaborDay, USThanksgivingDay, nearest_workday,
+                                    sunday_to_monday, next_monday, next_monday_or_tuesday)
+from pandas.tseries.offsets import DateOffset
+from dateutil.relativedelta import MO
+
+
+class NYSECalendar(AbstractHolidayCalendar):
+    rules = [Holiday("New Year's Day", month=1, day=1, observance=sunday_to_monday), USMartinLutherKingJr,
+             USPresidentsDay, GoodFriday, USMemorialDay,
+             Holiday("Juneteenth", month=6, day=19, start_date="2022-06-19", observance=nearest_workday),
+             Holiday("Independence Day", month=7, day=4, observance=nearest_workday), USLaborDay,
+             USThanksgivingDay, Holiday("Christmas", month=12, day=25, observance=nearest_workday)]
+
+
+class LSECalendar(AbstractHolidayCalendar):
+    rules = [Holiday("New Year's Day", month=1, day=1, observance=next_monday), GoodFriday, EasterMonday,
+             Holiday("Early May bank holiday", month=5, day=1, offset=DateOffset(weekday=MO(1))),
+             Holiday("Spring bank holiday", month=5, day=31, offset=DateOffset(weekday=MO(-1))),
+             Holiday("Summer bank holiday", month=8, day=31, offset=DateOffset(weekday=MO(-1))),
+             Holiday("Christmas", month=12, day=25, observance=next_monday),
+             Holiday("Boxing Day", month=12, day=26, observance=next_monday_or_tuesday)]
+
+
+class EuropeCalendar(AbstractHolidayCalendar):
+    """Euronext, Xetra and BME close on the TARGET holidays"""
+    rules = [Holiday("New Year's Day", month=1, day=1), GoodFriday, EasterMonday,
+             Holiday("Labour Day", month=5, day=1), Holiday("Christmas", month=12, day=25),
+             Holiday("Christmas Holiday", month=12, day=26)]
+
+
+CALENDARS = {"NYSE": NYSECalendar(), "LSE": LSECalendar(), "EUROPE": EuropeCalendar(), "WEEKDAYS": None,
+             "ALWAYS": None}
+REGION_CALENDARS = {"united states": "NYSE", "united kingdom": "LSE", "amsterdam": "EUROPE", "paris": "EUROPE",
+                    "brussels": "EUROPE", "lisbon": "EUROPE", "paris/brussels/amsterdam": "EUROPE",
+                    "xetra": "EUROPE", "frankfurt": "EUROPE", "madrid": "EUROPE"}
+
+CALENDAR_TIMEZONES = {"NYSE": "America/New_York", "LSE": "Europe/London", "EUROPE": "Europe/Berlin",
+                      "WEEKDAYS": "America/New_York", "ALWAYS": "UTC"}
+CALENDAR_CLOSES = {"NYSE": "16:00", "LSE": "16:30", "EUROPE": "17:30", "WEEKDAYS": "17:00", "ALWAYS": "23:59"}
+utc_offset_regex = re.compile(r"\AUTC([+-])(\d{1,2}):?(\d{2})?\Z")
+
+
+def calendar_name(category, info=None):
+    """Calendar of a series: from the category (fx, crypto) or the region of the symbol (weekdays if unknown)"""
+    category = category.lower()
+    if category.startswith("digital"):
+        return "ALWAYS"
+    if category.startswith("fx"):
+        return "WEEKDAYS"
+    region = (info or {}).get("region") or (info or {}).get("Region") or ""
+    return REGION_CALENDARS.get(region.lower(), "WEEKDAYS")
+
+
+@lru_cache(maxsize=64)
+def _year_sessions(name, first_year, last_year):
+    """Trading days of whole years (computing the holiday rules is slow: every plan reuses them)"""
+    start, end = pd.Timestamp(first_year, 1, 1), pd.Timestamp(last_year, 12, 31)
+    if name == "ALWAYS":
+        return pd.date_range(start, end, freq="D")
+    calendar = CALENDARS[name]
+    holidays = [] if calendar is None else calendar.holidays(start, end)
+    return pd.bdate_range(start, end, freq="C", holidays=holidays)
+
+
+def sessions(name, start, end):
+    """Trading days between two dates (both included)"""
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    if name not in CALENDARS:
+        raise ValueError(f"Calendar {name} not supported. Please select one among {list(CALENDARS)}")
+    # Whole decades, so the cache is shared by the series starting in different years
+    days = _year_sessions(name, start.year // 10 * 10, end.year)
+    return days[days.searchsorted(start):days.searchsorted(end, side="right")]
+
+
+def market_timezone(name, info=None):
+    """Timezone of the sessions: the exchange one, or the UTC offset of the info file for unknown regions"""
+    if name == "WEEKDAYS" and info:
+        match = utc_offset_regex.match(info.get("timezone") or "")
+        if match:
+            sign, hours, minutes = match.groups()
+            offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+            return timezone(-offset if sign == "-" else offset)
+    return ZoneInfo(CALENDAR_TIMEZONES[name])
+
+
+def market_close(name, info=None):
+    """Closing time of the sessions (local time of the exchange)"""
+    close = (info or {}).get("marketClose") or CALENDAR_CLOSES[name]
+    return time.fromisoformat(close)
+
+
+def session_closes(name, start, end, info=None):
+    """Close (UTC) of every session between two dates (both included)"""
+    days = sessions(name, start, end)
+    close, tz = market_close(name, info), market_timezone(name, info)
+    return pd.DatetimeIndex([pd.Timestamp.combine(day.date(), close).tz_localize(tz) for day in days]).tz_convert("UTC")
+
+
+def last_close(name, now, info=None):
+    """Close (UTC) of the last session finished at now"""
+    now = pd.Timestamp(now).tz_convert("UTC")
+    day = now.tz_localize(None)
+    closes = session_closes(name, day - pd.Timedelta(days=15), day + pd.Timedelta(days=1), info=info)
+    return closes[closes.searchsorted(now, side="right") - 1]
+
+
+def next_close(name, now, info=None):
+    """Close (UTC) of the first session finishing after now"""
+    now = pd.Timestamp(now).tz_convert("UTC")
+    day = now.tz_localize(None)
+    closes = session_closes(name, day - pd.Timedelta(days=1), day + pd.Timedelta(days=15), info=info)
+    return closes[closes.searchsorted(now, side="right")]
@@ -1,5 +1,6 @@
 import os
 import sys
+import functools
 import inspect
 import logging
 import pathlib
@@ -30,8 +31,9 @@ def bigint2utctimestamp(bigint):
     return datetime.utcfromtimestamp(bigint / 1e3)
 
 
+@functools.lru_cache(maxsize=None)
 def in_ipynb(verbose=VERBOSE):
-    """Detects if we are running within ipython (Notebook)"""
+    """Detects if we are running within ipython (Notebook). Cached: get_tabs calls it on every log line"""
     try:
         cfg = get_ipython().config
         if isinstance(cfg['IPKernelApp']['parent_appname'], LazyConfigValue):
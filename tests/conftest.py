@@ -0,0 +1,46 @@
+import asyncio
+import pytest
+from src.alpha_vantage_api import alpha_vantage_query
+from src.benchmark import PayloadFactory, StubVantageServer
+from src.crawler_semaphore import SemaphoreController
+from src.providers import Provider, PROVIDERS, register_provider, unregister_provider
+
+
+class StubProviders:
+    """Providers of the Alpha Vantage API backed by stub servers, on a new event loop"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.servers = {}
+
+    def add(self, name, categories, limits=(2, [(100, 60)]), factory=None, calls=100, period=1.0):
+        """
+        Start a stub server (answering with the rate-limit Note over `calls` requests within `period` seconds) and
+        register a provider of the categories querying it. Returns the server
+        """
+        server = self.loop.run_until_complete(StubVantageServer(factory or PayloadFactory(rows=20, variants=1),
+                                                                calls=calls, period=period).start())
+
+        def query(symbol, category, key=None, **kwargs):
+            return server.url, alpha_vantage_query(symbol, category, key="test", **kwargs)[1], {}
+        register_provider(Provider(name, query, tuple(categories), limits, check=PROVIDERS["vantage"].check,
+                                   valid=PROVIDERS["vantage"].valid, stream=True))
+        self.servers[name] = server
+        return server
+
+    def close(self):
+        for name, server in self.servers.items():
+            unregister_provider(name)
+            self.loop.run_until_complete(server.stop())
+        self.servers = {}
+        self.loop.run_until_complete(SemaphoreController().close_sessions())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def stub_providers():
+    providers = StubProviders()
+    yield providers
+    providers.close()
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+from hamcrest import *
+import src.api_manager as api_manager
+from src.adjust import AdjustmentFactors, FactorCache, extract_actions, merge_actions, adjust
+from src.frame_cache import FrameCache
+from src.storage import get_backend
+
+
+def daily(rows=10, split=None, dividend=None):
+    """Constant close of 100 (50 after a 2:1 split at row `split`), a dividend of 1 at row `dividend`"""
+    index = pd.bdate_range("2020-01-01", periods=rows, name="date").astype("datetime64[ns]")
+    close = np.full(rows, 100.0)
+    splits, dividends = np.ones(rows), np.zeros(rows)
+    if split is not None:
+        close[split:] = 50.0
+        splits[split] = 2.0
+    if dividend is not None:
+        dividends[dividend] = 1.0
+    return pd.DataFrame({"open": close, "high": close, "low": close, "close": close, "adjusted close": close,
+                         "volume": np.full(rows, 1000, dtype="<i8"), "dividend amount": dividends,
+                         "split coefficient": splits}, index=index)
+
+
+def test_factors():
+    data = daily(split=4, dividend=7)
+    actions = extract_actions(data)
+    assert_that(actions.index.tolist(), equal_to(data.index[[4, 7]].tolist()))
+    assert_that(actions["factor"].tolist(), equal_to([0.5, 1 - 1 / 50]))
+
+    adjusted = adjust(data, AdjustmentFactors(data.index, actions))
+    assert_that(adjusted.columns.tolist(), equal_to(["open", "high", "low", "close", "volume"]))
+    assert_that(adjusted["close"].round(6).tolist(), equal_to([49.0] * 4 + [49.0] * 3 + [50.0] * 3))
+    assert_that(adjusted["volume"].tolist(), equal_to([2000.0] * 4 + [1000.0] * 6))
+    assert_that(adjust(data, AdjustmentFactors(data.index, actions), period="weekly").index.tolist(),
+                equal_to(pd.DatetimeIndex(["2020-01-03", "2020-01-10", "2020-01-14"]).tolist()))
+
+
+def test_incremental_update():
+    data = daily(rows=30, split=25, dividend=5)
+    factors = AdjustmentFactors(data.index[:20], extract_actions(data.iloc[:20]))
+    # New rows with a new action: only the prefix is multiplied
+    assert_that(factors.update(data.index, extract_actions(data)), equal_to(True))
+    expected = AdjustmentFactors(data.index, extract_actions(data))
+    assert_that(np.allclose(factors.price, expected.price) and np.allclose(factors.volume, expected.volume))
+    # Rewritten history: computed again
+    assert_that(factors.update(data.index[1:], extract_actions(data)), equal_to(False))
+    assert_that(len(factors.price), equal_to(29))
+
+    cache = FactorCache()
+    cache.factors("AAA", data.index[:20], extract_actions(data.iloc[:20]))
+    cache.factors("AAA", data.index, extract_actions(data))
+    assert_that((cache.computed, cache.incremental), equal_to((1, 1)))
+
+
+def test_merge_actions():
+    old = extract_actions(daily(dividend=3))
+    new = extract_actions(daily(split=4, dividend=3)).assign(factor=0.9)
+    merged = merge_actions(old, new.iloc[1:])
+    assert_that(merged["factor"].tolist(), equal_to([0.99, 0.9]))
+
+
+def test_load_adjusted(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path)
+    monkeypatch.setattr(api_manager, "frame_cache", FrameCache())
+    monkeypatch.setattr(api_manager, "factor_cache", FactorCache())
+    file_name = api_manager.build_path_and_file("AAA", "daily-adjusted")[1]
+    get_backend().write(file_name, daily(rows=20, split=15))
+
+    adjusted = api_manager.load_adjusted(["AAA", "BBB"], period="monthly")
+    assert_that(adjusted["BBB"], none())
+    assert_that(adjusted["AAA"]["close"].tolist(), equal_to([50.0]))
+    assert_that(api_manager.actions_file("AAA").exists(), equal_to(True))
+    assert_that(api_manager.write_actions(file_name, api_manager.actions_file("AAA")), equal_to(False))
+
+    # A dividend in the new rows: the table changes and the factors are updated in place
+    get_backend().append(file_name, daily(rows=25, split=15, dividend=22).iloc[20:])
+    assert_that(api_manager.write_actions(file_name, api_manager.actions_file("AAA")), equal_to(True))
+    assert_that(api_manager.load_adjusted(["AAA"])["AAA"]["close"].iloc[0], close_to(49.0, 1e-9))
+    assert_that(api_manager.factor_cache.incremental, equal_to(1))
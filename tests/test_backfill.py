@@ -0,0 +1,108 @@
+import pytest
+import pandas as pd
+from hamcrest import *
+import src.api_manager as api_manager
+from src.backfill import Gap, FetchPlan, find_gaps, plan_fetch
+from src.benchmark import PayloadFactory
+from src.catalog import Catalog
+from src.storage import get_backend
+from src.trading_calendar import calendar_name, sessions
+
+
+def test_calendars():
+    assert_that(len(sessions("NYSE", "2019-01-01", "2019-12-31")), equal_to(252))
+    assert_that(len(sessions("LSE", "2019-01-01", "2019-12-31")), equal_to(253))
+    assert_that(pd.Timestamp("2019-04-19"), is_not(is_in(sessions("EUROPE", "2019-04-15", "2019-04-26"))))
+    assert_that(len(sessions("ALWAYS", "2019-04-15", "2019-04-28")), equal_to(14))
+    assert_that(calendar_name("daily", {"region": "United Kingdom"}), equal_to("LSE"))
+    assert_that(calendar_name("daily-adjusted", {"region": "Unknown"}), equal_to("WEEKDAYS"))
+    assert_that(calendar_name("fx_daily"), equal_to("WEEKDAYS"))
+    assert_that(calendar_name("digital_daily", {"region": "United States"}), equal_to("ALWAYS"))
+
+
+@pytest.mark.parametrize("drop, as_of, expected", (
+    [[], "2019-06-28", ("none", 0)],                                    # Up to date
+    [[], "2019-07-03", ("compact", 3)],                                 # Tail only (July 4th is a holiday)
+    [["2019-06-10", "2019-06-11"], "2019-06-28", ("compact", 2)],        # Recent hole
+    [["2019-01-10"], "2019-06-28", ("full", 1)],                        # Hole older than the compact window
+    [[], "2019-12-31", ("full", 128)],                                  # Tail longer than the compact window
+))
+def test_plan_fetch(drop, as_of, expected):
+    dates = sessions("NYSE", "2019-01-02", "2019-06-28").drop(pd.DatetimeIndex(drop))
+    plan = plan_fetch(dates, "daily", info={"region": "United States"}, as_of=as_of)
+    assert_that((plan.fetch, plan.missing), equal_to(expected))
+    if drop and plan.fetch == "compact":
+        assert_that(plan.start, equal_to(pd.Timestamp(drop[0])))
+        assert_that(plan.gaps, equal_to([Gap(pd.Timestamp(drop[0]), pd.Timestamp(drop[-1]), len(drop))]))
+
+
+def test_confirmed_and_periodic_gaps():
+    dates = sessions("NYSE", "2019-01-02", "2019-06-28").drop(pd.DatetimeIndex(["2019-01-10"]))
+    confirmed = [Gap(pd.Timestamp("2019-01-10"), pd.Timestamp("2019-01-10"), 1, True)]
+    plan = plan_fetch(dates, "daily", info={"region": "United States"}, as_of="2019-07-01", confirmed=confirmed)
+    assert_that((plan.fetch, plan.missing, len(plan.gaps)), equal_to(("compact", 1, 2)))
+    # Monthly bars are labelled with the last session of the month: only March is missing
+    months = pd.DatetimeIndex(["2019-01-31", "2019-02-28", "2019-04-30", "2019-05-31", "2019-06-14"])
+    gaps = find_gaps(months, "NYSE", period="monthly", as_of="2019-06-14")
+    assert_that(gaps, equal_to([Gap(pd.Timestamp("2019-03-29"), pd.Timestamp("2019-03-29"), 1)]))
+
+
+def test_write_from_start_fills_hole(tmp_path):
+    file_name = tmp_path.joinpath("stock_data_daily.col")
+    index = pd.bdate_range("2020-01-01", periods=20, name="date")
+    data = pd.DataFrame({"close": range(20)}, index=index, dtype="<f8")
+    get_backend("columnar").write(file_name, data.drop(index[[5, 6]]))
+    api_manager.write_pandas_data(file_name, data.iloc[3:], old_data=data.drop(index[[5, 6]]), start=index[5])
+    assert_that(api_manager.read_pandas_data(file_name)["close"].tolist(), equal_to(list(range(20))))
+
+
+def test_update_stock_confirms_gaps(tmp_path, monkeypatch, stub_providers):
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path)
+    monkeypatch.setattr(api_manager, "RESPONSE_CACHE", False)
+    monkeypatch.setattr(api_manager, "catalog", Catalog(db_file=tmp_path.joinpath("catalog.db"), data_folder=tmp_path))
+    factory = PayloadFactory(rows=300, variants=1)
+    server = stub_providers.add("stub_daily", ("daily",), limits=(2, [(10, 60)]), factory=factory)
+    loop = stub_providers.loop
+    try:
+        # Stored data with a hole; the stub has no data after 2020-01-31 (a delisted symbol)
+        full = api_manager.clean_pandas_data(factory.payload("AAA", adjusted=False)["Time Series (Daily)"])
+        full.index = pd.to_datetime(full.index)
+        file_name = api_manager.build_path_and_file("AAA", "daily")[1]
+        get_backend().write(file_name, full.iloc[:250].drop(full.index[[100, 101]]).astype(float))
+
+        status = loop.run_until_complete(api_manager.update_stock("AAA", "daily", api="stub_daily", verbose=0))
+        assert_that((status, server.served), equal_to(("ok", 1)))
+        assert_that(len(api_manager.read_pandas_data(file_name)), equal_to(300))
+        gaps = api_manager.catalog.gaps("AAA", "daily")
+        assert_that(gaps, contains_exactly(has_entries(first_ts="2020-02-03T00:00:00", status="confirmed")))
+
+        # The missing tail is confirmed: no more requests
+        loop.run_until_complete(api_manager.update_stock("AAA", "daily", api="stub_daily", verbose=0))
+        assert_that(server.served, equal_to(1))
+    finally:
+        api_manager.catalog.close()
+
+
+def test_compact_answer_not_reaching_the_hole_is_an_error(tmp_path, monkeypatch, stub_providers):
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path)
+    monkeypatch.setattr(api_manager, "RESPONSE_CACHE", False)
+    monkeypatch.setattr(api_manager, "catalog", Catalog(db_file=tmp_path.joinpath("catalog.db"), data_folder=tmp_path))
+    factory = PayloadFactory(rows=300, variants=1)
+    server = stub_providers.add("stub_daily", ("daily",), factory=factory)
+    full = api_manager.clean_pandas_data(factory.payload("AAA", adjusted=False)["Time Series (Daily)"])
+    full.index = pd.to_datetime(full.index)
+    file_name = api_manager.build_path_and_file("AAA", "daily")[1]
+    get_backend().write(file_name, full.iloc[:250].drop(full.index[10]).astype(float))
+    stored = file_name.read_bytes()
+
+    # The compact answer (last 100 sessions) starts long after the hole to fill
+    async def plan_update(folder_name, category, dates, max_gap=0, verbose=0):
+        return FetchPlan("compact", full.index[10], 1, [], "WEEKDAYS")
+    monkeypatch.setattr(api_manager, "plan_update", plan_update)
+    try:
+        status = stub_providers.loop.run_until_complete(api_manager.update_stock("AAA", "daily", api="stub_daily",
+                                                                                  verbose=0))
+        assert_that((status, server.served), equal_to(("error", 1)))
+        assert_that(file_name.read_bytes(), equal_to(stored))
+    finally:
+        api_manager.catalog.close()
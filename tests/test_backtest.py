@@ -0,0 +1,78 @@
+import pytest
+import numpy as np
+import pandas as pd
+from hamcrest import *
+import src.backtest as backtest_module
+from src.backtest import *
+from src.panel import Panel
+
+
+DATES = pd.bdate_range("2020-01-01", periods=200, name="date")
+
+
+def build_close():
+    rng = np.random.default_rng(2)
+    close = 100 * np.cumprod(1 + rng.normal(0.0005, 0.01, size=(200, 3)), axis=0)
+    close[:40, 2] = np.nan                  # Listed later
+    close[100, 0] = np.nan                  # Missing bar
+    return close
+
+
+@pytest.fixture
+def converted(monkeypatch, tmp_path):
+    close = build_close()
+    calls = []
+
+    def load_converted(symbols, base="GBP", period="daily", fields=("close",)):
+        calls.append(base)
+        return Panel(DATES, list(symbols), ["close"], close[None])
+
+    monkeypatch.setattr(backtest_module, "load_converted", load_converted)
+    monkeypatch.setattr(backtest_module, "BACKTEST_FOLDER", tmp_path)
+    return close, calls
+
+
+def test_expand_grid():
+    assert_that(expand_grid("sma_cross", {"fast": [10, 50], "slow": [20, 50]}),
+                equal_to([{"fast": 10, "slow": 20}, {"fast": 10, "slow": 50}]))
+    assert_that(label("bollinger", {"window": 20, "k": 2}), equal_to("bollinger(window=20, k=2)"))
+    with pytest.raises(ValueError):
+        expand_grid("pairs", {})
+
+
+def test_run_grid_matches_loop():
+    close = backtest_module.forward_fill(build_close())
+    returns, turnover, _, trades = run_grid(close, "momentum", [{"lookback": 5}, {"lookback": 20}], cost_bps=10)
+
+    # One set and one symbol at a time
+    signal = momentum(close, {}, 20)
+    expected = np.zeros(len(close))
+    for t in range(1, len(close)):
+        listed = [n for n in range(3) if not np.isnan(close[t, n])]
+        for n in listed:
+            held = signal[t - 1, n] if not np.isnan(close[t - 1, n]) and not np.isnan(signal[t - 1, n]) else 0.0
+            now = signal[t, n] if not np.isnan(signal[t, n]) else 0.0
+            move = close[t, n] / close[t - 1, n] - 1 if not np.isnan(close[t - 1, n]) else 0.0
+            expected[t] += (held * move - 10 / 1e4 * abs(now - held)) / len(listed)
+    assert_that(np.allclose(returns[1], expected), is_(True))
+    assert_that(trades[1], greater_than(0))
+
+    long_only, _, exposure, _ = run_grid(close, "momentum", [{"lookback": 5}], long_only=True)
+    assert_that(exposure.max(), less_than_or_equal_to(1.0))
+
+
+def test_backtest(converted):
+    _, calls = converted
+    grid = {"fast": [5, 10, 20], "slow": [20, 50]}
+    result = backtest(["AAA", "BBB", "CCC"], "sma_cross", grid, base="USD", start="2020-03-02", workers=0)
+    assert_that(calls, equal_to(["USD"]))
+    assert_that(result.equity.shape, equal_to((5, len(DATES[DATES >= "2020-03-02"]))))
+    assert_that(result.frame().columns[0], equal_to("sma_cross(fast=5, slow=20)"))
+    stats = result.stats.loc["sma_cross(fast=10, slow=50)"]
+    assert_that(stats["total return"], close_to(result.equity[3, -1] - 1, 1e-12))
+    assert_that(stats["max drawdown"], less_than_or_equal_to(0.0))
+    assert_that(result.best("sharpe", n=1).index[0], is_in(result.labels))
+
+    # Same result from the chunks run in the process pool on the memory-mapped closes
+    pooled = backtest(["AAA", "BBB", "CCC"], "sma_cross", grid, base="USD", start="2020-03-02", workers=2)
+    assert_that(np.allclose(pooled.equity, result.equity), is_(True))
@@ -0,0 +1,43 @@
+import asyncio
+import aiohttp
+from hamcrest import *
+from src.api_manager import clean_pandas_data, process_vantage_data
+from src.alpha_vantage_api import manage_vantage_errors
+from src.benchmark import PayloadFactory, StubVantageServer, compare_results
+
+
+def test_payload_shape():
+    factory = PayloadFactory(rows=50, variants=2)
+    info, dat = process_vantage_data(factory.payload("AMZN"))
+    data = clean_pandas_data(dat)
+    assert_that(info["Symbol"], equal_to("AMZN"))
+    assert_that(data.shape, equal_to((50, 8)))
+    assert_that(data.columns.tolist(), has_item("adjusted close"))
+    assert_that(data.index.is_monotonic_increasing, is_(True))
+    assert_that(len(factory.payload("AMZN", output_size="compact")["Time Series (Daily)"]), equal_to(50))
+
+
+def test_stub_server_rate_limit_note():
+    async def run():
+        server = await StubVantageServer(PayloadFactory(rows=10, variants=1), calls=2, period=60).start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                answers = []
+                for _ in range(3):
+                    async with session.get(server.url, params={"function": "TIME_SERIES_DAILY", "symbol": "MMM"}) as r:
+                        answers.append(await r.json())
+        finally:
+            await server.stop()
+        return server, answers
+
+    server, answers = asyncio.new_event_loop().run_until_complete(run())
+    assert_that([manage_vantage_errors(answer, "MMM") for answer in answers], equal_to([None, None, "longWait"]))
+    assert_that((server.served, server.notes), equal_to((2, 1)))
+
+
+def test_compare_results():
+    def results(throughput):
+        return {"runs": [{"symbols": 40, "stages": {"read_pandas_data": {"throughput": throughput}}}]}
+    comparison = compare_results(results(100.0), results(80.0), threshold=0.1)
+    assert_that(comparison["change"].tolist(), contains_exactly(close_to(-0.2, 1e-9)))
+    assert_that(comparison["regression"].tolist(), equal_to([True]))
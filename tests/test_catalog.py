@@ -0,0 +1,49 @@
+import json
+import sqlite3
+import pytest
+import pandas as pd
+from hamcrest import *
+from src.catalog import Catalog, folder_kind, data_period
+from src.storage import get_backend
+
+
+@pytest.mark.parametrize("name, expected", (["AMZN", "stock"], ["GBP_USD", "fx"], ["CRYPTO_BTC_GBP", "crypto"],
+                                            ["BAS.DEX", "stock"]))
+def test_folder_kind(name, expected):
+    assert_that(folder_kind(name), equal_to(expected))
+
+
+def test_rebuild_and_record(tmp_path):
+    folder = tmp_path.joinpath("data", "AMZN")
+    folder.mkdir(parents=True)
+    folder.joinpath("info_data_daily.json").write_text(json.dumps({"name": "Amazon.com Inc.", "currency": "USD"}))
+    data = pd.DataFrame({"close": [1.0, 2.0]}, index=pd.Index(["2019-12-23", "2019-12-24"], name="date"))
+    get_backend("columnar").write(folder.joinpath("stock_data_daily.col"), data)
+
+    catalog = Catalog(db_file=tmp_path.joinpath("catalog.db"), data_folder=tmp_path.joinpath("data"))
+    assert_that(catalog.rebuild(), equal_to(2))
+    series = catalog.series(kind="stock")
+    assert_that(series, has_length(1))
+    assert_that(series[0], has_entries(folder="AMZN", period="daily", rows=2, last_ts="2019-12-24T00:00:00"))
+    assert_that(series[0]["info"], has_entries(currency="USD"))
+
+    get_backend("columnar").append(folder.joinpath("stock_data_daily.col"),
+                                   pd.DataFrame({"close": [3.0]}, index=pd.Index(["2019-12-26"], name="date")))
+    catalog.record_data(folder.joinpath("stock_data_daily.col"))
+    assert_that(catalog.series(folder="AMZN")[0], has_entries(rows=3, last_ts="2019-12-26T00:00:00"))
+    assert_that(catalog.summary("AMZN", "daily")["columns"], equal_to(["close"]))
+    assert_that(catalog.series(kind="fx"), empty())
+    catalog.close()
+
+
+def test_older_catalog_gets_the_new_columns(tmp_path):
+    db_file = tmp_path.joinpath("catalog.db")
+    with sqlite3.connect(db_file.as_posix()) as conn:
+        conn.execute("CREATE TABLE series (folder TEXT NOT NULL, period TEXT NOT NULL, kind TEXT NOT NULL, info TEXT, "
+                     "data_file TEXT, first_ts TEXT, last_ts TEXT, rows INTEGER, checksum TEXT, updated TEXT, "
+                     "PRIMARY KEY (folder, period))")
+        conn.execute("INSERT INTO series (folder, period, kind, rows) VALUES ('AMZN', 'daily', 'stock', 2)")
+    conn.close()
+    catalog = Catalog(db_file=db_file, data_folder=tmp_path)
+    assert_that(catalog.summary("AMZN", "daily"), has_entries(rows=2, columns=None))
+    catalog.close()
@@ -0,0 +1,52 @@
+import pytest
+import numpy as np
+import pandas as pd
+from hamcrest import *
+from src.correlation import *
+
+
+def build_returns():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(300, 4)) @ np.array([[1, 0.5, 0, 0], [0, 1, 0.3, 0], [0, 0, 1, 0], [0, 0, 0, 1.0]])
+    x[:30, 2] = np.nan                      # Listed later
+    x[rng.random(x.shape) < 0.05] = np.nan  # Holidays
+    return x + 1000                         # Offset: rounding of the add/remove updates
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_rolling_matches_pandas(kind):
+    x = build_returns()
+    frame = pd.DataFrame(x)
+    rolling = frame.rolling(20, min_periods=15)
+    expected = (rolling.cov() if kind == "cov" else rolling.corr()).values.reshape(300, 4, 4)
+    values = rolling_matrices(x, 20, kind=kind, min_periods=15, resync=2)
+    assert_that(values.shape, equal_to((300, 4, 4)))
+    assert_that(np.allclose(values, expected, equal_nan=True, atol=1e-8), is_(True))
+
+    packed = rolling_matrices(x, 20, kind=kind, min_periods=15, upper=True, resync=2)
+    assert_that(packed.shape, equal_to((300, 10)))
+    assert_that(np.array_equal(unpack(packed, 4), values, equal_nan=True), is_(True))
+
+
+def test_streaming_and_constant_series():
+    x = build_returns()
+    x[:, 3] = 1.0                           # No variance: no correlation
+    moments = RollingMoments(4, 20, ref=np.nanmean(x, axis=0))
+    for row in x:
+        moments.push(row)
+    last = unpack(moments.corr(), 4)
+    assert_that(np.allclose(last, rolling_matrices(x, 20)[-1], equal_nan=True), is_(True))
+    assert_that(np.isnan(last[3]).all(), is_(True))
+    assert_that(unpack(moments.cov(), 4)[3, 3], close_to(0.0, 1e-9))
+
+
+def test_rolling_matrices_access():
+    x = build_returns()
+    dates = pd.bdate_range("2020-01-01", periods=300, name="date")
+    symbols = ["AAA", "BBB", "CCC", "DDD"]
+    full = RollingMatrices(dates, symbols, "corr", 20, rolling_matrices(x, 20))
+    upper = RollingMatrices(dates, symbols, "corr", 20, rolling_matrices(x, 20, upper=True, dtype="<f4"), upper=True)
+    assert_that(np.allclose(full.pair("DDD", "BBB"), upper.pair("BBB", "DDD"), equal_nan=True, atol=1e-6), is_(True))
+    assert_that(np.allclose(full.matrix("2022-01-01"), upper.matrix(dates[-1]), equal_nan=True, atol=1e-6), is_(True))
+    with pytest.raises(ValueError):
+        rolling_matrices(x, 20, kind="beta")
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from hamcrest import *
+from src.crawler_semaphore import TokenBucket, RateLimiter, SemaphoreController
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_refill():
+    clock = FakeClock()
+    bucket = TokenBucket(5, 60, clock=clock)
+    for _ in range(5):
+        assert_that(bucket.delay(), equal_to(0.0))
+        bucket.consume()
+    assert_that(bucket.delay(), close_to(12.0, 1e-9))
+    clock.now = 12.0
+    assert_that(bucket.delay(), equal_to(0.0))
+
+
+def test_token_bucket_drain():
+    clock = FakeClock()
+    bucket = TokenBucket(5, 60, clock=clock)
+    bucket.drain()
+    assert_that(bucket.delay(), close_to(60.0, 1e-9))
+
+
+@pytest.mark.parametrize("elapsed, expected", ([0.0, 12.0], [12.0, 0.0], [30.0, 0.0]))
+def test_rate_limiter_uses_slowest_bucket(elapsed, expected):
+    clock = FakeClock()
+    limiter = RateLimiter([(1, 12), (10, 100)], clock=clock)
+    asyncio.run(limiter.acquire())
+    clock.now = elapsed
+    assert_that(limiter.delay(), close_to(expected, 1e-9))
+
+
+def test_limits_work_in_every_event_loop():
+    controller = SemaphoreController()
+    controller.add_api("stub_loops", 1, [(100, 1)])
+    limiter = RateLimiter([(1, 0.01)])
+
+    async def contend():
+        async def call():
+            await controller.get_semaphore("stub_loops")
+            try:
+                await limiter.acquire()
+                await asyncio.sleep(0)
+            finally:
+                controller.release_semaphore("stub_loops")
+        await asyncio.gather(*(call() for _ in range(3)))
+        await asyncio.gather(*(limiter.acquire() for _ in range(3)))
+
+    try:
+        # The lock and the semaphore wait in the first loop, then are used again in a new one
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(contend())
+            finally:
+                loop.close()
+    finally:
+        controller.remove_api("stub_loops")
@@ -0,0 +1,76 @@
+import json
+import pytest
+import numpy as np
+import pandas as pd
+from hamcrest import *
+import src.api_manager as api_manager
+import src.currency as currency
+import src.panel as panel
+from src.frame_cache import FrameCache
+from src.storage import get_backend
+
+
+PAIRS = {("GBP", "USD"): 1.25, ("GBP", "EUR"): 1.1}
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    for module in (api_manager, currency):
+        monkeypatch.setattr(module, "DATA_FOLDER", tmp_path)
+    monkeypatch.setattr(api_manager, "frame_cache", FrameCache())
+    monkeypatch.setattr(currency, "rate_cache", currency.RateCache())
+    monkeypatch.setattr(panel, "PANEL_FOLDER", tmp_path.joinpath("panels"))
+    # FX closes on weekdays only, from the second business day
+    dates = pd.bdate_range("2020-01-02", periods=10, name="date")
+    for pair, rate in PAIRS.items():
+        file_name = api_manager.build_path_and_file(pair, "fx_daily")[1]
+        get_backend().write(file_name, pd.DataFrame({"close": np.full(10, rate)}, index=dates))
+    return tmp_path
+
+
+def test_rate_path():
+    pairs = set(PAIRS)
+    assert_that(currency.rate_path("USD", "GBP", pairs), equal_to([(("GBP", "USD"), True)]))
+    assert_that(currency.rate_path("USD", "EUR", pairs), equal_to([(("GBP", "USD"), True), (("GBP", "EUR"), False)]))
+    assert_that(currency.rate_path("EUR", "EUR", pairs), empty())
+    with pytest.raises(ValueError):
+        currency.rate_path("USD", "JPY", pairs)
+
+
+def test_asof():
+    rate_dates = pd.DatetimeIndex(["2020-01-02", "2020-01-06"]).values
+    dates = pd.DatetimeIndex(["2020-01-01", "2020-01-04", "2020-01-06", "2020-01-07"]).values
+    values = currency.asof(dates, rate_dates, np.array([1.0, 2.0]))
+    assert_that(np.array_equal(values, [np.nan, 1.0, 2.0, 2.0], equal_nan=True), equal_to(True))
+
+
+def test_rates_are_cached(data_folder):
+    dates = pd.date_range("2020-01-01", periods=5).values
+    rates = currency.rate_cache.rates(dates, "USD", "EUR")
+    assert_that(np.allclose(rates[1:], 1.1 / 1.25) and np.isnan(rates[0]), equal_to(True))
+    pence = currency.rate_cache.rates(dates, "GBX", "USD")
+    assert_that(pence[-1], close_to(0.0125, 1e-12))
+    matrix = currency.rate_cache.matrix(dates, ["USD", "GBX", "USD"], "EUR")
+    assert_that(matrix.shape, equal_to((5, 3)))
+    assert_that((currency.rate_cache.misses, currency.rate_cache.hits), equal_to((3, 1)))
+
+
+def test_load_converted(data_folder):
+    index = pd.bdate_range("2020-01-06", periods=5, name="date")
+    for symbol, info in (("AAA", {"currency": "USD", "region": "United States"}),
+                         ("LLL", {"currency": "GBP", "region": "United Kingdom"})):
+        folder_name, file_name = api_manager.build_path_and_file(symbol, "daily")
+        get_backend().write(file_name, pd.DataFrame({"close": np.full(5, 100.0), "volume": np.full(5, 7.0)},
+                                                    index=index))
+        api_manager.build_info_file(folder_name, "daily").write_text(json.dumps(info))
+    crypto = pd.DataFrame({"close (GBP)": np.full(7, 10.0), "volume": np.ones(7)},
+                          index=pd.date_range("2020-01-06", periods=7, name="date"))
+    get_backend().write(api_manager.build_path_and_file(("BTC", "GBP"), "digital_daily")[1], crypto)
+
+    converted = currency.load_converted(["LLL", ("BTC", "GBP"), "AAA"], base="USD", fields=["close", "volume"])
+    assert_that(converted.symbols, equal_to(["LLL", "BTC_GBP", "AAA"]))
+    close = converted.frame("close")
+    assert_that(close.iloc[0].tolist(), equal_to([1.25, 12.5, 100.0]))
+    # Weekend crypto prices use the last (Friday) rate
+    assert_that(close.loc["2020-01-12", "BTC_GBP"], equal_to(12.5))
+    assert_that(converted.frame("volume").iloc[0].tolist(), equal_to([7.0, 1.0, 7.0]))
@@ -0,0 +1,127 @@
+import asyncio
+import aiohttp
+import pytest
+import pandas as pd
+from hamcrest import *
+import src.daemon as daemon
+from src.catalog import Catalog
+from src.daemon import JobQueue, UpdateDaemon
+from src.trading_calendar import next_close, last_close
+
+
+# Tuesday 2024-03-12, 14:00 New York: the NYSE session of the day is open
+NOW = pd.Timestamp("2024-03-12 18:00", tz="UTC")
+US_INFO = {"symbol": "AAA", "region": "United States", "marketClose": "16:00", "timezone": "UTC-05"}
+
+
+def test_closes():
+    # Daylight saving time started on Sunday 2024-03-10
+    assert_that(next_close("NYSE", NOW, US_INFO), equal_to(pd.Timestamp("2024-03-12 20:00", tz="UTC")))
+    assert_that(last_close("NYSE", NOW, US_INFO), equal_to(pd.Timestamp("2024-03-11 20:00", tz="UTC")))
+    assert_that(next_close("NYSE", pd.Timestamp("2024-03-01 22:00", tz="UTC")),
+                equal_to(pd.Timestamp("2024-03-04 21:00", tz="UTC")))
+    assert_that(next_close("WEEKDAYS", NOW, {"timezone": "UTC+05:30", "marketClose": "15:30"}),
+                equal_to(pd.Timestamp("2024-03-13 10:00", tz="UTC")))
+
+
+def test_job_queue(tmp_path):
+    queue = JobQueue(tmp_path.joinpath("queue.db"))
+    assert_that(queue.add("AAA", "daily-adjusted", "AAA", NOW), equal_to(True))
+    assert_that(queue.add("AAA", "daily-adjusted", "AAA", NOW + pd.Timedelta(days=1)), equal_to(False))
+    queue.add("GBP_USD", "fx_daily", ["GBP", "USD"], NOW + pd.Timedelta(hours=1))
+
+    jobs = queue.claim(NOW, limit=5)
+    assert_that([job.folder for job in jobs], equal_to(["AAA"]))
+    assert_that(queue.counts(NOW), equal_to({"pending": 1, "running": 1, "due": 0}))
+    queue.close()
+
+    # Restart: the interrupted job is due again, the other one keeps its time
+    queue = JobQueue(tmp_path.joinpath("queue.db"))
+    assert_that(queue.resume(), equal_to(1))
+    assert_that(queue.next_due(), equal_to(NOW))
+    queue.finish(queue.claim(NOW, limit=5)[0], NOW + pd.Timedelta(days=1), 0, "ok")
+    assert_that(queue.next_due(), equal_to(NOW + pd.Timedelta(hours=1)))
+    assert_that(queue.jobs(status="pending")[0]["symbol"], equal_to(["GBP", "USD"]))
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    catalog = Catalog(db_file=tmp_path.joinpath("catalog.db"), data_folder=tmp_path)
+    for folder, last_ts in (("AAA", "2024-03-11T00:00:00"), ("BBB", "2024-03-01T00:00:00")):
+        catalog.record_info(tmp_path.joinpath(folder, "info_data_daily-adjusted.json"), {**US_INFO, "symbol": folder})
+        catalog.record_data(tmp_path.joinpath(folder, "stock_data_daily-adjusted.col"),
+                            {"data_file": "stock_data_daily-adjusted.col", "first_ts": "2020-01-02T00:00:00",
+                             "last_ts": last_ts, "rows": 10, "checksum": "0"})
+    calls = []
+
+    async def update_stock(symbol, category, max_gap, verbose):
+        calls.append((symbol, category))
+        if symbol == "BBB":
+            catalog.record_data(tmp_path.joinpath(symbol, "stock_data_daily-adjusted.col"),
+                                {"last_ts": "2024-03-11T00:00:00"})
+            return "ok"
+        return "error"
+
+    async def derive_stock(symbol, category, verbose):
+        calls.append((symbol, category))
+        return "ok"
+
+    monkeypatch.setattr(daemon, "catalog", catalog)
+    monkeypatch.setattr(daemon, "update_stock", update_stock)
+    monkeypatch.setattr(daemon, "derive_stock", derive_stock)
+    service = UpdateDaemon(queue=JobQueue(tmp_path.joinpath("queue.db")), workers=2, port=0, clock=lambda: NOW,
+                           verbose=0)
+    return service, calls
+
+
+def test_schedule(service):
+    service, calls = service
+    assert_that(service.seed(), equal_to(2))
+    due = {job["folder"]: job["due"] for job in service.queue.jobs()}
+    # AAA has the last session: refreshed 30 minutes after today's close. BBB is stale: due now
+    assert_that(due, equal_to({"BBB": "2024-03-12T18:00:00", "AAA": "2024-03-12T20:30:00"}))
+
+    async def run():
+        service.dispatch()
+        await asyncio.gather(*service._running.values())
+
+    asyncio.new_event_loop().run_until_complete(run())
+    assert_that(calls[0], equal_to(("BBB", "daily-adjusted")))
+    assert_that(len(calls), equal_to(1 + len(daemon.DERIVED_STOCK_CATEGORIES)))
+    job = service.queue.jobs(status="pending")[-1]
+    assert_that((job["folder"], job["due"], job["result"]), equal_to(("BBB", "2024-03-12T20:30:00", "ok")))
+    assert_that(service.done, equal_to(1))
+
+
+def test_status_endpoint(service):
+    service, _ = service
+
+    async def run():
+        task = asyncio.ensure_future(service.serve())
+        while service._runner is None or not service._runner.addresses:
+            await asyncio.sleep(0.01)
+        host, port = service._runner.addresses[0][:2]
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://{host}:{port}/status") as resp:
+                status = await resp.json()
+            async with session.get(f"http://{host}:{port}/metrics") as resp:
+                metrics = await resp.text()
+        service.stop()
+        await task
+        return status, metrics
+
+    status, metrics = asyncio.new_event_loop().run_until_complete(run())
+    assert_that(status["jobs"]["pending"] + status["jobs"].get("running", 0), equal_to(2))
+    assert_that(metrics, contains_string("pythia_queue_depth"))
+
+
+def test_failed_update_is_retried(service):
+    service, calls = service
+    service.seed()
+    # AAA is up to date, but its update failed: retried after DAEMON_RETRY_DELAY instead of the next close
+    job = next(job for job in service.queue.claim(NOW + pd.Timedelta(hours=3), limit=5) if job.folder == "AAA")
+    asyncio.new_event_loop().run_until_complete(service.run_job(job))
+    job = next(job for job in service.queue.jobs() if job["folder"] == "AAA")
+    assert_that((job["result"], job["attempts"]), equal_to(("retry", 1)))
+    assert_that(job["error"], equal_to("update_stock error"))
+    assert_that(service.failed, equal_to(1))
@@ -0,0 +1,72 @@
+import pytest
+import numpy as np
+import pandas as pd
+from hamcrest import *
+import src.api_manager as api_manager
+import src.dataset as dataset_module
+from src.catalog import Catalog
+from src.dataset import dataset
+from src.frame_cache import FrameCache
+from src.storage import get_backend
+
+
+DATES = pd.bdate_range("2020-01-01", periods=100, name="date")
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    catalog = Catalog(db_file=tmp_path.joinpath("catalog.db"), data_folder=tmp_path)
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path)
+    monkeypatch.setattr(dataset_module, "catalog", catalog)
+    monkeypatch.setattr(dataset_module, "frame_cache", FrameCache())
+    for n, (symbol, backend) in enumerate((("AAA", "columnar"), ("BBB", "zip"))):
+        data = pd.DataFrame({"open": np.arange(100.0) + n, "close": np.arange(100.0) + n,
+                             "volume": np.arange(100) * 10}, index=DATES)
+        file_name = api_manager.build_path_and_file(symbol, "daily", backend=backend)[1]
+        get_backend(backend).write(file_name, data)
+        catalog.record_data(file_name)
+    return tmp_path
+
+
+def test_lazy_handle(data_folder):
+    handle = dataset(["AAA", "BBB"]).between("2020-02-01").between(end="2020-03-31").select(["close", "volume"])
+    assert_that((handle.start, handle.end), equal_to((pd.Timestamp("2020-02-01"), pd.Timestamp("2020-03-31"))))
+    assert_that(handle.between("2020-01-01").start, equal_to(pd.Timestamp("2020-02-01")))
+    with pytest.raises(ValueError):
+        handle.select("open")
+
+    frames = handle.collect()
+    for symbol, offset in (("AAA", 0), ("BBB", 1)):
+        expected = pd.DataFrame({"close": np.arange(100.0) + offset, "volume": np.arange(100) * 10},
+                                index=DATES).loc["2020-02-01":"2020-03-31"]
+        assert_that(frames[symbol].equals(expected), equal_to(True))
+    assert_that(dataset("AAA").between("2021-01-01").collect().empty, equal_to(True))
+
+
+def test_estimate(data_folder):
+    estimate = dataset(["AAA", "BBB"]).between("2020-02-01", "2020-03-31").select("close").estimate()
+    actual = len(DATES[(DATES >= "2020-02-01") & (DATES <= "2020-03-31")])
+    assert_that(abs(estimate.loc["AAA", "rows"] - actual), less_than_or_equal_to(2))
+    assert_that(estimate.loc["AAA", "bytes"], equal_to(estimate.loc["AAA", "rows"] * 16))
+    # All the columns of the file when none is selected
+    assert_that(dataset("BBB").estimate().loc["BBB"].tolist(), equal_to([100, 3, 100 * 8 * 4]))
+
+
+def test_estimate_without_data_files(tmp_path, monkeypatch):
+    catalog = Catalog(db_file=tmp_path.joinpath("catalog.db"), data_folder=tmp_path)
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path)
+    monkeypatch.setattr(dataset_module, "catalog", catalog)
+    catalog.record_data(tmp_path.joinpath("AAA", "stock_data_daily.col"),
+                        {"data_file": "stock_data_daily.col", "first_ts": "2020-01-01T00:00:00",
+                         "last_ts": "2020-12-31T00:00:00", "rows": 366, "columns": '["open", "close"]', "checksum": "0"})
+    estimate = dataset(["AAA", "ZZZ"]).between("2020-07-01").estimate()
+    assert_that(estimate.loc["AAA"].tolist(), equal_to([185, 2, 185 * 8 * 3]))
+    assert_that(estimate.loc["ZZZ"].isna().all(), equal_to(True))         # Not indexed
+
+
+def test_collect_from_frame_cache(data_folder):
+    file_name = api_manager.build_path_and_file("AAA", "daily")[1]
+    dataset_module.frame_cache.read(file_name)
+    frame = dataset("AAA").between("2020-01-06", "2020-01-08").select("close").collect()
+    assert_that(frame.close.tolist(), equal_to([3.0, 4.0, 5.0]))
+    assert_that(dataset_module.frame_cache.hits, equal_to(1))
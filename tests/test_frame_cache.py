@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+from hamcrest import *
+import src.api_manager as api_manager
+from src.frame_cache import FrameCache
+from src.storage import get_backend
+
+
+def sample(rows=50, start="2020-01-01"):
+    index = pd.date_range(start, periods=rows, freq="D", name="date").astype("datetime64[ns]")
+    return pd.DataFrame({"close": np.arange(rows, dtype="<f8"), "volume": np.arange(rows, dtype="<i8")}, index=index)
+
+
+def test_hits_projection_and_copy_on_write(tmp_path):
+    file_name = tmp_path.joinpath("stock_data_daily.col")
+    get_backend("columnar").write(file_name, sample())
+    cache = FrameCache()
+
+    first = cache.read(file_name)
+    first.loc[first.index[0], "close"] = -1.0           # Copied on write: the cached arrays do not change
+    close = cache.read(file_name, columns=["close"])
+    assert_that(close.columns.tolist(), equal_to(["close"]))
+    assert_that(close["close"].iloc[0], equal_to(0.0))
+    assert_that((cache.hits, cache.misses, len(cache._entries)), equal_to((1, 1, 1)))
+
+    # Appending changes the size (and mtime) of the file: read again, the old version is dropped
+    get_backend("columnar").append(file_name, sample(rows=5, start="2020-02-19"))
+    assert_that(len(cache.read(file_name)), equal_to(54))
+    assert_that((cache.misses, len(cache._entries)), equal_to((2, 1)))
+
+
+def test_lru_eviction_by_bytes(tmp_path):
+    files = [tmp_path.joinpath(f"stock_data_{n}.col") for n in range(3)]
+    for file_name in files:
+        get_backend("columnar").write(file_name, sample())
+    cache = FrameCache(max_bytes=2 * 50 * 24)              # Index, close and volume: 24 bytes per row
+    cache.read(files[0])
+    cache.read(files[1])
+    cache.read(files[0])                                    # files[1] is now the least recently used
+    cache.read(files[2])
+    assert_that([key[0] for key in cache._entries], equal_to([files[0].as_posix(), files[2].as_posix()]))
+    assert_that((cache.evictions, cache.bytes), equal_to((1, 2 * 50 * 24)))
+
+
+def test_load_universe(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path)
+    monkeypatch.setattr(api_manager, "frame_cache", FrameCache())
+    for symbol in ("AAA", "BBB"):
+        get_backend("columnar").write(api_manager.build_path_and_file(symbol, "daily")[1], sample())
+    universe = api_manager.load_universe(["AAA", "BBB", "CCC"], columns=["close"], workers=2)
+    assert_that(list(universe), equal_to(["AAA", "BBB", "CCC"]))
+    assert_that(universe["CCC"], none())
+    assert_that(universe["AAA"].shape, equal_to((50, 1)))
+    assert_that(api_manager.frame_cache.misses, equal_to(2))
+    assert_that(api_manager.load_shares_data(["AAA", "BBB"])[1]["volume"].sum(), equal_to(sum(range(50))))
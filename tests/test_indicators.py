@@ -0,0 +1,39 @@
+import pytest
+import numpy as np
+import pandas as pd
+from hamcrest import *
+from src.indicators import *
+
+
+def build_prices():
+    rng = np.random.default_rng(0)
+    x = 100 + np.cumsum(rng.normal(size=(120, 3)), axis=0)
+    x[:5, 1] = np.nan
+    return x
+
+
+def test_indicators_match_pandas():
+    x = build_prices()
+    frame = pd.DataFrame(x)
+    values, _ = compute_indicators(x, ["sma_20", "std_20", "ema_12"])
+    assert_that(np.allclose(values[0], frame.rolling(20).mean().values, equal_nan=True), is_(True))
+    assert_that(np.allclose(values[1], frame.rolling(20).std().values, equal_nan=True), is_(True))
+    expected = frame.ewm(span=12, adjust=False, ignore_na=True).mean().values
+    assert_that(np.allclose(values[2], expected, equal_nan=True), is_(True))
+
+
+def test_tail_recompute_matches_full():
+    x = build_prices()
+    names = ["returns", "bollinger_20_2", "ema_12", "rsi_14"]
+    full, _ = compute_indicators(x, names)
+    previous, states = compute_indicators(x[:100], names)
+    tail, _ = compute_indicators(x, names, start=99, states=states, previous=previous)
+    assert_that(tail.shape, equal_to((6, 120, 3)))
+    assert_that(np.allclose(tail, full, equal_nan=True), is_(True))
+
+
+def test_unknown_indicator():
+    assert_that(output_names("bollinger_20_2"), equal_to(["bollinger_20_2_lower", "bollinger_20_2_mid",
+                                                          "bollinger_20_2_upper"]))
+    with pytest.raises(ValueError):
+        parse_indicator("macd_12_26")
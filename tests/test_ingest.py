@@ -0,0 +1,46 @@
+import json
+import pytest
+import numpy as np
+from hamcrest import *
+from src.api_manager import clean_pandas_data
+from src.benchmark import PayloadFactory
+from src.ingest import *
+
+
+def chunked(body, size):
+    return [body[n:n + size] for n in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize("size", [1, 13, STREAM_CHUNK_SIZE])
+def test_json_stream_matches_dict(size):
+    body = PayloadFactory(rows=60, variants=1).body("AMZN").encode()
+    response = parse_body(chunked(body, size))
+    expected = clean_pandas_data(json.loads(body)["Time Series (Daily)"])
+    assert_that(response.info["2. Symbol"], equal_to("AMZN"))
+    assert_that(response.data.columns.tolist(), equal_to(expected.columns.tolist()))
+    assert_that(response.data.index.strftime("%Y-%m-%d").tolist(), equal_to(expected.index.tolist()))
+    assert_that(np.allclose(response.data.values, expected.astype(float).values), is_(True))
+    assert_that(str(response.data["volume"].dtype), equal_to("int64"))
+    assert_that(str(response.data["adjusted close"].dtype), equal_to("float64"))
+
+
+def test_csv_stream():
+    body = (b"timestamp,open,high,low,close,adjusted_close,volume\r\n"
+            b"2020-01-31,1.5,2.5,1.0,1.75,1.75,100\r\n2020-01-30,1.4,2.0,1.0,1.5,1.5,200\r\n")
+    response = parse_body(chunked(body, 7), datatype="csv")
+    assert_that(response.data.columns.tolist(), equal_to(["open", "high", "low", "close", "adjusted close",
+                                                          "volume"]))
+    assert_that(response.data.close.tolist(), equal_to([1.5, 1.75]))
+    assert_that(response.data.volume.tolist(), equal_to([200, 100]))
+
+
+@pytest.mark.parametrize("datatype", ["json", "csv"])
+def test_other_answers_are_dicts(datatype):
+    note = {"Note": "Thank you for using Alpha Vantage!"}
+    assert_that(parse_body(chunked(json.dumps(note).encode(), 5), datatype=datatype), equal_to(note))
+
+
+def test_truncated_json():
+    body = PayloadFactory(rows=10, variants=1).body("AMZN").encode()
+    with pytest.raises(ValueError):
+        parse_body([body[:len(body) // 2]])
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+from hamcrest import *
+import src.api_manager as api_manager
+from src.alpha_vantage_api import alpha_vantage_query, get_api_function
+from src.benchmark import PayloadFactory
+from src.intraday import RingBuffer, IntradayCache, read_partitions, interval_seconds, poll_period, poll_watchlist
+
+
+def bars(start, n, freq="5min"):
+    index = pd.date_range(start, periods=n, freq=freq, name="date").astype("datetime64[ns]")
+    close = np.arange(n, dtype="<f8") + 100
+    return pd.DataFrame({"open": close, "close": close, "volume": np.arange(n, dtype="<i8")}, index=index)
+
+
+def test_intraday_queries():
+    _, params = alpha_vantage_query("MMM", "intraday_5min", key="demo_key")
+    assert_that(params, has_entries(function="TIME_SERIES_INTRADAY", symbol="MMM", interval="5min"))
+    _, params = alpha_vantage_query(["EUR", "USD"], "fx_intraday_1min", key="demo_key")
+    assert_that(params, has_entries(function="FX_INTRADAY", from_symbol="EUR", to_symbol="USD", interval="1min"))
+    assert_that(get_api_function("fx_monthly"), equal_to("FX_MONTHLY"))
+    assert_that(interval_seconds("fx_intraday_15min"), equal_to(900))
+
+
+def test_ring_buffer_wraps_and_replaces_last_bar():
+    data = bars("2020-01-31 09:30", 12)
+    buffer = RingBuffer.like(data, capacity=5)
+    assert_that(buffer.extend(data.iloc[:4]), equal_to(4))
+    assert_that(buffer.extend(data.iloc[2:9]), equal_to(5))        # Last bar received again + 5 new ones
+    assert_that(len(buffer), equal_to(5))
+    assert_that(buffer.latest().index.tolist(), equal_to(data.index[4:9].tolist()))
+    assert_that(buffer.latest(2)["close"].tolist(), equal_to([107.0, 108.0]))
+
+    updated = data.iloc[8:10].copy()
+    updated.loc[updated.index[0], "close"] = 1.0
+    assert_that(buffer.extend(updated), equal_to(1))
+    assert_that(buffer.latest()["close"].tolist(), equal_to([105.0, 106.0, 107.0, 1.0, 109.0]))
+    assert_that(buffer.latest()["volume"].dtype, equal_to(np.dtype("<i8")))
+    assert_that(buffer.last_timestamp, equal_to(data.index[9]))
+
+
+def test_cache_flushes_date_partitions(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path)
+    data = bars("2020-01-30 23:40", 40, freq="3min")                   # Two days
+    cache = IntradayCache(capacity=16)
+    cache.update("MMM", "intraday_5min", data.iloc[:10])
+    files = cache.flush()
+    assert_that([f.name for f in files], equal_to(["2020-01-30.col", "2020-01-31.col"]))
+    assert_that(cache.buffer("MMM", "intraday_5min").pending, equal_to(0))
+
+    # More bars than the buffer holds: the pending ones are flushed before being overwritten
+    cache.update("MMM", "intraday_5min", data.iloc[9:40])
+    cache.flush()
+    stored = read_partitions("MMM", "intraday_5min")
+    pd.testing.assert_frame_equal(stored, data, check_freq=False)
+    pd.testing.assert_frame_equal(cache.latest("MMM", "intraday_5min"), data.iloc[-16:], check_freq=False)
+    assert_that(read_partitions("MMM", "intraday_5min", start="2020-01-31").index[0], equal_to(data.index[7]))
+    assert_that(cache.latest("AMZN", "intraday_5min"), none())
+
+
+def test_poll_watchlist(tmp_path, monkeypatch, stub_providers):
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path)
+    monkeypatch.setattr(api_manager, "RESPONSE_CACHE", False)
+    stub_providers.add("stub_intraday", ("intraday_1min",), limits=(2, [(1, 60)]),
+                       factory=PayloadFactory(rows=10, variants=1))
+    cache = IntradayCache(capacity=50)
+    assert_that(poll_period(["AAA", "BBB"], "intraday_1min", api="stub_intraday"), equal_to(120))
+    stub_providers.loop.run_until_complete(poll_watchlist(["AAA"], "intraday_1min", rounds=1, cache=cache,
+                                                          api="stub_intraday", verbose=0))
+    latest = cache.latest("AAA", "intraday_1min")
+    assert_that(latest.columns.tolist(), equal_to(["open", "high", "low", "close", "volume"]))
+    assert_that(len(latest), equal_to(50))
+    assert_that(len(read_partitions("AAA", "intraday_1min")), equal_to(100))
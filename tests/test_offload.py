@@ -0,0 +1,46 @@
+import asyncio
+import pytest
+from hamcrest import *
+import src.offload as offload
+from src.api_manager import write_pandas_data, read_pandas_data
+from src.benchmark import PayloadFactory
+
+
+@pytest.fixture(params=[0, 1], ids=["inline", "pool"])
+def workers(request, monkeypatch):
+    monkeypatch.setattr(offload, "PROCESS_WORKERS", request.param)
+    offload.metrics.reset()
+    yield request.param
+    offload.shutdown_pool()
+    offload.metrics.reset()
+
+
+def test_run_off_loop(tmp_path, workers):
+    file_name = tmp_path.joinpath("stock_data_daily.col")
+    dat = PayloadFactory(rows=30, variants=1).payload("MMM")["Time Series (Daily)"]
+    loop = asyncio.new_event_loop()
+    try:
+        summary = loop.run_until_complete(offload.run_off_loop("save", write_pandas_data, file_name, dat))
+    finally:
+        loop.close()
+    assert_that(summary, has_entries(data_file="stock_data_daily.col", rows=30))
+    assert_that(read_pandas_data(file_name).shape, equal_to((30, 8)))
+
+    step = offload.metrics.stats()["save"]
+    assert_that(step["calls"], equal_to(1))
+    if workers:
+        assert_that((step["on_loop"], step["off_loop"] > 0, step["wait"] >= step["off_loop"]), equal_to((0, True, True)))
+    else:
+        assert_that((step["on_loop"] > 0, step["off_loop"], step["wait"]), equal_to((True, 0, 0)))
+
+
+def test_metrics_table():
+    metrics = offload.LoopMetrics()
+    with metrics.on_loop("catalog"):
+        pass
+    metrics.add("parse", off_loop=2.0, wait=2.5)
+    metrics.add("parse", on_loop=0.5)
+    table = metrics.table()
+    assert_that(table.index.tolist(), equal_to(["catalog", "parse", "total"]))
+    assert_that(table.loc["parse"].tolist(), equal_to([2, 0.5, 2.0, 2.5]))
+    assert_that(table.loc["total", "calls"], equal_to(3))
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from hamcrest import *
+import src.api_manager as api_manager
+import src.panel as panel_module
+from src.panel import Panel, load_panel, concat_panels
+from src.storage import get_backend
+
+
+def write_series(symbol, dates, close):
+    file_name = api_manager.build_path_and_file(symbol, "daily")[1]
+    data = pd.DataFrame({"close": close, "volume": np.arange(len(dates)) * 10},
+                        index=pd.DatetimeIndex(dates, name="date"))
+    get_backend().write(file_name, data)
+    return file_name
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_manager, "DATA_FOLDER", tmp_path.joinpath("data"))
+    monkeypatch.setattr(panel_module, "PANEL_FOLDER", tmp_path.joinpath("panels"))
+    write_series("AAA", ["2020-01-01", "2020-01-02", "2020-01-03"], [1.0, 2.0, 3.0])
+    write_series("BBB", ["2020-01-02", "2020-01-06"], [20.0, 60.0])
+    return tmp_path
+
+
+def test_alignment_over_the_union_of_dates(data_folder):
+    panel = load_panel(["AAA", "BBB", "CCC"], fields=["close", "volume"], verbose=0)
+    assert_that(panel.dates.strftime("%m-%d").tolist(), equal_to(["01-01", "01-02", "01-03", "01-06"]))
+    assert_that(panel.shape, equal_to((2, 4, 3)))
+    close = panel.frame("close")
+    assert_that(close["AAA"].tolist()[:3], equal_to([1.0, 2.0, 3.0]))
+    assert_that(np.isnan(close.loc["2020-01-06", "AAA"]), is_(True))                 # Date missing in a symbol
+    assert_that(close["BBB"].dropna().tolist(), equal_to([20.0, 60.0]))
+    assert_that(np.isnan(panel["close"][:, 2]).all(), is_(True))                     # Symbol without data
+    assert_that(panel["volume"][:, 0].tolist()[:3], equal_to([0.0, 10.0, 20.0]))
+
+    assert_that(isinstance(panel.values, np.memmap), is_(True))
+    with pytest.raises(ValueError):
+        panel.values[0, 0, 0] = 0.0
+
+
+def test_rebuilt_only_when_a_source_changes(data_folder):
+    first = load_panel(["AAA", "BBB"], fields=["close"], verbose=0)
+    assert_that(load_panel(["AAA", "BBB"], fields=["close"], verbose=0).build, equal_to(first.build))
+    old_files = sorted(f.name for f in data_folder.joinpath("panels").glob(f"*-{first.build}.*.npy"))
+    assert_that(old_files, has_length(2))
+
+    # Same content, new mtime: new build, the files of the old one are removed
+    file_name = api_manager.build_path_and_file("AAA", "daily")[1]
+    stat = file_name.stat()
+    os.utime(file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    second = load_panel(["AAA", "BBB"], fields=["close"], verbose=0)
+    assert_that(second.build, is_not(equal_to(first.build)))
+    assert_that(list(data_folder.joinpath("panels").glob(f"*-{first.build}.*.npy")), empty())
+
+    # Appended rows change the size
+    write_series("BBB", ["2020-01-02", "2020-01-06", "2020-01-07"], [20.0, 60.0, 70.0])
+    third = load_panel(["AAA", "BBB"], fields=["close"], verbose=0)
+    assert_that(third.build, is_not(equal_to(second.build)))
+    assert_that(third.frame("close").loc["2020-01-07", "BBB"], equal_to(70.0))
+
+
+def test_concat_panels():
+    first = Panel(pd.DatetimeIndex(["2020-01-01", "2020-01-03"], name="date"), ["AAA"], ["close"],
+                  np.array([[[1.0], [3.0]]]))
+    second = Panel(pd.DatetimeIndex(["2020-01-02", "2020-01-03"], name="date"), ["BBB", "CCC"], ["close"],
+                   np.array([[[20.0, 200.0], [30.0, 300.0]]]))
+    panel = concat_panels([first, second])
+    assert_that(panel.symbols, equal_to(["AAA", "BBB", "CCC"]))
+    assert_that(panel.dates.day.tolist(), equal_to([1, 2, 3]))
+    expected = [[1.0, np.nan, np.nan], [np.nan, 20.0, 200.0], [3.0, 30.0, 300.0]]
+    assert_that(np.array_equal(panel["close"], np.array(expected), equal_nan=True), is_(True))
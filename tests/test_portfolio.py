@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from hamcrest import *
+from src.portfolio import Portfolio, forward_fill, ledger_symbol
+
+
+DATES = pd.bdate_range("2020-01-06", periods=6, name="date")
+# AAA in base currency, BBB quoted in USD (0.8 GBP per USD): closes already converted, NaN on a holiday
+CLOSE = np.array([[100.0, 80.0], [110.0, 80.0], [110.0, np.nan], [121.0, 88.0], [121.0, 88.0], [99.0, 88.0]])
+RATES = np.array([[1.0, 0.8]] * 6)
+LEDGER = pd.DataFrame([["2020-01-06", "ISA", "AAA", 10, 100.0, 0.0],
+                       ["2020-01-07", "SIPP", "BBB", 5, None, None],
+                       ["2020-01-09", "ISA", "AAA", -5, 121.0, 1.0],
+                       ["2020-01-11", "SIPP", "BBB", 5, 110.0, 0.0]],       # Saturday: valued on Monday
+                      columns=["date", "account", "symbol", "quantity", "price", "fees"])
+
+
+def test_helpers():
+    assert_that(ledger_symbol("BTC_GBP"), equal_to(("BTC", "GBP")))
+    assert_that(ledger_symbol("DGE.LON"), equal_to("DGE.LON"))
+    filled = forward_fill(np.array([[np.nan, 1.0], [2.0, np.nan], [np.nan, np.nan]]), last=np.array([5.0, 0.0]))
+    assert_that(filled.tolist(), equal_to([[5.0, 1.0], [2.0, 1.0], [2.0, 1.0]]))
+
+
+def test_valuation():
+    portfolio = Portfolio(LEDGER).value(DATES, CLOSE, RATES)
+    nav = portfolio.frame("nav")
+    assert_that(nav["ISA"].tolist(), equal_to([1000.0, 1100.0, 1100.0, 605.0, 605.0, 495.0]))
+    assert_that(nav["SIPP"].tolist(), equal_to([0.0, 400.0, 400.0, 440.0, 440.0, 880.0]))
+    flows = portfolio.frame("flows")
+    assert_that(flows.loc[DATES[3], "ISA"], equal_to(-5 * 121.0 + 1.0))
+    assert_that(flows.loc[DATES[5], "SIPP"], equal_to(5 * 110.0 * 0.8))
+
+    twr = portfolio.frame("twr")["ISA"]
+    # +10%, +10% less the fee on the day of the sale (selling at the close does not change the return), -18.2%
+    assert_that(twr.iloc[-1], close_to(1.1 * (1210 - 1) / 1100 * 495 / 605 - 1, 1e-12))
+    assert_that(portfolio.frame("drawdown")["ISA"].iloc[-1], close_to(495 / 605 - 1, 1e-12))
+    assert_that(portfolio.frame("pnl")["total"].iloc[-1], close_to(495 + 880 - 1000 + 604 - 400 - 440, 1e-9))
+    assert_that(portfolio.summary().index.tolist(), equal_to(["ISA", "SIPP", "total"]))
+
+
+def test_incremental_matches_full():
+    full = Portfolio(LEDGER).value(DATES, CLOSE, RATES)
+    portfolio = Portfolio(LEDGER).update(DATES[:3], CLOSE[:3], RATES[:3])
+    assert_that(portfolio.state.date, equal_to(DATES[2]))
+    portfolio.update(DATES, CLOSE, RATES)
+    for metric in ("nav", "pnl", "returns", "twr", "drawdown"):
+        assert_that(np.allclose(portfolio.frame(metric), full.frame(metric)), equal_to(True))
+
+    # A trade after the last valued date keeps the state, an older one values every date again
+    portfolio.add_trades(pd.DataFrame([["2020-01-14", "ISA", "AAA", 1]], columns=["date", "account", "symbol",
+                                                                                   "quantity"]))
+    assert_that(portfolio.state, not_none())
+    portfolio.add_trades(pd.DataFrame([["2020-01-06", "ISA", "AAA", 1]], columns=["date", "account", "symbol",
+                                                                                   "quantity"]))
+    assert_that(portfolio.state, none())
@@ -0,0 +1,43 @@
+from hamcrest import *
+import src.api_manager as api_manager
+from src.ingest import VantageResponse
+from src.crawler_semaphore import SemaphoreController
+from src.providers import PROVIDERS, providers_for, pick_provider, calls_per_minute, unregister_provider
+
+
+def test_providers_for():
+    assert_that(providers_for("daily-adjusted"), contains_exactly(PROVIDERS["vantage"]))
+    assert_that(providers_for("search", api="alpha_vantage"), contains_exactly(PROVIDERS["vantage"]))
+    assert_that(calling(providers_for).with_args("daily", api="myallies"), raises(ValueError))
+    assert_that(calling(providers_for).with_args("daily", api="unknown"), raises(ValueError))
+
+
+def test_failover_to_provider_with_spare_quota(stub_providers, monkeypatch):
+    # Two providers of the same data (the first one allows a single call)
+    server_a, server_b = (stub_providers.add(name, ("daily-adjusted",), calls=calls, period=60)
+                          for name, calls in (("stub_a", 1), ("stub_b", 100)))
+    loop = stub_providers.loop
+    monkeypatch.setattr(api_manager, "RESPONSE_CACHE", False)
+    candidates = ["stub_a", "stub_b"]
+    assert_that(calls_per_minute(["daily-adjusted"], api=candidates), close_to(200, 1e-9))
+
+    answers = [loop.run_until_complete(api_manager.query_data(symbol, category="daily-adjusted", api=candidates,
+                                                              stream=True, verbose=0))
+               for symbol in ("AAA", "BBB", "CCC")]
+    assert_that(all(isinstance(answer, VantageResponse) for answer in answers), is_(True))
+    assert_that([answer.info["2. Symbol"] for answer in answers], equal_to(["AAA", "BBB", "CCC"]))
+    # The second query is throttled by the first provider and retried on the second one, which then gets the rest
+    assert_that((server_a.served, server_a.notes), equal_to((1, 1)))
+    assert_that((server_b.served, server_b.notes), equal_to((2, 0)))
+    assert_that(pick_provider([PROVIDERS["stub_a"], PROVIDERS["stub_b"]]).name, equal_to("stub_b"))
+
+
+def test_unregister_provider(stub_providers):
+    stub_providers.add("stub_c", ("daily",), limits=(1, [(5, 60)]))
+    assert_that(SemaphoreController().delay("stub_c"), equal_to(0.0))
+    assert_that(unregister_provider("stub_c").name, equal_to("stub_c"))
+    # Registered again with other limits: the old limiter is not reused
+    stub_providers.add("stub_c", ("daily",), limits=(1, [(1, 60)]))
+    loop = stub_providers.loop
+    loop.run_until_complete(SemaphoreController().wait_for_rate("stub_c"))
+    assert_that(SemaphoreController().delay("stub_c"), greater_than(0.0))
@@ -0,0 +1,45 @@
+import pytest
+import numpy as np
+import pandas as pd
+from hamcrest import *
+from src.resample import resample_bars, resample_tail, derived_from
+
+
+def build_daily():
+    index = pd.to_datetime(["2019-11-28", "2019-11-29", "2019-12-02", "2019-12-03", "2019-12-09"])
+    return pd.DataFrame({"open": [1.0, 2.0, 3.0, 4.0, 5.0], "high": [1.5, 2.5, 3.5, 4.5, 5.5],
+                         "low": [0.5, 1.5, 2.5, 3.5, 4.5], "close": [1.2, 2.2, 3.2, 4.2, 5.2],
+                         "volume": [10, 20, 30, 40, 50], "split coefficient": [1.0, 2.0, 1.0, 1.0, 1.0]},
+                        index=index)
+
+
+RESAMPLE_DATA = (
+    ["monthly", ["2019-11-29", "2019-12-09"], [1.0, 3.0], [2.5, 5.5], [2.2, 5.2], [30, 120]],
+    ["weekly", ["2019-11-29", "2019-12-03", "2019-12-09"], [1.0, 3.0, 5.0], [2.5, 4.5, 5.5], [2.2, 4.2, 5.2],
+     [30, 70, 50]],
+)
+
+
+@pytest.mark.parametrize("period, dates, opens, highs, closes, volumes", RESAMPLE_DATA)
+def test_resample_bars(period, dates, opens, highs, closes, volumes):
+    bars = resample_bars(build_daily(), period)
+    assert_that([str(d.date()) for d in bars.index], equal_to(dates))
+    assert_that(bars.open.tolist(), equal_to(opens))
+    assert_that(bars.high.tolist(), equal_to(highs))
+    assert_that(bars.close.tolist(), equal_to(closes))
+    assert_that(bars.volume.tolist(), equal_to(volumes))
+    assert_that(bars["split coefficient"].iloc[0], equal_to(2.0))
+
+
+def test_resample_tail_matches_full_resample():
+    daily = build_daily()
+    partial = resample_bars(daily.iloc[:3], "weekly")
+    updated = resample_tail(daily, partial, "weekly")
+    assert_that(np.array_equal(updated.values, resample_bars(daily, "weekly").values), is_(True))
+
+
+@pytest.mark.parametrize("category, expected", (["monthly-adjusted", ("daily-adjusted", "monthly", True)],
+                                                ["daily", ("daily-adjusted", None, False)],
+                                                ["fx_weekly", ("fx_daily", "weekly", False)]))
+def test_derived_from(category, expected):
+    assert_that(derived_from(category), equal_to(expected))
@@ -0,0 +1,68 @@
+import pytest
+from hamcrest import *
+from src.response_cache import ResponseCache, cache_key, ttl_for, conditional_headers
+from src.config import CACHE_TTL_SEARCH, CACHE_TTL_DAILY, CACHE_TTL_MONTHLY
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_key_ignores_order_and_apikey():
+    key_a = cache_key({"function": "TIME_SERIES_DAILY", "symbol": "MMM", "apikey": "a"})
+    key_b = cache_key({"symbol": "MMM", "apikey": "b", "function": "TIME_SERIES_DAILY"})
+    assert_that(key_a, equal_to(key_b))
+    assert_that(key_a, is_not(equal_to(cache_key({"function": "TIME_SERIES_DAILY", "symbol": "MMM",
+                                                  "outputsize": "compact"}))))
+
+
+@pytest.mark.parametrize("category, expected", (["search", CACHE_TTL_SEARCH], ["daily-adjusted", CACHE_TTL_DAILY],
+                                                ["fx_monthly", CACHE_TTL_MONTHLY]))
+def test_ttl_for(category, expected):
+    assert_that(ttl_for(category), equal_to(expected))
+
+
+def test_ttl_and_counters(tmp_path):
+    clock = FakeClock()
+    cache = ResponseCache(folder=tmp_path, clock=clock)
+    cache.put("k", {"a": 1}, etag='"v1"')
+    assert_that(cache.get("k", ttl=10), equal_to({"a": 1}))
+    clock.now += 11
+    assert_that(cache.get("k", ttl=10), none())
+    assert_that(conditional_headers(cache.lookup("k")), equal_to({"If-None-Match": '"v1"'}))
+    assert_that(cache.stats(), has_entries(hits=1, misses=1, entries=1))
+
+
+def test_lru_eviction(tmp_path):
+    clock = FakeClock()
+    cache = ResponseCache(folder=tmp_path, max_bytes=10 ** 6, clock=clock)
+    for key in ["a", "b", "c"]:
+        clock.now += 1
+        cache.put(key, {"payload": "x" * 100})
+    clock.now += 1
+    cache.lookup("a")                               # "b" is now the least recently used
+    cache.max_bytes = cache.size - 1
+    cache.evict()
+    assert_that(cache.lookup("b"), none())
+    assert_that(cache.lookup("a"), not_none())
+    assert_that(cache.evictions, equal_to(1))
+
+
+def test_streamed_body(tmp_path):
+    clock = FakeClock()
+    cache = ResponseCache(folder=tmp_path, clock=clock)
+    body_tmp = cache.body_tmp_file("k")
+    assert_that(cache.body_tmp_file("k"), is_not(equal_to(body_tmp)))     # Same query received twice at once
+    body_tmp.write_bytes(b'{"Meta Data": {}}')
+    cache.put_body("k", body_tmp, etag='"v1"')
+    assert_that(cache.get("k", ttl=10), equal_to(cache.body_file("k")))
+    assert_that(cache.size, greater_than(len(b'{"Meta Data": {}}')))
+    clock.now += 11
+    cache.refresh("k", cache.lookup("k"))
+    assert_that(cache.get("k", ttl=10).read_bytes(), equal_to(b'{"Meta Data": {}}'))
+    cache.discard("k")
+    assert_that(list(tmp_path.iterdir()), empty())
@@ -0,0 +1,67 @@
+import asyncio
+from hamcrest import *
+import src.scheduler as scheduler
+from src.scheduler import UpdateJob, Progress, plan_jobs, run_jobs, job_priority, jobs_total
+
+
+def run(coroutine):
+    """Run in a new event loop closed afterwards (nest_asyncio makes asyncio.run reuse the current one)"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_plan_jobs_skips_fresh_series_and_sorts_by_staleness(monkeypatch):
+    staleness = {"AAA": 10.0, "BBB": 2.0, "CCC": None, "DDD": 30.0}
+
+    async def get_staleness(symbol, category, verbose):
+        return staleness[symbol]
+
+    monkeypatch.setattr(scheduler, "get_staleness", get_staleness)
+    jobs = run(plan_jobs([(["AAA", "BBB", "CCC", "DDD"], ["daily"], [])], gap=7, verbose=0))
+    # Never updated first, then the most stale; BBB was refreshed 2 days ago (< gap)
+    assert_that([job.symbol for job in jobs], equal_to(["CCC", "DDD", "AAA"]))
+
+
+def test_run_jobs_takes_the_most_stale_first(monkeypatch):
+    calls = []
+
+    async def update_stock(symbol, category, max_gap, verbose):
+        calls.append(symbol)
+        return "ok"
+
+    monkeypatch.setattr(scheduler, "update_stock", update_stock)
+    jobs = [UpdateJob("AAA", "daily", 8.0), UpdateJob("BBB", "daily", None), UpdateJob("CCC", "daily", 20.0)]
+    run(run_jobs(jobs, workers=1, verbose=0))
+    assert_that(calls, equal_to(["BBB", "CCC", "AAA"]))
+    assert_that(calls, equal_to([job.symbol for job in sorted(jobs, key=job_priority)]))
+
+
+def test_progress_eta():
+    now = [0.0]
+    progress = Progress(10, calls_per_minute=5, clock=lambda: now[0])
+    assert_that(progress.eta(), equal_to(120.0))            # Rate limit until a job finishes
+    now[0] = 30.0
+    progress.update()
+    progress.update(ok=False)
+    assert_that(progress.eta(), equal_to(120.0))            # 8 jobs left at 15 s per job
+    assert_that(str(progress), starts_with("2/10 (20.0%) failed: 1 elapsed: 0:00:30 ETA: 0:02:00"))
+
+
+def test_run_jobs_counts_failed_updates(monkeypatch):
+    statuses = {"AAA": "ok", "BBB": "error", "CCC": "empty"}
+
+    async def update_stock(symbol, category, max_gap, verbose):
+        if symbol == "DDD":
+            raise RuntimeError("Unexpected")
+        return statuses[symbol]
+
+    monkeypatch.setattr(scheduler, "update_stock", update_stock)
+    before = {status: jobs_total.value(category="daily", status=status) or 0 for status in ("ok", "error", "empty")}
+    jobs = [UpdateJob(symbol, "daily", 1) for symbol in ("AAA", "BBB", "CCC", "DDD")]
+    progress = run(run_jobs(jobs, workers=2, verbose=0))
+    assert_that((progress.done, progress.failed), equal_to((4, 3)))
+    counts = {status: (jobs_total.value(category="daily", status=status) or 0) - before[status] for status in before}
+    assert_that(counts, equal_to({"ok": 1, "error": 2, "empty": 1}))
@@ -0,0 +1,89 @@
+import pytest
+import numpy as np
+import pandas as pd
+from hamcrest import *
+from src.storage import *
+
+
+def build_frame():
+    index = pd.Index(["2019-12-20", "2019-12-23", "2019-12-24"], name="date")
+    return pd.DataFrame({"open": ["1.5", "2.0", "2.5"], "close": ["1.75", "2.25", "2.0"],
+                         "volume": ["100", "200", "300"]}, index=index)
+
+
+@pytest.mark.parametrize("backend, suffix", (["zip", ".zip"], ["columnar", ".col"]))
+def test_backend_roundtrip(tmp_path, backend, suffix):
+    file_name = tmp_path.joinpath("stock_data_daily" + suffix)
+    storage = get_backend(backend)
+    storage.write(file_name, build_frame())
+    data = backend_for(file_name).read(file_name)
+    assert_that(data.columns.tolist(), equal_to(["open", "close", "volume"]))
+    assert_that(data.close.tolist(), equal_to([1.75, 2.25, 2.0]))
+    assert_that(data.volume.tolist(), equal_to([100, 200, 300]))
+    assert_that(str(data.index[-1].date()), equal_to("2019-12-24"))
+
+
+def test_columnar_projection_and_dtypes(tmp_path):
+    file_name = tmp_path.joinpath("stock_data_daily.col")
+    get_backend("columnar").write(file_name, build_frame())
+    data = get_backend("columnar").read(file_name, columns=["volume"])
+    assert_that(data.columns.tolist(), equal_to(["volume"]))
+    assert_that(str(data.volume.dtype), equal_to("int64"))
+    assert_that(str(data.index.dtype), equal_to("datetime64[ns]"))
+    with pytest.raises(ValueError):
+        get_backend("columnar").read(file_name, columns=["high"])
+
+
+def test_migrate_data_folder(tmp_path):
+    folder = tmp_path.joinpath("AMZN")
+    folder.mkdir()
+    get_backend("zip").write(folder.joinpath("stock_data_daily.zip"), build_frame())
+    migrated = migrate_data_folder(tmp_path, remove=True, verbose=0)
+    assert_that(migrated, equal_to([folder.joinpath("stock_data_daily.col")]))
+    assert_that(folder.joinpath("stock_data_daily.zip").exists(), is_(False))
+
+
+def test_columnar_append_replaces_tail(tmp_path):
+    file_name = tmp_path.joinpath("stock_data_daily.col")
+    storage = get_backend("columnar")
+    storage.write(file_name, build_frame())
+    update = pd.DataFrame({"open": ["2.6", "3.0"], "close": ["2.1", "3.5"], "volume": ["350", "400"]},
+                          index=pd.Index(["2019-12-24", "2019-12-26"], name="date"))
+    storage.append(file_name, update)
+    data = storage.read(file_name)
+    assert_that(len(storage.segments(file_name)), equal_to(2))
+    assert_that([str(d.date()) for d in data.index], equal_to(["2019-12-20", "2019-12-23", "2019-12-24", "2019-12-26"]))
+    assert_that(data.close.tolist(), equal_to([1.75, 2.25, 2.1, 3.5]))
+
+
+def test_columnar_interrupted_append(tmp_path):
+    file_name = tmp_path.joinpath("stock_data_daily.col")
+    storage = get_backend("columnar")
+    storage.write(file_name, build_frame())
+    with open(file_name, "ab") as f:
+        f.write(storage.encode_segment(build_frame().iloc[-1:])[:-4])      # Crash in the middle of a write
+    assert_that(storage.read(file_name).close.tolist(), equal_to([1.75, 2.25, 2.0]))
+    storage.append(file_name, build_frame().iloc[-1:])
+    assert_that(len(storage.segments(file_name)), equal_to(2))
+    assert_that(storage.read(file_name).close.tolist(), equal_to([1.75, 2.25, 2.0]))
+
+
+@pytest.mark.parametrize("start, end", [(None, None), ("2020-01-10", None), (None, "2020-01-20"),
+                                        ("2020-01-14", "2020-01-16"), ("2020-02-01", None), (None, "2019-12-01")])
+def test_date_range_pushdown(tmp_path, start, end):
+    dates = pd.bdate_range("2020-01-01", periods=20, name="date")
+    data = pd.DataFrame({"close": np.arange(20.0), "volume": np.arange(20) * 10}, index=dates)
+    columnar = tmp_path.joinpath("stock_data_daily.col")
+    storage = get_backend("columnar")
+    storage.write(columnar, data.iloc[:10])
+    storage.append(columnar, data.iloc[9:15] + 100)                  # Replaces the last bar
+    storage.append(columnar, data.iloc[14:] + 1000, start=dates[12])
+    expected = storage.read(columnar).loc[start:end]
+
+    ranged = storage.read(columnar, columns=["volume"], start=start, end=end)
+    assert_that(ranged.equals(expected[["volume"]]), equal_to(True))
+    assert_that(str(ranged.volume.dtype), equal_to("int64"))
+
+    zipped = tmp_path.joinpath("stock_data_daily.zip")
+    get_backend("zip").write(zipped, storage.read(columnar))
+    assert_that(get_backend("zip").read(zipped, start=start, end=end).equals(expected), equal_to(True))
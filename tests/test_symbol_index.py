@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+from hamcrest import *
+import src.api_manager as api_manager
+from src.catalog import Catalog
+from src.response_cache import ResponseCache
+from src.symbol_index import SymbolIndex, normalize, is_isin, is_sedol
+
+
+SSE = {"1. symbol": "SSE.LON", "2. name": "SSE plc", "3. type": "Equity", "4. region": "United Kingdom",
+       "5. marketOpen": "08:00", "6. marketClose": "16:30", "7. timezone": "UTC+01", "8. currency": "GBP",
+       "9. matchScore": "1.0000"}
+INFO = [{"symbol": "AMZN", "name": "Amazon.com Inc.", "region": "United States", "currency": "USD",
+         "Last Refreshed": "2019-12-24"},
+        {"symbol": "BAS.DEX", "name": "BASF SE", "region": "XETRA", "currency": "EUR"},
+        {"symbol": "JNJ", "name": "Johnson & Johnson", "region": "United States", "currency": "USD"}]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SymbolIndex(tmp_path.joinpath("symbol_index.json"))
+    for info in INFO:
+        index.add(info)
+    return index
+
+
+def test_identifiers():
+    assert_that(normalize("Johnson&Johnson"), equal_to("JOHNSON JOHNSON"))
+    assert_that([is_isin(code) for code in ("GB0007908733", "US0378331005", "US0378331006")],
+                equal_to([True, True, False]))
+    assert_that([is_sedol(code) for code in ("0790873", "B0YBKJ7", "0790874")], equal_to([True, True, False]))
+
+
+def test_search(index):
+    assert_that(index.entries["AMZN"], is_not(has_key("Last Refreshed")))
+    best = {keyword: [(m["symbol"], float(m["matchScore"])) for m in index.search(keyword)][:1]
+            for keyword in ("AMZN", "bas.dex", "amazon", "Johnson&Johnson", "Amazn", "BA", "united")}
+    assert_that(best["AMZN"], equal_to([("AMZN", 1.0)]))
+    assert_that(best["bas.dex"], equal_to([("BAS.DEX", 1.0)]))
+    assert_that(best["amazon"], equal_to([("AMZN", 0.95)]))
+    assert_that(best["Johnson&Johnson"], equal_to([("JNJ", 0.95)]))
+    assert_that(best["Amazn"], equal_to([("AMZN", 0.9)]))                 # Typo
+    assert_that(best["BA"][0][0], equal_to("BAS.DEX"))
+    assert_that(best["united"], empty())                                   # Regions only narrow the name matches
+    assert_that(index.search("amazon united")[0]["symbol"], equal_to("AMZN"))
+    assert_that(index.search("son", currency="eur"), empty())
+
+    # A short prefix is not enough to skip the API
+    assert_that(index.lookup("BA"), none())
+    assert_that(index.lookup("basf")["bestMatches"][0]["symbol"], equal_to("BAS.DEX"))
+    assert_that((index.hits, index.misses), equal_to((1, 1)))
+
+
+def test_merge_answer(index):
+    index.merge_answer("GB0007908733", {"bestMatches": [SSE]})
+    index.merge_answer("nothing at all", {"bestMatches": []})
+    assert_that(index.aliases, equal_to({"GB0007908733": "SSE.LON"}))
+    assert_that(index.entries["SSE.LON"]["marketClose"], equal_to("16:30"))
+    index.save()
+
+    index = SymbolIndex(index.index_file).load()
+    assert_that(index.lookup("gb0007908733")["bestMatches"][0]["symbol"], equal_to("SSE.LON"))
+    assert_that(index.lookup("SSE")["bestMatches"][0]["name"], equal_to("SSE plc"))
+    # Keywords already searched are answered even without matches
+    assert_that(index.lookup("Nothing at all!"), equal_to({"bestMatches": []}))
+
+
+def test_search_symbol(index, tmp_path, monkeypatch):
+    calls = []
+
+    async def query_data(symbol, category, api, verbose):
+        calls.append(symbol)
+        return {"bestMatches": [SSE]}
+
+    monkeypatch.setattr(api_manager, "symbol_index", index)
+    monkeypatch.setattr(api_manager, "catalog", Catalog(db_file=tmp_path.joinpath("catalog.db"), data_folder=tmp_path))
+    monkeypatch.setattr(api_manager, "response_cache", ResponseCache(folder=tmp_path.joinpath("responses")))
+    monkeypatch.setattr(api_manager, "query_data", query_data)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    answers = api_manager.search_symbol(["AMZN", "SSE"], verbose=0)
+    assert_that(calls, equal_to(["SSE"]))
+    assert_that(answers[0]["bestMatches"][0]["symbol"], equal_to("AMZN"))
+    assert_that(answers[1]["bestMatches"][0], has_entries({"symbol": "SSE.LON", "matchScore": "1.0000"}))
+    assert_that(index.index_file.exists(), equal_to(True))
+
+    api_manager.search_symbol(["SSE", "sse plc"], verbose=0)
+    assert_that(calls, equal_to(["SSE"]))
+
+
+def test_corrupted_index_is_rebuilt_from_cached_answers(tmp_path):
+    response_cache = ResponseCache(folder=tmp_path.joinpath("responses"))
+    response_cache.put("sse", {"bestMatches": [SSE]}, params={"function": "SYMBOL_SEARCH", "keywords": "SSE"})
+    index_file = tmp_path.joinpath("symbol_index.json")
+    index_file.write_text('{"entries": {"AMZN"')
+    index = SymbolIndex(index_file).load(response_cache=response_cache)
+    assert_that(index.queries, has_key("SSE"))
+    assert_that(index.lookup("sse")["bestMatches"][0]["symbol"], equal_to("SSE.LON"))
@@ -0,0 +1,81 @@
+import json
+import asyncio
+import pytest
+from hamcrest import *
+from src.offload import LoopMetrics
+from src.telemetry import Registry, trace, span
+
+
+def test_metrics():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ("api",))
+    requests.inc(api="vantage")
+    requests.inc(2, api="vantage")
+    assert_that(registry.counter("requests_total", "Requests", ("api",)), same_instance(requests))
+    assert_that(requests.value(api="vantage"), equal_to(3))
+    with pytest.raises(ValueError):
+        requests.inc(provider="vantage")
+    with pytest.raises(ValueError):
+        registry.gauge("requests_total")
+
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for seconds in (0.05, 0.5, 5.0):
+        latency.observe(seconds)
+    assert_that(latency.value(), equal_to({"buckets": [1, 2], "sum": 5.55, "count": 3}))
+
+
+def test_exports(tmp_path):
+    registry = Registry()
+    registry.counter("requests_total", "Requests", ("api",)).inc(api='a"b')
+    registry.histogram("latency_seconds", "Latency", buckets=(1.0,)).observe(0.5)
+    registry.add_collector(lambda reg: reg.gauge("depth", "Queue depth").set(4))
+
+    text = registry.prometheus()
+    assert_that(text, contains_string('requests_total{api="a\\"b"} 1'))
+    assert_that(text, contains_string('latency_seconds_bucket{le="+Inf"} 1'))
+    assert_that(text, contains_string("# TYPE depth gauge\ndepth 4"))
+
+    registry.write(tmp_path.joinpath("pythia.prom"))
+    assert_that(tmp_path.joinpath("pythia.prom").read_text(), equal_to(registry.prometheus()))
+    snapshot = json.loads(registry.write(tmp_path.joinpath("pythia.json")).read_text())
+    assert_that(snapshot["metrics"]["depth"]["samples"], equal_to([{"labels": {}, "value": 4}]))
+    assert_that(list(tmp_path.glob("*.tmp")), empty())
+
+
+def test_traces():
+    registry = Registry(trace_history=2)
+
+    async def update(symbol):
+        with trace("update", registry=registry, symbol=symbol):
+            with span("query", registry=registry):
+                await asyncio.sleep(0.01)
+            with span("save", registry=registry):
+                pass
+
+    async def main():
+        await asyncio.gather(*(update(symbol) for symbol in ("AAA", "BBB", "CCC")))
+
+    asyncio.new_event_loop().run_until_complete(main())
+    # Concurrent traces keep their own spans; only the last ones are kept
+    assert_that(len(registry.traces), equal_to(2))
+    for traced in registry.traces:
+        assert_that([x["stage"] for x in traced["spans"]], equal_to(["query", "save"]))
+    assert_that(registry.histogram("pythia_stage_seconds", labels=("stage",)).value(stage="query")["count"],
+                equal_to(3))
+    # Spans out of any trace are still observed
+    with span("read", registry=registry):
+        pass
+    assert_that(registry.histogram("pythia_stage_seconds", labels=("stage",)).value(stage="read")["count"],
+                equal_to(1))
+
+
+def test_loop_metrics_bridge():
+    registry = Registry()
+    metrics = LoopMetrics(registry=registry)
+    metrics.add("save", off_loop=0.2, wait=0.3)
+    with metrics.on_loop("parse"):
+        pass
+    steps = registry.histogram("pythia_step_seconds", labels=("step", "where"))
+    assert_that(steps.value(step="save", where="off_loop")["sum"], equal_to(0.2))
+    assert_that(steps.value(step="save", where="on_loop"), none())
+    assert_that(steps.value(step="parse", where="on_loop")["count"], equal_to(1))